@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Two-tier cache of answers placed in front of process_query.
+
+Tier one matches the normalized query text exactly. Tier two embeds the
+query and returns the answer of the most similar cached query if its cosine
+similarity clears a threshold, so rephrasings of common questions ("when is
+trash day?" / "what day is trash pickup") skip retrieval and generation.
+Entries expire after a TTL, the cache is bounded with LRU eviction, and it
+is cleared whenever the ingest manifest changes (i.e. after an ingest).
+"""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from vector_utils import normalize_rows
+from query_timing import stage
+
+# Load environment variables
+answer_cache_enabled = os.environ.get('ANSWER_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+answer_cache_ttl = float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+answer_cache_max_entries = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000))
+answer_cache_similarity = float(os.environ.get('ANSWER_CACHE_SIMILARITY', 0.95))
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', query.lower()).split())
+
+
+def file_version(path: str) -> Callable[[], Optional[float]]:
+    """Version function that changes whenever the file at path is rewritten."""
+    def version():
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+    return version
+
+
+class AnswerCache:
+    """Exact and nearest-neighbour answer cache with TTL and LRU eviction.
+
+    Args:
+        embed_fn: Returns the embedding of a query, used by the semantic tier.
+            Pass None to use the exact tier only.
+        version_fn: Returns a token identifying the current index contents;
+            the cache is cleared whenever it changes.
+    """
+
+    def __init__(self, embed_fn: Optional[Callable[[str], List[float]]] = None,
+                 version_fn: Optional[Callable[[], Any]] = None,
+                 ttl: float = answer_cache_ttl, max_entries: int = answer_cache_max_entries,
+                 similarity: float = answer_cache_similarity):
+        self.embed_fn = embed_fn
+        self.version_fn = version_fn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._version = version_fn() if version_fn else None
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._clear()
+
+    def _clear(self):
+        # key -> (result, row); rows index the vector matrix
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._vectors = None
+        self._expires = np.zeros(self.max_entries, dtype=np.float64)
+        self._row_keys: List[Optional[str]] = [None] * self.max_entries
+        self._free = list(range(self.max_entries - 1, -1, -1))
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the index changed."""
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def _check_version(self):
+        if self.version_fn is None:
+            return
+        version = self.version_fn()
+        if version != self._version:
+            self._version = version
+            self._clear()
+            self.invalidations += 1
+
+    def _remove(self, key: str):
+        _, row = self._entries.pop(key)
+        self._expires[row] = 0
+        self._row_keys[row] = None
+        self._free.append(row)
+
+    def _embed(self, query: str) -> Optional[np.ndarray]:
+        if self.embed_fn is None:
+            return None
+        try:
+            return normalize_rows(self.embed_fn(query))
+        except Exception as e:
+            print(f"Answer cache could not embed query: {e}")
+            return None
+
+    def lookup(self, query: str):
+        """Return (result, tier, vector) where tier is 'exact', 'semantic' or None on a miss.
+
+        The query vector is returned so a following store() need not re-embed.
+        """
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expires[entry[1]] > now:
+                    self._entries.move_to_end(key)
+                    self.hits_exact += 1
+                    return entry[0], 'exact', None
+                self._remove(key)
+
+        vector = self._embed(query)
+        with self._lock:
+            if vector is not None and self._vectors is not None and self._entries:
+                scores = self._vectors @ vector
+                scores[self._expires <= now] = -np.inf
+                row = int(np.argmax(scores))
+                if scores[row] >= self.similarity:
+                    match = self._row_keys[row]
+                    self._entries.move_to_end(match)
+                    self.hits_semantic += 1
+                    return self._entries[match][0], 'semantic', vector
+            self.misses += 1
+        return None, None, vector
+
+    def store(self, query: str, result: Dict[str, Any], vector: Optional[np.ndarray] = None):
+        key = normalize_query(query)
+        if vector is None:
+            vector = self._embed(query)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while not self._free:
+                self._remove(next(iter(self._entries)))
+            row = self._free.pop()
+            if vector is not None:
+                if self._vectors is None:
+                    self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                self._vectors[row] = vector
+            self._expires[row] = time.time() + self.ttl
+            self._row_keys[row] = key
+            self._entries[key] = (result, row)
+
+    def stats(self) -> dict:
+        lookups = self.hits_exact + self.hits_semantic + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits_exact": self.hits_exact,
+            "hits_semantic": self.hits_semantic,
+            "misses": self.misses,
+            "hit_ratio": (self.hits_exact + self.hits_semantic) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+def cached_answer(cache: Optional[AnswerCache], query: str,
+                  answer_fn: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+    """Answer a query through the cache, calling answer_fn on a miss.
+
+    Results carrying an ``error`` key are never cached.
+    """
+    if cache is None or not query or not query.strip():
+        return answer_fn(query)
+
+    start = time.time()
+    with stage("cache"):
+        result, tier, vector = cache.lookup(query)
+    if result is not None:
+        res = dict(result)
+        res["cached"] = tier
+        res["processing_time"] = time.time() - start
+        return res
+
+    res = answer_fn(query)
+    if not res.get("error"):
+        cache.store(query, res, vector)
+    return res
@@ -1,19 +1,37 @@
 #!/usr/bin/env python3
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File
+from fastapi import FastAPI, HTTPException, Body, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import uvicorn
 import os
 import sys
 import shutil
-from typing import List, Optional
-from fastapi.responses import FileResponse
+import time
+from typing import Dict, List, Optional
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 
 # Import your privateGPT modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from new_private_gpt import create_qa_chain, process_query
-from ingest import process_documents, does_vectorstore_exist
+from new_private_gpt import create_qa_chain, process_query, stream_query, answer_cache
+from query_stream import ndjson
+from query_executor import run_query, stream_query_events, executor_stats
+from query_coalescer import coalescing_stats
+from llm_scheduler import scheduler, client_id, SchedulerRejected
+from ollama_warmup import warm_up_model, start_keep_alive, model_state
+from ingest import ingest_incremental, load_embeddings, does_vectorstore_exist
+from embedding_cache import cache_stats
+from metrics import (
+    registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE, observe_query, observe_events,
+    track_in_flight, answer_cache_families
+)
+
+# This server has no intent routing: every query is a document (RAG) query
+INTENT = "rag"
+
+metrics_registry.add_collector(lambda: answer_cache_families(answer_cache))
 
 app = FastAPI(title="PrivateGPT API")
 
@@ -38,6 +56,9 @@ async def root():
 # Initialize the QA chain on startup
 @app.on_event("startup")
 async def startup_event():
+    # Load the LLM before accepting traffic, then keep it resident
+    await run_in_threadpool(warm_up_model)
+    start_keep_alive()
     create_qa_chain()
     print("QA chain initialized")
 
@@ -53,23 +74,39 @@ class QueryResponse(BaseModel):
     result: str
     source_documents: Optional[List[Document]] = None
     processing_time: Optional[float] = None
+    timings: Optional[Dict[str, float]] = None  # Seconds per stage (embed, retrieve, llm, ...)
 
 class IngestResponse(BaseModel):
     status: str
     documents_processed: int
 
+@app.exception_handler(SchedulerRejected)
+async def scheduler_rejected(http_request: Request, exc: SchedulerRejected):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+def admit(http_request: Request):
+    """Rate-limit and queue-limit a query before doing any work."""
+    host = http_request.client.host if http_request.client else None
+    return scheduler.admit(client_id(http_request.headers, host))
+
 @app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest = Body(...)):
+async def query(http_request: Request, request: QueryRequest = Body(...)):
     if not request.query:
         raise HTTPException(status_code=400, detail="Query cannot be empty")
     
+    start = time.perf_counter()
     try:
-        result = process_query(request.query)
+        # Run the blocking query on the bounded pool so the event loop stays free
+        with admit(http_request), track_in_flight(INTENT, "query"):
+            result = await run_query(process_query, request.query)
+        observe_query(INTENT, "query", time.perf_counter() - start, result)
         
         # Format the response
         response = {
             "result": result.get("result", ""),
-            "processing_time": result.get("processing_time", 0)
+            "processing_time": result.get("processing_time", 0),
+            "timings": result.get("timings")
         }
         
         # Include source documents if available
@@ -84,9 +121,38 @@ async def query(request: QueryRequest = Body(...)):
         
         return response
     
+    except SchedulerRejected:
+        observe_query(INTENT, "query", time.perf_counter() - start, outcome="rejected")
+        raise
     except Exception as e:
+        observe_query(INTENT, "query", time.perf_counter() - start, outcome="error")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream")
+async def query_stream(http_request: Request, request: QueryRequest = Body(...)):
+    """Stream the answer as NDJSON: sources, then tokens, then a timing record."""
+    if not request.query or not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    try:
+        admission = admit(http_request)
+    except SchedulerRejected:
+        observe_query(INTENT, "stream", 0.0, outcome="rejected")
+        raise
+    
+    async def events():
+        try:
+            async for line in stream_query_events(
+                    lambda: ndjson(observe_events(INTENT, "stream", stream_query(request.query)))):
+                yield line
+        finally:
+            admission.release()
+    
+    # A client that disconnects before the first chunk cancels the response
+    # before events() starts, so its finally never runs; the background task
+    # runs either way (release() is idempotent)
+    return StreamingResponse(events(), media_type="application/x-ndjson",
+                             background=BackgroundTask(admission.release))
+
 @app.post("/upload-documents")
 async def upload_documents(files: List[UploadFile] = File(...)):
     """
@@ -121,43 +187,20 @@ async def upload_documents(files: List[UploadFile] = File(...)):
 @app.post("/ingest", response_model=IngestResponse)
 async def ingest():
     try:
-        from langchain.embeddings import HuggingFaceEmbeddings
-        from langchain.vectorstores import Chroma
-        from constants import CHROMA_SETTINGS
-        
-        # Process documents from your source directory
-        texts = process_documents()
-        if not texts:
-            return {
-                "status": "no_documents",
-                "documents_processed": 0
-            }
-        
-        # Create embeddings using the specified model
-        print("Creating embeddings...")
-        embeddings = HuggingFaceEmbeddings(
-            model_name=os.environ.get("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2")
-        )
+        # Only new or changed files are embedded, in chunks sized in the embedding
+        # model's tokens; stale vectors are removed and the ingest manifest updated
+        chunks_added = await run_in_threadpool(lambda: ingest_incremental(load_embeddings()))
         
-        persist_directory = os.environ.get('PERSIST_DIRECTORY', 'db')
+        # Rebuild the QA chain around the updated vectorstore
+        create_qa_chain()
         
-        # Create the vectorstore with your documents
-        print(f"Creating vector database in {persist_directory}...")
-        db = Chroma.from_documents(
-            documents=texts,
-            embedding=embeddings,
-            persist_directory=persist_directory,
-            client_settings=CHROMA_SETTINGS
-        )
-        
-        # Persist the vectorstore to disk
-        print("Persisting database...")
-        db.persist()
-        print("Database persisted successfully!")
+        # Cached answers may cite documents that have changed
+        if answer_cache is not None:
+            answer_cache.invalidate()
         
         return {
-            "status": "success",
-            "documents_processed": len(texts)
+            "status": "success" if chunks_added else "no_documents",
+            "documents_processed": chunks_added
         }
     
     except Exception as e:
@@ -166,6 +209,19 @@ async def ingest():
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics in the text exposition format."""
+    body = await run_in_threadpool(metrics_registry.render)
+    return Response(content=body, media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 only once the LLM has been warmed up."""
+    if not model_state.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "llm": model_state.to_dict()})
+    return {"ready": True, "llm": model_state.to_dict()}
+
 @app.get("/status")
 async def status():
     persist_directory = os.environ.get('PERSIST_DIRECTORY', 'db')
@@ -176,8 +232,14 @@ async def status():
     
     return {
         "database_initialized": db_initialized,
+        "llm": model_state.to_dict(),
         "model": os.environ.get("MODEL", "mistral"),
-        "embeddings_model": os.environ.get("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2")
+        "embeddings_model": os.environ.get("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2"),
+        "embedding_cache": cache_stats(),
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "query_executor": executor_stats(),
+        "coalescing": coalescing_stats(),
+        "llm_scheduler": scheduler.stats()
     }
 
 if __name__ == "__main__":
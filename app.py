@@ -21,12 +21,13 @@ def generate_response(user_message, history):
             sources += f"\n\n**Source {i}:** *{doc.metadata.get('source','Unknown Source')}*\n{snippet}..."
     
     processing_time = end - start
+    cached = " from cache" if res.get("cached") else ""
     
     # Modified format: Answer first, then hidden sources that can be toggled
     bot_message = (
         f"**Answer:**\n{answer}\n\n"
         f"<sources>{sources}</sources>\n\n"
-        f"*(Processed in {processing_time:.2f} seconds)*"
+        f"*(Processed{cached} in {processing_time:.2f} seconds)*"
     )
     
     history.append((user_message, bot_message))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of the ingest and query path.
+
+Generates a synthetic municipal-code corpus, builds a local vector index from
+it and answers queries with a deterministic fake LLM, so it needs no network,
+Ollama or Pinecone. Each stage is measured separately:
+
+    load            load_single_document          files/s, MB/s
+    split           CodeChunker.split_documents   chunks/s
+    embed           embed_documents               chunks/s
+    index           local index upsert + persist  vectors/s
+    retrieval       search_with_scores            p50/p95 ms
+    process_query   process_query end to end      p50/p95 ms
+
+Results are written as JSON and compared against a stored baseline:
+
+    python benchmark.py                      # run and compare with benchmark_baseline.json
+    python benchmark.py --save-baseline      # run and store the result as the new baseline
+    python benchmark.py --check              # exit 1 if any metric regressed
+
+By default embeddings come from a deterministic hashing model, so numbers
+reflect the pipeline rather than the model; use ``--embeddings model`` to
+benchmark the configured sentence-transformer (it must already be cached).
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import shutil
+import platform
+import statistics
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+# Load environment variables
+baseline_path = os.environ.get('BENCHMARK_BASELINE', 'benchmark_baseline.json')
+results_path = os.environ.get('BENCHMARK_RESULTS', 'benchmark_results.json')
+regression_tolerance = float(os.environ.get('BENCHMARK_TOLERANCE', 0.15))
+
+TOPICS = [
+    "sidewalk maintenance", "snow removal", "refuse collection", "recycling", "water service",
+    "sewer connections", "stormwater management", "fence height", "accessory structures", "deck construction",
+    "swimming pools", "signs", "noise", "parking", "short-term rentals", "home occupations",
+    "tree removal", "demolition", "historic district review", "zoning variances", "building permits",
+    "fire lanes", "outdoor burning", "animal control", "street vacations", "curb cuts",
+]
+TERMS = [
+    "owner", "occupant", "permit", "Borough", "Council", "Zoning Officer", "Code Enforcement Officer",
+    "application", "fee", "inspection", "violation", "notice", "property line", "right-of-way",
+    "resolution", "district", "structure", "setback", "appeal", "penalty",
+]
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings via the hashing trick; no model needed."""
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            h = zlib.crc32(word.encode('utf-8'))
+            vector[h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class FakeLLM(LLM):
+    """Deterministic LLM: answers with the first words of the context, streamed as tokens."""
+
+    answer_words: int = 60
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        context = prompt.split("Context:", 1)[-1]
+        words = context.split()[:self.answer_words]
+        for word in words:
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            if run_manager:
+                run_manager.on_llm_new_token(word + " ")
+        return " ".join(words)
+
+
+def generate_corpus(directory: str, files: int, sections: int, seed: int) -> List[str]:
+    """Write synthetic municipal-code chapters; return query strings about them."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    queries = []
+    for chapter in range(1, files + 1):
+        lines = [f"Chapter {chapter}. {rng.choice(TOPICS).title()}", ""]
+        for part in range(1, max(1, sections // 10) + 1):
+            lines += [f"Part {part}. General Provisions", ""]
+            for number in range(1, 11):
+                topic = rng.choice(TOPICS)
+                lines.append(f"§ {chapter}-{part}{number:02d}. {topic.title()}.")
+                for _ in range(rng.randint(3, 8)):
+                    lines.append(
+                        f"The {rng.choice(TERMS)} shall {rng.choice(['submit', 'maintain', 'obtain', 'review', 'post'])} "
+                        f"a {rng.choice(TERMS)} regarding {topic} within {rng.randint(5, 90)} days of the "
+                        f"{rng.choice(TERMS)}, unless the {rng.choice(TERMS)} grants an extension."
+                    )
+                lines.append("")
+                if rng.random() < 0.05:
+                    queries.append(f"What does the {rng.choice(TERMS)} need to do about {topic}?")
+        with open(os.path.join(directory, f"chapter_{chapter:03d}.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+    while len(queries) < 20:
+        queries.append(f"What are the rules for {rng.choice(TOPICS)}?")
+    return queries
+
+
+def offline_environment(prefix: str = 'rag-benchmark-') -> str:
+    """Point the project modules at a throwaway work directory, offline and uncached.
+
+    Must run before the project modules are imported, since they read their
+    configuration at import time. Returns the work directory.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.environ.setdefault('HF_HUB_OFFLINE', '1')
+    os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+    os.environ['VECTOR_BACKEND'] = 'local'
+    os.environ['ANSWER_CACHE'] = '0'
+    os.environ['QUERY_COALESCING'] = '0'
+    os.environ['SLOW_QUERY_THRESHOLD'] = '0'
+    os.environ['LOCAL_INDEX_DIRECTORY'] = os.path.join(workdir, 'index')
+    os.environ['INGEST_MANIFEST'] = os.path.join(workdir, 'ingest_manifest.json')
+    return workdir
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def timed(fn, repeats: int):
+    """Run fn repeats times; return (median seconds, last result)."""
+    durations, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+
+def latency_metrics(prefix: str, fn, inputs: List[str], rounds: int) -> Dict[str, float]:
+    latencies = []
+    for _ in range(rounds):
+        for item in inputs:
+            start = time.perf_counter()
+            fn(item)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        f"{prefix}.p50_ms": percentile(latencies, 50),
+        f"{prefix}.p95_ms": percentile(latencies, 95),
+        f"{prefix}.mean_ms": statistics.fmean(latencies),
+    }
+
+
+def run_benchmark(args, workdir: str) -> Dict[str, Any]:
+    from pinecone_ingest import load_single_document, build_pinecone_vectors, chunk_size, chunk_overlap
+    from code_chunker import CodeChunker
+    from local_vector_store import LocalVectorIndex, local_index_directory
+    from retrieval_context import RetrievalContext, use_retrieval_context, get_embeddings
+    import pinecone_new_private_gpt as rag
+
+    corpus_dir = os.path.join(workdir, 'corpus')
+    queries = generate_corpus(corpus_dir, args.files, args.sections, args.seed)
+    files = sorted(os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir))
+    corpus_bytes = sum(os.path.getsize(path) for path in files)
+    metrics: Dict[str, float] = {}
+
+    print(f"Corpus: {len(files)} files, {corpus_bytes / 1e6:.2f} MB, {len(queries)} queries")
+
+    seconds, documents = timed(lambda: [doc for path in files for doc in load_single_document(path)], args.repeats)
+    metrics["load.files_per_second"] = len(files) / seconds
+    metrics["load.mb_per_second"] = corpus_bytes / 1e6 / seconds
+
+    # Chunks are sized like ingest sizes them: in the model's tokens when it has a tokenizer
+    embeddings = HashEmbeddings() if args.embeddings == 'hash' else get_embeddings()
+    chunker = CodeChunker.for_embeddings(embeddings, chunk_size, chunk_overlap)
+    seconds, chunks = timed(lambda: chunker.split_documents([doc.copy(deep=True) for doc in documents]), args.repeats)
+    metrics["split.chunks_per_second"] = len(chunks) / seconds
+    texts = [chunk.page_content for chunk in chunks]
+    batch = args.batch_size
+    seconds, vectors = timed(lambda: [v for i in range(0, len(texts), batch)
+                                      for v in embeddings.embed_documents(texts[i:i + batch])], args.repeats)
+    metrics["embed.chunks_per_second"] = len(texts) / seconds
+
+    def build_index():
+        index = LocalVectorIndex(local_index_directory, dimension=len(vectors[0]))
+        ids = [f"chunk-{i}" for i in range(len(chunks))]
+        index.upsert(vectors=build_pinecone_vectors([chunk.copy(deep=True) for chunk in chunks], vectors, ids))
+        index.persist()
+    seconds, _ = timed(build_index, 1)
+    metrics["index.vectors_per_second"] = len(chunks) / seconds
+
+    context = use_retrieval_context(RetrievalContext(backend='local').warm_up(embeddings=embeddings))
+    metrics.update(latency_metrics("retrieval", lambda q: context.search_with_scores(q, k=rag.target_source_chunks),
+                                   queries, args.rounds))
+
+    rag.create_qa_chain(mute_stream=True, llm=FakeLLM(token_latency=args.llm_token_ms / 1000))
+    rag.process_query(queries[0])  # first call builds the prompt machinery
+    metrics.update(latency_metrics("process_query", rag.process_query, queries, args.rounds))
+
+    return {
+        "meta": {
+            "time": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "files": len(files),
+            "corpus_mb": round(corpus_bytes / 1e6, 3),
+            "documents": len(documents),
+            "chunks": len(chunks),
+            "queries": len(queries),
+            "embeddings": args.embeddings,
+            "search_type": os.environ.get('SEARCH_TYPE', 'similarity'),
+            "k": rag.target_source_chunks,
+        },
+        "metrics": {name: round(value, 4) for name, value in metrics.items()},
+    }
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_second")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Print a comparison table and return the metrics that regressed beyond the tolerance."""
+    regressions = []
+    print(f"\n{'metric':32} {'baseline':>12} {'current':>12} {'change':>9}")
+    for metric, value in results["metrics"].items():
+        old = baseline.get("metrics", {}).get(metric)
+        if not old:
+            print(f"{metric:32} {'-':>12} {value:12.3f}")
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better(metric) else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(metric)
+            flag = "  REGRESSION"
+        print(f"{metric:32} {old:12.3f} {value:12.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of loading, splitting, embedding, retrieval and process_query.')
+    parser.add_argument("--files", type=int, default=40, help='Synthetic chapters to generate.')
+    parser.add_argument("--sections", type=int, default=30, help='Sections per chapter.')
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=3, help='Runs per throughput stage (median is reported).')
+    parser.add_argument("--rounds", type=int, default=5, help='Passes over the query set for latency stages.')
+    parser.add_argument("--batch-size", type=int, default=64, help='Chunks per embed_documents call.')
+    parser.add_argument("--embeddings", choices=['hash', 'model'], default='hash')
+    parser.add_argument("--llm-token-ms", type=float, default=0.0, help='Simulated latency per fake LLM token.')
+    parser.add_argument("--output", default=results_path)
+    parser.add_argument("--baseline", default=baseline_path)
+    parser.add_argument("--tolerance", type=float, default=regression_tolerance,
+                        help='Allowed relative slowdown before a metric counts as a regression.')
+    parser.add_argument("--save-baseline", action='store_true', help='Store these results as the baseline.')
+    parser.add_argument("--check", action='store_true', help='Exit with status 1 if any metric regressed.')
+    args = parser.parse_args()
+
+    workdir = offline_environment()
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+    else:
+        for metric, value in results["metrics"].items():
+            print(f"{metric:32} {value:12.3f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
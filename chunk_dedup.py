@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+De-duplication of chunks before they are embedded.
+
+Municipal PDFs repeat the same headers, footers, signature blocks and
+boilerplate on every page, and each repeat would otherwise cost an
+embedding, a vector in the index and a slot in the retrieved context.
+``ChunkDeduplicator.split_documents`` wraps a splitter in three steps:
+
+1. Repeated page headers and footers are stripped. A line near the top or
+   bottom of a page is removed when, with digits ignored (so "Page 3 of
+   40" matches "Page 4 of 40"), it recurs on at least DEDUP_HEADER_RATIO of
+   the pages of its file. Lines longer than a header are never stripped.
+   A repeated Chapter/Part/§ heading is a running head and is kept only
+   where it first appears in the file.
+2. Exact duplicates are dropped by a hash of the whitespace- and
+   case-normalized text.
+3. Near-duplicates are dropped by MinHash over word shingles. Locality
+   sensitive hashing on signature bands finds candidates, and a chunk is
+   dropped when its estimated Jaccard similarity with a kept chunk is at
+   least DEDUP_NEAR_THRESHOLD.
+
+Chunks are only compared with chunks under the same heading path
+(``section_path``), so identical wording in two sections of the code stays
+retrievable, and filterable, in both. Chunk offsets (start_index,
+end_index) refer to the page text after stripping.
+
+Each dropped chunk is recorded against the chunk it duplicates. The
+sources sharing every kept chunk are written to DEDUP_REPORT, and
+``dependencies`` feeds IngestManifest.record_duplicates. A file whose
+chunks were dropped is then re-ingested when the file it depends on
+changes or is deleted.
+"""
+
+import os
+import re
+import json
+import zlib
+import hashlib
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from code_chunker import HEADING_PATTERN
+
+# Load environment variables
+dedup_enabled = os.environ.get('DEDUP', '1').lower() not in ('0', 'false', 'no', 'off')
+near_duplicate_threshold = float(os.environ.get('DEDUP_NEAR_THRESHOLD', 0.9))
+header_ratio = float(os.environ.get('DEDUP_HEADER_RATIO', 0.5))
+dedup_report_path = os.environ.get('DEDUP_REPORT', 'dedup_report.json')
+
+# MinHash signature: BANDS bands of ROWS rows. A pair with Jaccard 0.9 shares
+# at least one band with probability 1 - (1 - 0.9**8)**16 > 0.999
+BANDS = 16
+ROWS = 8
+NUM_PERM = BANDS * ROWS
+SHINGLE_WORDS = 3
+
+# Header/footer detection looks at this many non-empty lines at each end of a
+# page, in files with at least MIN_PAGES pages. Longer lines are body text.
+EDGE_LINES = 3
+MIN_PAGES = 3
+MAX_EDGE_LINE_CHARS = 100
+
+# Bump whenever stripping or duplicate detection changes (see settings)
+DEDUP_VERSION = 1
+
+# Kept chunk text shown in the report
+PREVIEW_CHARS = 120
+
+_WORD = re.compile(r"\w+")
+_DIGITS = re.compile(r"\d+")
+_WHITESPACE = re.compile(r"\s+")
+
+# Multiply-shift hash functions (odd 64-bit multipliers, top 32 bits kept)
+_random = np.random.RandomState(20240601)
+_MULTIPLIERS = (_random.randint(0, 2 ** 63 - 1, size=NUM_PERM, dtype=np.int64).astype(np.uint64) << np.uint64(1)) | np.uint64(1)
+_INCREMENTS = _random.randint(0, 2 ** 63 - 1, size=NUM_PERM, dtype=np.int64).astype(np.uint64)
+_SHINGLE_WEIGHTS = [np.uint64(0x9E3779B1), np.uint64(0x85EBCA77), np.uint64(1)]
+
+
+def _normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def _line_key(line: str) -> str:
+    # Page numbers and dates change from page to page; the rest of the line does
+    # not. A heading's number is what tells it apart, so headings keep theirs.
+    if HEADING_PATTERN.match(line):
+        return _normalize(line)
+    return _DIGITS.sub("#", _normalize(line))
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature (NUM_PERM uint32 values) of the text's word shingles."""
+    words = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in _WORD.findall(text.lower())), dtype=np.uint64)
+    if len(words) == 0:
+        words = np.zeros(1, dtype=np.uint64)
+    if len(words) >= SHINGLE_WORDS:
+        # Combine each run of SHINGLE_WORDS word hashes into one 32-bit shingle hash
+        count = len(words) - SHINGLE_WORDS + 1
+        shingles = sum(words[i:i + count] * weight for i, weight in enumerate(_SHINGLE_WEIGHTS))
+        shingles &= np.uint64(0xFFFFFFFF)
+    else:
+        shingles = words
+    hashes = (np.unique(shingles)[None, :] * _MULTIPLIERS[:, None] + _INCREMENTS[:, None]) >> np.uint64(32)
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+class ChunkDeduplicator:
+    """Strip repeated headers/footers and drop exact and near-duplicate chunks.
+
+    One instance covers one ingest run; chunks are compared with every
+    chunk kept so far in the run.
+
+    Args:
+        threshold: Estimated Jaccard similarity at which a chunk counts as a
+            near-duplicate of a kept one.
+        strip_ratio: Fraction of a file's pages a header/footer line must
+            appear on to be stripped; 0 disables stripping.
+        enabled: When False, ``split_documents`` only splits.
+    """
+
+    def __init__(self, threshold: float = near_duplicate_threshold, strip_ratio: float = header_ratio,
+                 enabled: bool = dedup_enabled):
+        self.threshold = threshold
+        self.strip_ratio = strip_ratio
+        self.enabled = enabled
+        self.stats = {"pages": 0, "lines_stripped": 0, "chars_stripped": 0,
+                      "chunks": 0, "exact_duplicates": 0, "near_duplicates": 0}
+        # Kept chunks: metadata, signature and the sources of their duplicates
+        self._kept: List[Tuple[dict, str, Optional[np.ndarray]]] = []
+        self._shared: Dict[int, Counter] = {}
+        self._exact: Dict[Tuple[str, str], int] = {}
+        self._buckets: Dict[Tuple[str, int, bytes], List[int]] = {}
+        self.dependencies: Dict[str, Set[str]] = {}
+
+    @property
+    def settings(self) -> dict:
+        """Everything that decides which text and chunks are dropped, for the ingest manifest."""
+        if not self.enabled:
+            return {"enabled": False}
+        return {"enabled": True, "version": DEDUP_VERSION, "threshold": self.threshold,
+                "strip_ratio": self.strip_ratio}
+
+    def strip_headers_footers(self, documents: List[Document]) -> List[Document]:
+        """Remove lines repeated at the top or bottom of most pages of a file.
+
+        Consecutive documents with the same source are taken to be the
+        pages of one file.
+        """
+        if self.strip_ratio <= 0:
+            return documents
+        stripped: List[Document] = []
+        start = 0
+        while start < len(documents):
+            source = documents[start].metadata.get("source")
+            end = start + 1
+            while end < len(documents) and documents[end].metadata.get("source") == source:
+                end += 1
+            stripped.extend(self._strip_file(documents[start:end]))
+            start = end
+        return stripped
+
+    def _edges(self, lines: List[str]) -> Tuple[List[int], List[int]]:
+        # Indexes of the short lines among the first and last EDGE_LINES non-empty lines
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        short = lambda indexes: [i for i in indexes if len(lines[i]) <= MAX_EDGE_LINE_CHARS]
+        return short(filled[:EDGE_LINES]), short(filled[-EDGE_LINES:])
+
+    def _strip_file(self, pages: List[Document]) -> List[Document]:
+        self.stats["pages"] += len(pages)
+        if len(pages) < MIN_PAGES:
+            return pages
+        split_pages = [page.page_content.split("\n") for page in pages]
+        top, bottom = Counter(), Counter()
+        for lines in split_pages:
+            head, tail = self._edges(lines)
+            top.update({_line_key(lines[i]) for i in head})
+            bottom.update({_line_key(lines[i]) for i in tail})
+        needed = max(MIN_PAGES, self.strip_ratio * len(pages))
+        repeated_top = {key for key, count in top.items() if count >= needed}
+        repeated_bottom = {key for key, count in bottom.items() if count >= needed}
+        if not repeated_top and not repeated_bottom:
+            return pages
+
+        result = []
+        # A repeated heading is a running head ("CHAPTER 27 ZONING" on every
+        # page); its first occurrence in the file is the heading itself
+        headings_seen = set()
+        for page, lines in zip(pages, split_pages):
+            head, tail = self._edges(lines)
+            drop = {i for i in head if _line_key(lines[i]) in repeated_top}
+            drop |= {i for i in tail if _line_key(lines[i]) in repeated_bottom}
+            for i in sorted(drop):
+                if HEADING_PATTERN.match(lines[i]) and _line_key(lines[i]) not in headings_seen:
+                    headings_seen.add(_line_key(lines[i]))
+                    drop.discard(i)
+            if not drop:
+                result.append(page)
+                continue
+            self.stats["lines_stripped"] += len(drop)
+            self.stats["chars_stripped"] += sum(len(lines[i]) for i in drop)
+            text = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+            result.append(Document.construct(page_content=text, metadata=page.metadata))
+        return result
+
+    def _keep(self, chunk: Document, scope: str, signature: Optional[np.ndarray]) -> int:
+        index = len(self._kept)
+        self._kept.append((chunk.metadata, chunk.page_content[:PREVIEW_CHARS], signature))
+        if signature is not None:
+            for band in range(BANDS):
+                key = (scope, band, signature[band * ROWS:(band + 1) * ROWS].tobytes())
+                self._buckets.setdefault(key, []).append(index)
+        return index
+
+    def _near_duplicate(self, scope: str, signature: np.ndarray) -> Optional[int]:
+        seen = set()
+        for band in range(BANDS):
+            for index in self._buckets.get((scope, band, signature[band * ROWS:(band + 1) * ROWS].tobytes()), ()):
+                if index in seen:
+                    continue
+                seen.add(index)
+                if np.count_nonzero(self._kept[index][2] == signature) >= self.threshold * NUM_PERM:
+                    return index
+        return None
+
+    def _drop(self, chunk: Document, index: int):
+        source = chunk.metadata.get("source", "")
+        self._shared.setdefault(index, Counter())[source] += 1
+        kept_source = self._kept[index][0].get("source", "")
+        if source != kept_source:
+            self.dependencies.setdefault(source, set()).add(kept_source)
+
+    def dedupe(self, chunks: List[Document]) -> List[Document]:
+        """Return the chunks that are neither exact nor near duplicates of a kept chunk."""
+        kept = []
+        for chunk in chunks:
+            self.stats["chunks"] += 1
+            scope = chunk.metadata.get("section_path", "")
+            digest = hashlib.sha1(_normalize(chunk.page_content).encode("utf-8")).hexdigest()
+            index = self._exact.get((scope, digest))
+            if index is not None:
+                self.stats["exact_duplicates"] += 1
+                self._drop(chunk, index)
+                continue
+            signature = minhash(chunk.page_content) if self.threshold < 1 else None
+            index = self._near_duplicate(scope, signature) if signature is not None else None
+            if index is not None:
+                self.stats["near_duplicates"] += 1
+                self._drop(chunk, index)
+                continue
+            self._exact[(scope, digest)] = self._keep(chunk, scope, signature)
+            kept.append(chunk)
+        return kept
+
+    def split_documents(self, documents: List[Document],
+                        split_fn: Callable[[List[Document]], List[Document]]) -> List[Document]:
+        """Strip headers/footers, split with ``split_fn`` and drop duplicate chunks."""
+        if not self.enabled:
+            return split_fn(documents)
+        return self.dedupe(split_fn(self.strip_headers_footers(documents)))
+
+    @property
+    def dropped(self) -> int:
+        return self.stats["exact_duplicates"] + self.stats["near_duplicates"]
+
+    def report(self) -> str:
+        """One-line summary of the embeddings and vectors saved."""
+        if not self.enabled:
+            return "De-duplication disabled (DEDUP=0)"
+        chunks = self.stats["chunks"]
+        share = self.dropped / chunks if chunks else 0.0
+        return (f"De-duplicated {self.dropped} of {chunks} chunks ({share:.1%}): "
+                f"{self.stats['exact_duplicates']} exact, {self.stats['near_duplicates']} near-duplicate; "
+                f"{self.dropped} fewer embeddings and vectors. Stripped {self.stats['lines_stripped']} "
+                f"repeated header/footer lines ({self.stats['chars_stripped']} characters) "
+                f"from {self.stats['pages']} pages")
+
+    def write_report(self, path: str = dedup_report_path):
+        """Write the statistics and, for each kept chunk with duplicates, the sources sharing it."""
+        if not self.enabled or not path:
+            return
+        shared = []
+        for index, sources in sorted(self._shared.items(), key=lambda item: -sum(item[1].values())):
+            metadata, preview, _ = self._kept[index]
+            shared.append({
+                "source": metadata.get("source", ""),
+                "start_index": metadata.get("start_index"),
+                "section_path": metadata.get("section_path", ""),
+                "text": preview,
+                "duplicates": sum(sources.values()),
+                "sources": dict(sources),
+            })
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stats": dict(self.stats, dropped=self.dropped), "shared_chunks": shared}, f, indent=1)
+        os.replace(tmp_path, path)
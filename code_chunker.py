@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Structure-aware chunking of municipal code documents.
+
+One regex pass per document finds every Chapter, Part and § heading, and
+the text between two headings is cut into chunks of at most ``chunk_size``
+characters, breaking at the last newline (or space) before the limit. Every
+chunk carries the heading path it falls under, so a chunk from the middle
+of a long section is still tagged with its Chapter, Part and §:
+
+    chapter          "27"                  (identifiers, for filtering)
+    part             "2"
+    section          "27-201"
+    section_path     "Chapter 27 Zoning > Part 2 Districts > § 27-201. Purpose."
+    section_heading  "§ 27-201. Purpose."  (innermost heading line)
+    start_index      offset of the chunk in the document's text
+    end_index        offset just past the chunk
+
+Levels missing from the path are left out of the metadata, since neither
+Pinecone nor Chroma accepts null values. Consecutive documents from the
+same source (e.g. the pages of a PDF) continue the path of the previous one.
+
+Sizes are in characters unless the chunker is given the embedding model's
+tokenizer (``CodeChunker.for_embeddings``). It then counts tokens, so no chunk
+exceeds the model's window and gets silently truncated when embedded.
+"""
+
+import os
+import re
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain.docstore.document import Document
+
+# Load environment variables
+chunk_tokens = int(os.environ.get('CHUNK_TOKENS', 0))  # 0: the embedding model's whole window
+chunk_overlap_tokens = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 32))
+
+# Hierarchy levels, outermost first
+LEVELS = ("chapter", "part", "section")
+
+# After "Chapter 27" or "Part 2": the end of the line, or a title ("Zoning",
+# ". Zoning", ": ZONING"). A cross-reference wrapped onto the start of a line
+# ("Chapter 5, Code Enforcement", "Part 3 of this Chapter") has neither.
+_TITLE = r"(?=[ \t]*$|[ \t]*[.:\u2013\u2014-][ \t]*[^\sa-z]|[ \t]+[A-Z0-9(\"'])"
+
+# A heading occupies a whole line: "Chapter 27 Zoning", "Part 2A", "§ 27-201. Purpose."
+# A § heading needs a title too, so "§ 27-201 of this Chapter" is body text.
+HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:"
+    r"(?:Chapter|CHAPTER)[ \t]+(?P<chapter>\d+[A-Z]?|[IVXLC]+)\b" + _TITLE +
+    r"|(?:Part|PART)[ \t]+(?P<part>\d+[A-Z]?|[IVXLC]+)\b" + _TITLE +
+    r"|§(?!§)[ \t]*(?P<section>\d+[A-Z]?(?:[-:.]\d+[A-Z]?)*)(?:\.[ \t]+(?=\S)|[ \t]+(?=[A-Z(\"']))"
+    r")[^\n]*",
+    re.MULTILINE
+)
+
+# Section numbers that carry their chapter: "27-201", "27:201"
+_CHAPTER_PREFIX = re.compile(r"^(\d+[A-Z]?)[-:]")
+
+_WHITESPACE = re.compile(r"\s+")
+
+# Heading lines are stored in metadata; cap runaway lines from bad extractions
+MAX_HEADING_CHARS = 200
+
+UNKNOWN_SECTION = "Unknown Section"
+
+# Bump whenever heading detection or splitting changes; the ingest manifest
+# then re-chunks files whose content has not changed
+CHUNKER_VERSION = 1
+
+# The character sizes used before chunks were sized in tokens, for the truncation report
+LEGACY_CHUNK_SIZE = 500
+LEGACY_CHUNK_OVERLAP = 50
+
+
+def iter_sections(text: str, path: Optional[Dict[str, Tuple[str, str]]] = None) -> Iterator[Tuple[int, int, dict]]:
+    """Yield (start, end, path) for the spans between headings, in one pass.
+
+    ``path`` maps each level to its (identifier, heading line) and is
+    updated in place, so passing the same dict for consecutive pages
+    continues the hierarchy across them. Each yielded path is a snapshot.
+    """
+    path = {} if path is None else path
+    start = 0
+    for match in HEADING_PATTERN.finditer(text):
+        if match.lastgroup == "section" and not _in_chapter(match.group("section"), path):
+            continue
+        level = match.lastgroup
+        identifier = match.group(level).rstrip('.:-')
+        # A running head repeats the open heading on every page; it must not
+        # close the Part and § beneath it
+        if path.get(level, ("",))[0] == identifier:
+            continue
+        if match.start() > start:
+            yield start, match.start(), dict(path)
+        # A heading closes every level below it
+        for inner in LEVELS[LEVELS.index(level):]:
+            path.pop(inner, None)
+        path[level] = (identifier, match.group(0).strip()[:MAX_HEADING_CHARS])
+        start = match.start()
+    if start < len(text):
+        yield start, len(text), dict(path)
+
+
+_ROMAN_VALUES = {"I": 1, "V": 5, "X": 10, "L": 50, "C": 100}
+
+
+def _arabic(identifier: str) -> str:
+    """Chapter identifier with Roman numerals converted: "XXVII" -> "27", "27A" unchanged."""
+    if not identifier or any(char not in _ROMAN_VALUES for char in identifier):
+        return identifier
+    values = [_ROMAN_VALUES[char] for char in identifier]
+    # A numeral smaller than the one after it is subtracted (IV, XL)
+    return str(sum(-value if value < following else value
+                   for value, following in zip(values, values[1:] + [0])))
+
+
+def _in_chapter(section: str, path: Dict[str, Tuple[str, str]]) -> bool:
+    # "§ 5-102" inside Chapter 27 (or Chapter XXVII) is a cross-reference, not a heading
+    prefix = _CHAPTER_PREFIX.match(section)
+    return prefix is None or "chapter" not in path or prefix.group(1) == _arabic(path["chapter"][0])
+
+
+def path_metadata(path: Dict[str, Tuple[str, str]]) -> dict:
+    """Chunk metadata for a heading path (see the module docstring)."""
+    metadata = {}
+    lines = []
+    for level in LEVELS:
+        if level in path:
+            identifier, line = path[level]
+            metadata[level] = identifier
+            lines.append(line)
+    if lines:
+        metadata["section_path"] = " > ".join(lines)
+        metadata["section_heading"] = lines[-1]
+    else:
+        metadata["section_heading"] = UNKNOWN_SECTION
+    return metadata
+
+
+def chapter_filter(chapter) -> dict:
+    """Metadata filter restricting retrieval to one chapter ("27" or "Chapter 27")."""
+    chapter = re.sub(r"(?i)^\s*chapter\s+", "", str(chapter)).strip().rstrip('.')
+    return {"chapter": {"$eq": chapter}}
+
+
+def embedding_tokenizer(embeddings) -> Tuple[Optional[object], Optional[int]]:
+    """The tokenizer of the sentence-transformers model behind embeddings, and its window.
+
+    Looks through wrappers (CachedEmbeddings, HuggingFaceEmbeddings,
+    CustomHuggingFaceEmbeddings). The window is the model's max_seq_length
+    less the special tokens it adds. Returns (None, None) if there is no such model.
+    """
+    candidates = [embeddings]
+    for _ in range(4):
+        for candidate in candidates:
+            if hasattr(candidate, "tokenizer") and hasattr(candidate, "max_seq_length"):
+                tokenizer = candidate.tokenizer
+                return tokenizer, candidate.max_seq_length - tokenizer.num_special_tokens_to_add(pair=False)
+        candidates = [getattr(candidate, attribute) for candidate in candidates
+                      for attribute in ("embeddings", "model", "client") if getattr(candidate, attribute, None) is not None]
+    return None, None
+
+
+class CodeChunker:
+    """Split documents at Chapter/Part/§ boundaries into bounded chunks.
+
+    Args:
+        chunk_size: Maximum characters (or tokens) per chunk.
+        chunk_overlap: Characters (or tokens) repeated at the start of the
+            next chunk when a section is longer than one chunk. Chunks never
+            overlap across headings.
+        tokenizer: A HuggingFace fast tokenizer; sizes then count its tokens.
+        window: The embedding model's token window. In token mode, ``stats``
+            counts how many chunks of the old 500-character splitter would
+            have exceeded it.
+    """
+
+    def __init__(self, chunk_size: int = 500, chunk_overlap: int = 50, tokenizer=None, window: Optional[int] = None):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
+        self.window = window
+        self.unit = "tokens" if tokenizer is not None else "characters"
+        self.stats = {"chunks": 0, "legacy_chunks": 0, "legacy_truncated": 0, "legacy_truncated_tokens": 0}
+        self._legacy = CodeChunker(LEGACY_CHUNK_SIZE, LEGACY_CHUNK_OVERLAP) if tokenizer is not None and window else None
+
+    @classmethod
+    def for_embeddings(cls, embeddings, chunk_size: int = 500, chunk_overlap: int = 50) -> "CodeChunker":
+        """A chunker sized in the embedding model's tokens (CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS).
+
+        Falls back to ``chunk_size``/``chunk_overlap`` characters when the
+        model's tokenizer is not available.
+        """
+        tokenizer, window = embedding_tokenizer(embeddings)
+        if tokenizer is None or not getattr(tokenizer, "is_fast", False):
+            print(f"No fast tokenizer found for the embedding model; chunking by {chunk_size} characters")
+            return cls(chunk_size, chunk_overlap)
+        size = min(chunk_tokens, window) if chunk_tokens > 0 else window
+        print(f"Chunking by embedding model tokens: up to {size} per chunk (window {window}), "
+              f"overlap {chunk_overlap_tokens}")
+        return cls(size, chunk_overlap_tokens, tokenizer=tokenizer, window=window)
+
+    @property
+    def settings(self) -> dict:
+        """Everything that decides where chunks fall, for the ingest manifest."""
+        return {
+            "version": CHUNKER_VERSION,
+            "unit": self.unit,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "tokenizer": getattr(self.tokenizer, "name_or_path", None),
+        }
+
+    def _token_starts(self, texts: List[str]) -> List[List[int]]:
+        """Character offset of every token in each text, tokenizing all texts in one batch."""
+        encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+        return [[start for start, end in offsets if end > start] for offsets in encoded["offset_mapping"]]
+
+    def _pieces(self, text: str, start: int, end: int, starts: Sequence[int]) -> Iterator[Tuple[int, int]]:
+        """Yield (start, end) of the chunks covering text[start:end], whitespace trimmed.
+
+        ``starts`` holds the offset of each unit (character or token) in
+        text, so a chunk of n units ends before ``starts[i + n]``.
+        """
+        size = self.chunk_size
+        # In character mode offsets are indexes; skip the bisection
+        chars = isinstance(starts, range)
+        pos = start
+        while pos < end:
+            while pos < end and text[pos].isspace():
+                pos += 1
+            if pos >= end:
+                return
+            first = pos if chars else bisect_left(starts, pos)
+            if first + size >= len(starts) or starts[first + size] >= end:
+                cut = end
+            else:
+                # Break at a line, else a word, in the second half of the window
+                limit = starts[first + size]
+                floor = starts[first + size // 2]
+                cut = text.rfind("\n", floor, limit)
+                if cut == -1:
+                    cut = text.rfind(" ", floor, limit)
+                if cut == -1:
+                    cut = limit
+            piece_end = cut
+            while piece_end > pos and text[piece_end - 1].isspace():
+                piece_end -= 1
+            yield pos, piece_end
+            if cut >= end:
+                return
+            if self.chunk_overlap:
+                # Start the next chunk on a word boundary inside the overlap
+                resume = starts[max((cut if chars else bisect_left(starts, cut)) - self.chunk_overlap, first + 1)]
+                space = _WHITESPACE.search(text, resume, cut)
+                pos = space.end() if space else cut
+            else:
+                pos = cut
+
+    def split_text(self, text: str, path: Optional[dict] = None,
+                   starts: Optional[Sequence[int]] = None) -> Iterator[Tuple[int, int, dict]]:
+        """Yield (start, end, metadata) for each chunk of text.
+
+        ``starts`` are the token offsets in token mode (see _token_starts).
+        A heading with no text of its own before the next heading (e.g. a
+        Chapter title followed directly by its first Part) is kept at the
+        start of the following chunk rather than emitted on its own.
+        """
+        starts = range(len(text)) if starts is None else starts
+        pending = None
+        for start, end, section_path in iter_sections(text, path):
+            match = HEADING_PATTERN.match(text, start)
+            body = match.end() if match is not None else start
+            if pending is not None:
+                start = pending
+            if end < len(text) and not text[body:end].strip():
+                pending = start
+                continue
+            pending = None
+            metadata = path_metadata(section_path)
+            for piece_start, piece_end in self._pieces(text, start, end, starts):
+                yield piece_start, piece_end, metadata
+
+    def _count_legacy(self, text: str, path: dict, starts: List[int]):
+        # Token counts of the 500-character chunks follow from the token offsets
+        for start, end, _ in self._legacy.split_text(text, path):
+            tokens = bisect_left(starts, end) - bisect_left(starts, start)
+            self.stats["legacy_chunks"] += 1
+            if tokens > self.window:
+                self.stats["legacy_truncated"] += 1
+                self.stats["legacy_truncated_tokens"] += tokens - self.window
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        """Split documents into chunks carrying their heading path and offsets."""
+        chunks = []
+        path: dict = {}
+        legacy_path: dict = {}
+        source = None
+        token_starts = (self._token_starts([document.page_content for document in documents])
+                        if self.tokenizer is not None and documents else [None] * len(documents))
+        for document, starts in zip(documents, token_starts):
+            if document.metadata.get("source") != source:
+                source = document.metadata.get("source")
+                path, legacy_path = {}, {}
+            text = document.page_content
+            for start, end, metadata in self.split_text(text, path, starts):
+                # The fields are built here; skipping pydantic validation halves the split time
+                chunks.append(Document.construct(
+                    page_content=text[start:end],
+                    metadata={**document.metadata, **metadata, "start_index": start, "end_index": end}
+                ))
+            if self._legacy is not None:
+                self._count_legacy(text, legacy_path, starts)
+        self.stats["chunks"] += len(chunks)
+        return chunks
+
+    def report(self) -> str:
+        """One-line summary of the chunks produced, with the legacy truncation count in token mode."""
+        line = f"Split into {self.stats['chunks']} chunks of at most {self.chunk_size} {self.unit}"
+        if self._legacy is not None and self.stats["legacy_chunks"]:
+            truncated = self.stats["legacy_truncated"]
+            line += (f"; the old {LEGACY_CHUNK_SIZE}-character chunks ({self.stats['legacy_chunks']}) would have had "
+                     f"{truncated} ({truncated / self.stats['legacy_chunks']:.1%}) truncated at the "
+                     f"{self.window}-token window, losing {self.stats['legacy_truncated_tokens']} tokens")
+        return line
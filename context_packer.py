@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Context packing between retrieval and the LLM.
+
+Prompt evaluation dominates Ollama latency, so only the context that is
+likely to help is sent: chunks below a relevance cutoff or after a sharp
+drop in score are dropped, overlapping and near-duplicate text is removed,
+and the rest is trimmed to a token budget counted with the LLM's tokenizer.
+"""
+
+import os
+import math
+import threading
+from typing import List, Optional, Tuple
+
+from langchain.schema import Document
+
+# Load environment variables
+score_cutoff = float(os.environ.get('CONTEXT_SCORE_CUTOFF', 0.2))
+score_gap = float(os.environ.get('CONTEXT_SCORE_GAP', 0.15))
+token_budget = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500))
+duplicate_threshold = float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.8))
+# HuggingFace tokenizer matching MODEL (a repo id or local path); when unset,
+# token counts are estimated from text length
+tokenizer_name = os.environ.get('CONTEXT_TOKENIZER', '')
+
+# Chunks shorter than this are not worth truncating into the remaining budget
+MIN_TRUNCATED_TOKENS = 48
+# Splitter overlap between neighbouring chunks is at most a few hundred characters
+MAX_OVERLAP_CHARS = 300
+MIN_OVERLAP_CHARS = 20
+SHINGLE_WORDS = 5
+
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """Load the LLM's HuggingFace tokenizer once, or return None if unavailable.
+
+    The API server calls this at startup, so the first query does not pay
+    for the download.
+    """
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                if tokenizer_name:
+                    try:
+                        from transformers import AutoTokenizer
+                        _tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                    except Exception as e:
+                        print(f"Could not load tokenizer '{tokenizer_name}' ({e}); estimating token counts")
+                _tokenizer_loaded = True
+    return _tokenizer
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    """Token counts for several texts, tokenized in one batch."""
+    if not texts:
+        return []
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # Roughly 3.5 characters per token for English prose; errs on the high side
+        return [math.ceil(len(text) / 3.5) for text in texts]
+    encoded = tokenizer(list(texts), add_special_tokens=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens tokens."""
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[:int(max_tokens * 3.5)]
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"][:max_tokens]
+    return tokenizer.decode(ids)
+
+
+def strip_overlap(previous: str, text: str) -> str:
+    """Remove the start of text that repeats the end of previous."""
+    longest = min(len(previous), len(text), MAX_OVERLAP_CHARS)
+    for length in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(text[:length]):
+            return text[length:].lstrip()
+    return text
+
+
+def shingles(text: str) -> set:
+    words = text.lower().split()
+    if len(words) <= SHINGLE_WORDS:
+        return {hash(' '.join(words))} if words else set()
+    return {hash(' '.join(words[i:i + SHINGLE_WORDS])) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+class PackedContext:
+    """The documents to send to the LLM and what packing did to get them."""
+
+    def __init__(self):
+        self.documents: List[Document] = []
+        self.scores: List[float] = []
+        self.tokens = 0
+        self.retrieved = 0
+        self.dropped_low_score = 0
+        self.dropped_duplicate = 0
+        self.dropped_budget = 0
+        self.truncated = 0
+        self.prompt_tokens: Optional[int] = None
+        self.prompt_chars: Optional[int] = None
+
+    def stats(self) -> dict:
+        return {
+            "retrieved_chunks": self.retrieved,
+            "packed_chunks": len(self.documents),
+            "context_tokens": self.tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_chars": self.prompt_chars,
+            "dropped_low_score": self.dropped_low_score,
+            "dropped_duplicate": self.dropped_duplicate,
+            "dropped_budget": self.dropped_budget,
+            "truncated": self.truncated,
+        }
+
+
+def pack_context(docs_with_scores: List[Tuple[Document, float]], budget: int = None,
+                 cutoff: float = None, gap: float = None) -> PackedContext:
+    """Select, de-duplicate and trim retrieved chunks to fit the token budget.
+
+    Args:
+        docs_with_scores: (document, similarity) pairs from the vector store.
+        budget: Maximum context tokens (CONTEXT_TOKEN_BUDGET).
+        cutoff: Minimum similarity (CONTEXT_SCORE_CUTOFF).
+        gap: Stop at the first drop in similarity larger than this (CONTEXT_SCORE_GAP).
+    """
+    budget = token_budget if budget is None else budget
+    cutoff = score_cutoff if cutoff is None else cutoff
+    gap = score_gap if gap is None else gap
+
+    packed = PackedContext()
+    packed.retrieved = len(docs_with_scores)
+    ranked = sorted(docs_with_scores, key=lambda pair: pair[1], reverse=True)
+
+    # 1. Relevance: drop weak matches and everything after a sharp drop
+    relevant = []
+    for doc, score in ranked:
+        if score < cutoff or (relevant and gap > 0 and relevant[-1][1] - score > gap):
+            break
+        relevant.append((doc, score))
+    packed.dropped_low_score = len(ranked) - len(relevant)
+
+    # 2. Overlap: strip text repeated from a kept chunk of the same source,
+    #    and drop chunks that are mostly contained in what is already kept
+    candidates = []
+    kept_shingles: set = set()
+    kept_by_source = {}
+    for doc, score in relevant:
+        source = doc.metadata.get("source")
+        text = doc.page_content
+        for previous in kept_by_source.get(source, []):
+            text = strip_overlap(previous, text)
+        doc_shingles = shingles(text)
+        if not doc_shingles or len(doc_shingles & kept_shingles) >= duplicate_threshold * len(doc_shingles):
+            packed.dropped_duplicate += 1
+            continue
+        kept_shingles |= doc_shingles
+        kept_by_source.setdefault(source, []).append(doc.page_content)
+        candidates.append((Document(page_content=text, metadata=dict(doc.metadata)), score))
+
+    # 3. Budget: count all candidates in one tokenizer batch, then fill greedily
+    counts = count_tokens([doc.page_content for doc, _ in candidates])
+    for (doc, score), tokens in zip(candidates, counts):
+        remaining = budget - packed.tokens
+        if tokens > remaining:
+            if remaining < MIN_TRUNCATED_TOKENS:
+                packed.dropped_budget += 1
+                continue
+            doc.page_content = truncate_to_tokens(doc.page_content, remaining)
+            tokens = count_tokens([doc.page_content])[0]
+            packed.truncated += 1
+        packed.documents.append(doc)
+        packed.scores.append(score)
+        packed.tokens += tokens
+    return packed
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Persistent embedding cache keyed by model name and normalized text.
+
+Vectors live in a fixed-capacity float32 memory-mapped file, one row per
+entry, so cached embeddings cost 4 bytes per dimension on disk and are never
+re-serialized. A small side index (``.index.npz``) maps text hashes to rows
+and records when each row was last used; when the cache is full the least
+recently used rows are evicted.
+
+Several processes (API servers, ingest) can share one cache directory.
+Reads take a shared lock on ``.lock`` and writes an exclusive one. Each
+write batch appends its row assignments to a small journal (``.journal``)
+before releasing the lock, and both reads and writes first replay what
+other processes have appended. The journal is compacted into the side index
+once it holds JOURNAL_MAX_RECORDS records and when a process exits, so a
+cache miss on the query path costs an append, not an index rewrite. Queries
+and documents are cached under different keys, since some models embed them
+differently.
+"""
+
+import os
+import re
+import atexit
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# Load environment variables
+cache_enabled = os.environ.get('EMBEDDING_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+cache_directory = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+cache_max_entries = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 100000))
+
+
+# Journal record: a row now holds key (b'' once evicted), last used at last_used
+_JOURNAL_RECORD = np.dtype([('key', 'S32'), ('row', '<i8'), ('last_used', '<i8')])
+# Records appended before the journal is compacted into the side index
+JOURNAL_MAX_RECORDS = 4096
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different texts share a cache entry."""
+    return ' '.join(text.split())
+
+
+class EmbeddingCache:
+    """Disk-backed, size-bounded LRU cache of embedding vectors."""
+
+    def __init__(self, model_name: str, directory: str = cache_directory, max_entries: int = cache_max_entries):
+        self.model_name = model_name
+        self.capacity = max_entries
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        self._vectors_path = os.path.join(directory, f"{slug}.vectors")
+        self._index_path = os.path.join(directory, f"{slug}.index.npz")
+        self._lock_path = os.path.join(directory, f"{slug}.lock")
+        self._journal_path = os.path.join(directory, f"{slug}.journal")
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._rows: Dict[bytes, int] = {}
+        self._keys = np.zeros(self.capacity, dtype='S32')
+        self._last_used = np.zeros(self.capacity, dtype=np.int64)
+        self._free: List[int] = []
+        self._count = 0
+        self._clock = 0
+        self._vectors = None
+        self.dim = None
+        self._dirty = False
+        self._index_version = None
+        self._journal_offset = 0
+        self._changed: List[int] = []
+        self.hits = 0
+        self.misses = 0
+
+        with self._lock, self._file_lock(exclusive=False):
+            self._load()
+        atexit.register(self.flush)
+
+    def key(self, text: str, kind: str = "document") -> bytes:
+        # Document keys are unchanged from before queries got their own
+        prefix = "" if kind == "document" else f"{kind}\0"
+        digest = hashlib.sha256(f"{self.model_name}\0{prefix}{normalize_text(text)}".encode('utf-8'))
+        return digest.hexdigest()[:32].encode('ascii')
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _index_stat(self):
+        try:
+            stat = os.stat(self._index_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        # Pick up what other processes compacted or appended since this one last looked
+        version = self._index_stat()
+        if version is not None and version != self._index_version:
+            self._load()
+        elif self._vectors is not None:
+            self._replay()
+
+    def _replay(self):
+        """Apply journal records appended since the last replay."""
+        try:
+            size = os.path.getsize(self._journal_path)
+        except FileNotFoundError:
+            return
+        usable = (size - self._journal_offset) // _JOURNAL_RECORD.itemsize * _JOURNAL_RECORD.itemsize
+        if usable <= 0:
+            return
+        with open(self._journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            records = np.frombuffer(f.read(usable), dtype=_JOURNAL_RECORD)
+        self._journal_offset += usable
+        for key, row, last_used in zip(records['key'], records['row'].tolist(), records['last_used'].tolist()):
+            previous = bytes(self._keys[row])
+            if previous and self._rows.get(previous) == row:
+                del self._rows[previous]
+            self._keys[row] = key
+            if key:
+                self._rows[bytes(key)] = row
+            self._last_used[row] = max(int(self._last_used[row]), last_used)
+            self._count = max(self._count, row + 1)
+        self._free = np.flatnonzero(self._keys[:self._count] == b'').tolist()
+        self._clock = max(self._clock, int(records['last_used'].max()))
+
+    def _append_journal(self):
+        # Callers hold the exclusive file lock and have replayed the journal
+        rows = sorted(set(self._changed))
+        self._changed = []
+        if not rows:
+            return
+        records = np.zeros(len(rows), dtype=_JOURNAL_RECORD)
+        records['key'] = self._keys[rows]
+        records['row'] = rows
+        records['last_used'] = self._last_used[rows]
+        with open(self._journal_path, 'ab') as f:
+            f.write(records.tobytes())
+        self._journal_offset += records.nbytes
+
+    def _open_vectors(self, dim: int, mode: str):
+        self.dim = dim
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=(self.capacity, dim))
+
+    def _load(self):
+        """Read the row index, keeping the recency of rows used since the last flush."""
+        version = self._index_stat()
+        if version is None or not os.path.exists(self._vectors_path):
+            return
+        try:
+            with np.load(self._index_path) as data:
+                keys = data['keys'].astype('S32')
+                last_used = data['last_used'].astype(np.int64)
+                dim = int(data['dim'])
+                count = int(data['count'])
+            if len(keys) != self.capacity:
+                print(f"Embedding cache capacity changed; starting a new cache at {self._vectors_path}")
+                return
+            if self._vectors is None or self.dim != dim:
+                self._open_vectors(dim, 'r+')
+        except Exception as e:
+            print(f"Ignoring unreadable embedding cache {self._index_path}: {e}")
+            return
+
+        self._last_used = np.where(keys == self._keys, np.maximum(last_used, self._last_used), last_used)
+        self._keys = keys
+        self._count = count
+        self._rows = {}
+        self._free = []
+        for row in range(count):
+            key = bytes(self._keys[row])
+            if key:
+                self._rows[key] = row
+            else:
+                self._free.append(row)
+        self._clock = max(self._clock, int(self._last_used[:count].max()) if count else 0)
+        self._index_version = version
+        self._journal_offset = 0
+        self._replay()
+
+    def _allocate_row(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._count < self.capacity:
+            row = self._count
+            self._count += 1
+            return row
+        # Full: evict the least recently used ~5% in one pass
+        self._evict(max(1, self.capacity // 20))
+        return self._free.pop()
+
+    def _evict(self, n: int):
+        n = min(n, self._count)
+        victims = np.argpartition(self._last_used[:self._count], n - 1)[:n]
+        for row in victims:
+            self._rows.pop(bytes(self._keys[row]), None)
+            self._keys[row] = b''
+            self._free.append(int(row))
+            self._changed.append(int(row))
+
+    def get_many(self, texts: List[str], kind: str = "document") -> List[Optional[np.ndarray]]:
+        """Return cached vectors (or None for misses), in input order."""
+        keys = [self.key(text, kind) for text in texts]
+        results: List[Optional[np.ndarray]] = []
+        with self._lock, self._file_lock(exclusive=False):
+            self._refresh()
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self.hits += 1
+                self._clock += 1
+                self._last_used[row] = self._clock
+                results.append(np.array(self._vectors[row]))
+            if any(result is not None for result in results):
+                self._dirty = True
+        return results
+
+    def put_many(self, texts: List[str], vectors, kind: str = "document") -> None:
+        """Store vectors for the given texts, journaling them for other processes."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) == 0:
+            return
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            if self._vectors is None:
+                self._open_vectors(vectors.shape[1], 'w+')
+            if vectors.shape[1] != self.dim:
+                return
+            for text, vector in zip(texts, vectors):
+                key = self.key(text, kind)
+                row = self._rows.get(key)
+                if row is None:
+                    row = self._allocate_row()
+                    self._vectors[row] = vector
+                    self._keys[row] = key
+                    self._rows[key] = row
+                    self._changed.append(row)
+                self._clock += 1
+                self._last_used[row] = self._clock
+            self._dirty = True
+            # Other processes only see the rows once they are on disk: the
+            # first batch writes the index (it records the dimension), later
+            # ones append to the journal until it is due for compaction
+            if self._index_version is None or self._journal_offset >= JOURNAL_MAX_RECORDS * _JOURNAL_RECORD.itemsize:
+                self._save()
+            else:
+                self._append_journal()
+
+    def flush(self):
+        """Compact the journal into the row index; called at exit."""
+        with self._lock:
+            if not self._dirty or self._vectors is None:
+                return
+            with self._file_lock(exclusive=True):
+                self._refresh()
+                self._save()
+
+    def _save(self):
+        # Callers hold the exclusive file lock
+        self._vectors.flush()
+        tmp_path = self._index_path + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, keys=self._keys, last_used=self._last_used,
+                 dim=np.int64(self.dim), count=np.int64(self._count))
+        os.replace(tmp_path, self._index_path)
+        # The index now includes every journaled row
+        open(self._journal_path, 'wb').close()
+        self._journal_offset = 0
+        self._changed = []
+        self._index_version = self._index_stat()
+        self._dirty = False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "entries": len(self._rows),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str) -> Optional[EmbeddingCache]:
+    """Return the shared cache for a model, or None when caching is disabled."""
+    if not cache_enabled:
+        return None
+    with _caches_lock:
+        if model_name not in _caches:
+            _caches[model_name] = EmbeddingCache(model_name)
+        return _caches[model_name]
+
+
+def cache_stats() -> List[dict]:
+    """Hit/miss statistics for every cache opened in this process."""
+    return [cache.stats() for cache in _caches.values()]
+
+
+def embed_with_cache(cache: Optional[EmbeddingCache], texts: List[str],
+                     embed_fn: Callable[[List[str]], list], kind: str = "document") -> List[np.ndarray]:
+    """Embed texts, computing only the ones missing from the cache.
+
+    ``kind`` is "document" or "query"; the two are cached separately.
+    """
+    if cache is None:
+        return [np.asarray(vector) for vector in embed_fn(texts)]
+
+    results = cache.get_many(texts, kind)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        computed = np.asarray(embed_fn(missing_texts), dtype=np.float32)
+        cache.put_many(missing_texts, computed, kind)
+        for i, vector in zip(missing, computed):
+            results[i] = vector
+    return results
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrap any LangChain Embeddings (e.g. HuggingFaceEmbeddings) with the disk cache."""
+
+    def __init__(self, embeddings: Embeddings, model_name: str):
+        self.embeddings = embeddings
+        self.cache = get_embedding_cache(model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in embed_with_cache(self.cache, list(texts), self.embeddings.embed_documents)]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several queries at once (for BatchedQueryEmbeddings), cached as queries.
+
+        Missing queries are encoded in one embed_documents call, which equals
+        embed_query for the symmetric sentence-transformer models used here.
+        """
+        if len(texts) == 1:
+            embed_fn = lambda missing: [self.embeddings.embed_query(missing[0])]
+        else:
+            embed_fn = self.embeddings.embed_documents
+        return [vector.tolist() for vector in embed_with_cache(self.cache, list(texts), embed_fn, "query")]
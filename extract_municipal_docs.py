@@ -1,34 +1,47 @@
-import fitz  # PyMuPDF
 import os
 import glob
+from multiprocessing import Pool
 
-# Folder containing the PDF documents
-pdf_folder = "/Users/heysilas/Downloads/phoenixville info"
+# Pages come from the same cache as ingestion, so already-ingested PDFs are not re-parsed
+from pdf_extract import PageRange, extract_pages, load_page_range, plan_load_tasks
 
-# Find all PDF files in the folder
-pdf_files = glob.glob(os.path.join(pdf_folder, "*.pdf"))
+# Folder containing the PDF documents
+pdf_folder = os.environ.get('PDF_FOLDER', "/Users/heysilas/Downloads/phoenixville info")
 
 # Name of the output text file (adjust as needed)
 output_file = "municipal_docs.txt"
 
-combined_text = ""
 
-# Process each PDF file
-for pdf_file in pdf_files:
-    print(f"Processing: {pdf_file}")
-    try:
-        doc = fitz.open(pdf_file)  # This should work if PyMuPDF is installed correctly.
-    except Exception as e:
-        print(f"Error opening {pdf_file}: {e}")
-        continue
+def extract_task(task):
+    # plan_load_tasks falls back to the bare path when it cannot read the PDF
+    return load_page_range(task) if isinstance(task, PageRange) else extract_pages(task)
+
+
+def main():
+    # Find all PDF files in the folder
+    pdf_files = glob.glob(os.path.join(pdf_folder, "*.pdf"))
+
+    combined_text = ""
+
+    # Process each PDF file, large ones in page ranges across the pool
+    with Pool(processes=os.cpu_count()) as pool:
+        for pdf_file in pdf_files:
+            print(f"Processing: {pdf_file}")
+            try:
+                pages = [page for part in pool.map(extract_task, plan_load_tasks(pdf_file)) for page in part]
+            except Exception as e:
+                print(f"Error opening {pdf_file}: {e}")
+                continue
+
+            combined_text += f"\n\n===== {os.path.basename(pdf_file)} =====\n\n"
+            combined_text += "".join(page.page_content for page in pages)
+
+    # Write the combined text to the output file
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(combined_text)
 
-    combined_text += f"\n\n===== {os.path.basename(pdf_file)} =====\n\n"
-    for page in doc:
-        combined_text += page.get_text()
-    doc.close()
+    print(f"All PDF content has been combined into {output_file}.")
 
-# Write the combined text to the output file
-with open(output_file, "w", encoding="utf-8") as f:
-    f.write(combined_text)
 
-print(f"All PDF content has been combined into {output_file}.")
+if __name__ == "__main__":
+    main()
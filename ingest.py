@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 import os
 import glob
+import threading
+from contextlib import contextmanager
 from typing import List
-from multiprocessing import Pool
-from tqdm import tqdm
 
 from langchain.document_loaders import (
     CSVLoader,
     EverNoteLoader,
-    PyMuPDFLoader,
     TextLoader,
     UnstructuredEmailLoader,
     UnstructuredEPubLoader,
@@ -19,18 +18,27 @@ from langchain.document_loaders import (
     UnstructuredWordDocumentLoader,
 )
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import Chroma
 from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.docstore.document import Document
 from constants import CHROMA_SETTINGS
+from ingest_manifest import IngestManifest
+from ingest_pipeline import IngestPipeline
+from loader_pool import load_files
+from code_chunker import CodeChunker
+from chunk_dedup import ChunkDeduplicator
+from pdf_extract import CachedPDFLoader, PageRange, load_page_range, plan_load_tasks
+from embedding_cache import CachedEmbeddings, cache_stats
 
 # Load environment variables
 persist_directory = os.environ.get('PERSIST_DIRECTORY', 'db')
 source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')
 embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME', 'all-MiniLM-L6-v2')
+manifest_path = os.environ.get('INGEST_MANIFEST', os.path.join(persist_directory, 'ingest_manifest.json'))
 chunk_size = 500
 chunk_overlap = 50
+code_chunker = CodeChunker(chunk_size, chunk_overlap)
 
 # Custom document loader for emails
 class MyElmLoader(UnstructuredEmailLoader):
@@ -60,7 +68,7 @@ LOADER_MAPPING = {
     ".html": (UnstructuredHTMLLoader, {}),
     ".md": (UnstructuredMarkdownLoader, {}),
     ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
+    ".pdf": (CachedPDFLoader, {}),
     ".ppt": (UnstructuredPowerPointLoader, {}),
     ".pptx": (UnstructuredPowerPointLoader, {}),
     ".txt": (TextLoader, {"encoding": "utf8"}),
@@ -74,58 +82,83 @@ def load_single_document(file_path: str) -> List[Document]:
         return loader.load()
     raise ValueError(f"Unsupported file extension '{ext}'")
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+def load_task(task) -> List[Document]:
+    """Load a file, or a page range of a PDF (see pdf_extract.plan_load_tasks)"""
+    if isinstance(task, PageRange):
+        return load_page_range(task)
+    return load_single_document(task)
+
+def list_source_files(source_dir: str) -> List[str]:
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True))
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                results.extend(docs)
-                pbar.update()
-    return results
-
-# Custom separators to capture municipal code structure
-custom_separators = [
-    "\nChapter ",   # Separate by chapter headings
-    "\nPart ",      # Separate by parts within chapters
-    "\n§ ",         # Separate by section symbol (common in codes)
-    "\n"           # Fallback: newline
-]
-
-def extract_heading(text: str) -> str:
-    # Look for common code markers in the first few lines
-    for line in text.split("\n"):
-        stripped = line.strip()
-        if stripped.startswith("Chapter") or stripped.startswith("Part") or stripped.startswith("§"):
-            return stripped
-    return "Unknown Section"
-
-def process_documents(ignored_files: List[str] = []) -> List[Document]:
+    return all_files
+
+def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+    ignored = set(ignored_files)
+    filtered_files = [file_path for file_path in list_source_files(source_dir) if file_path not in ignored]
+    # Largest files first on the shared loader pool; files that fail are quarantined
+    return load_files(load_task, filtered_files, plan_fn=plan_load_tasks)
+
+def split_documents(documents: List[Document], chunker: CodeChunker = code_chunker) -> List[Document]:
+    # Chunks follow Chapter/Part/§ boundaries and carry their heading path
+    return chunker.split_documents(documents)
+
+def load_embeddings():
+    return CachedEmbeddings(HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name)
+
+def process_documents(ignored_files: List[str] = [], embeddings=None) -> List[Document]:
     print(f"Loading documents from {source_directory}")
     documents = load_documents(source_directory, ignored_files)
     if not documents:
         print("No new documents to load")
         exit(0)
     print(f"Loaded {len(documents)} new documents from {source_directory}")
-    # Use our custom separators in the text splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, 
-        chunk_overlap=chunk_overlap,
-        separators=custom_separators
-    )
-    texts = text_splitter.split_documents(documents)
-    # Attach metadata to each chunk
-    for chunk in texts:
-        heading = extract_heading(chunk.page_content)
-        if not chunk.metadata:
-            chunk.metadata = {}
-        chunk.metadata["section_heading"] = heading
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} tokens each)")
+    # Chunks are sized in the embedding model's tokens, so none is truncated when embedded
+    chunker = CodeChunker.for_embeddings(embeddings or load_embeddings(), chunk_size, chunk_overlap)
+    # Repeated headers/footers are stripped and duplicate chunks dropped before embedding
+    deduplicator = ChunkDeduplicator()
+    texts = deduplicator.split_documents(documents, lambda docs: split_documents(docs, chunker))
+    print(f"Split into {len(texts)} chunks of text (max. {chunker.chunk_size} {chunker.unit} each)")
+    print(deduplicator.report())
+    deduplicator.write_report()
     return texts
 
+class PrecomputedEmbeddings(Embeddings):
+    """Embeddings wrapper that lets Chroma.add_texts store vectors computed earlier.
+
+    Inside ``use(texts, vectors)`` a matching embed_documents call returns the
+    given vectors; every other call goes to the wrapped embeddings.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self._local = threading.local()
+
+    @contextmanager
+    def use(self, texts: List[str], vectors: List[List[float]]):
+        self._local.precomputed = (texts, vectors)
+        try:
+            yield
+        finally:
+            self._local.precomputed = None
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        precomputed = getattr(self._local, "precomputed", None)
+        if precomputed is not None and precomputed[0] == texts:
+            return precomputed[1]
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+def write_chunks(db: Chroma, embeddings: PrecomputedEmbeddings, docs: List[Document],
+                 vectors: List[List[float]], ids: List[str]):
+    """Upsert embedded chunks under their manifest IDs through Chroma's public add_texts."""
+    texts = [doc.page_content for doc in docs]
+    with embeddings.use(texts, vectors):
+        db.add_texts(texts, metadatas=[doc.metadata for doc in docs], ids=ids)
+
 def does_vectorstore_exist(persist_directory: str) -> bool:
     if os.path.exists(os.path.join(persist_directory, 'index')):
         if os.path.exists(os.path.join(persist_directory, 'chroma-collections.parquet')) and os.path.exists(os.path.join(persist_directory, 'chroma-embeddings.parquet')):
@@ -135,22 +168,78 @@ def does_vectorstore_exist(persist_directory: str) -> bool:
                 return True
     return False
 
-def main():
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+def adopt_existing_vectors(db: Chroma, manifest: IngestManifest):
+    """One-off migration for vectorstores created before the manifest existed."""
+    print("No ingest manifest found, recording existing vectors once...")
+    collection = db.get(include=["metadatas"])
+    ids_by_source = {}
+    for id, metadata in zip(collection['ids'], collection['metadatas']):
+        ids_by_source.setdefault(metadata.get('source', ''), []).append(id)
+    for source, ids in ids_by_source.items():
+        manifest.adopt(source, ids)
+
+def ingest_incremental(embeddings) -> int:
+    """Ingest new and changed files, removing vectors of changed or deleted files.
+
+    Returns the number of chunks written.
+    """
+    manifest = IngestManifest(manifest_path)
+    source_files = list_source_files(source_directory)
+    # The pipeline embeds chunks itself; the store is handed those vectors
+    store_embeddings = PrecomputedEmbeddings(embeddings)
     if does_vectorstore_exist(persist_directory):
         print(f"Appending to existing vectorstore at {persist_directory}")
-        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-        collection = db.get()
-        texts = process_documents([metadata['source'] for metadata in collection['metadatas']])
-        print("Creating embeddings. May take some minutes...")
-        db.add_documents(texts)
+        db = Chroma(persist_directory=persist_directory, embedding_function=store_embeddings, client_settings=CHROMA_SETTINGS)
+        if not manifest.exists():
+            adopt_existing_vectors(db, manifest)
     else:
         print("Creating new vectorstore")
-        texts = process_documents()
+        db = Chroma(persist_directory=persist_directory, embedding_function=store_embeddings, client_settings=CHROMA_SETTINGS)
+        manifest.reset()
+
+    # Only new or changed files are loaded; vectors of changed/deleted files are removed.
+    # Every file is re-chunked when the chunking settings changed since the last ingest
+    chunker = CodeChunker.for_embeddings(embeddings, chunk_size, chunk_overlap)
+    deduplicator = ChunkDeduplicator()
+    plan = manifest.plan(source_files, {"chunker": chunker.settings, "dedup": deduplicator.settings})
+    print(f"Ingest plan: {plan.summary()}")
+    if plan.stale_ids:
+        print(f"Removing {len(plan.stale_ids)} vectors from changed or deleted files")
+        db.delete(ids=plan.stale_ids)
+
+    chunks = 0
+    if plan.files_to_process:
+        # Stream files through load -> split -> embed -> write
+        print(f"Loading documents from {source_directory}")
         print("Creating embeddings. May take some minutes...")
-        db = Chroma.from_documents(texts, embeddings, persist_directory=persist_directory)
+        pipeline = IngestPipeline(
+            load_fn=load_task,
+            plan_fn=plan_load_tasks,
+            split_fn=lambda docs: deduplicator.split_documents(docs, chunker.split_documents),
+            embed_fn=embeddings.embed_documents,
+            write_fn=lambda docs, vectors, ids: write_chunks(db, store_embeddings, docs, vectors, ids),
+            ids_fn=manifest.assign_chunk_ids
+        )
+        chunks = int(pipeline.run(plan.files_to_process)["chunks"])
+        print(chunker.report())
+        print(deduplicator.report())
+        deduplicator.write_report()
+        manifest.record_duplicates(deduplicator.dependencies)
+        # Files that failed to load are retried once they change
+        for file_path in pipeline.failed_files:
+            manifest.skip(file_path)
+    else:
+        print("No new or changed documents to load")
+
     db.persist()
+    manifest.commit(plan)
     db = None
+    for stats in cache_stats():
+        print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['entries']} entries)")
+    return chunks
+
+def main():
+    ingest_incremental(load_embeddings())
     print("Ingestion complete! You can now run privateGPT.py to query your documents")
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Persistent manifest of ingested source files.
+
+For every source file the manifest records its content hash and the IDs of
+the chunks that were written to the vector store. Ingest uses it to work out
+which files are new or changed and which vectors belong to files that changed
+or were deleted. Chunk IDs are derived from the file path and content hash so
+re-running an ingest is idempotent.
+
+The manifest also records the chunking settings the files were split with.
+When they change (a new chunk size, tokenizer or chunker version), every
+file is planned as changed so its vectors are rebuilt with the new chunks.
+"""
+
+import os
+import json
+import hashlib
+from typing import Dict, List, Iterable, Optional
+
+from langchain.docstore.document import Document
+
+MANIFEST_VERSION = 1
+
+
+def file_hash(file_path: str, block_size: int = 1 << 20) -> str:
+    """Return the SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(source: str, content_hash: str, index: int) -> str:
+    """Deterministic ID for the index-th chunk of a file version."""
+    prefix = hashlib.sha1(f"{source}:{content_hash}".encode("utf-8")).hexdigest()
+    return f"{prefix}-{index}"
+
+
+class IngestPlan:
+    """Result of comparing the source directory against the manifest."""
+
+    def __init__(self):
+        self.new_files: List[str] = []
+        self.changed_files: List[str] = []
+        self.deleted_files: List[str] = []
+        self.unchanged_files: List[str] = []
+        self.stale_ids: List[str] = []
+        self.chunking: Optional[dict] = None
+        self.rechunk = False
+
+    @property
+    def files_to_process(self) -> List[str]:
+        return self.new_files + self.changed_files
+
+    def summary(self) -> str:
+        rechunk = "chunking settings changed, re-chunking every file: " if self.rechunk else ""
+        return (f"{rechunk}{len(self.new_files)} new, {len(self.changed_files)} changed, "
+                f"{len(self.deleted_files)} deleted, {len(self.unchanged_files)} unchanged "
+                f"({len(self.stale_ids)} stale vectors)")
+
+
+class IngestManifest:
+    """JSON-backed record of file hashes and chunk IDs."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files: Dict[str, dict] = {}
+        self.chunking: Optional[dict] = None
+        self._pending: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.files = data.get("files", {})
+                self.chunking = data.get("chunking")
+            else:
+                print(f"Ignoring manifest {path} with unsupported version {data.get('version')}")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def plan(self, file_paths: Iterable[str], chunking: Optional[dict] = None) -> IngestPlan:
+        """Classify files as new, changed, deleted or unchanged.
+
+        Files whose size and mtime match the manifest are treated as unchanged
+        without being re-hashed, so an unchanged corpus is planned in seconds.
+        ``chunking`` describes the chunker and deduplicator of this run; when
+        it differs from the recorded one (or none was recorded, as in
+        manifests written before it was), every file is planned as changed.
+        """
+        plan = IngestPlan()
+        plan.chunking = chunking
+        plan.rechunk = chunking is not None and bool(self.files) and chunking != self.chunking
+        seen = set()
+        for file_path in file_paths:
+            seen.add(file_path)
+            stat = os.stat(file_path)
+            entry = self.files.get(file_path)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                if not plan.rechunk:
+                    plan.unchanged_files.append(file_path)
+                    continue
+                content_hash = entry["hash"]
+            else:
+                content_hash = file_hash(file_path)
+            if entry and entry["hash"] == content_hash and not plan.rechunk:
+                # Touched but not modified; remember the new mtime
+                entry["mtime"] = stat.st_mtime
+                plan.unchanged_files.append(file_path)
+                continue
+
+            self._pending[file_path] = {
+                "hash": content_hash,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+            }
+            if entry:
+                plan.changed_files.append(file_path)
+                plan.stale_ids.extend(entry.get("chunk_ids", []))
+            else:
+                plan.new_files.append(file_path)
+
+        for file_path, entry in self.files.items():
+            if file_path not in seen:
+                plan.deleted_files.append(file_path)
+                plan.stale_ids.extend(entry.get("chunk_ids", []))
+
+        # Chunks dropped as duplicates live on in another file's vectors; when
+        # that file changes or goes, re-ingest the files that relied on it
+        affected = set(plan.changed_files) | set(plan.deleted_files)
+        for file_path in [path for path in plan.unchanged_files
+                          if affected.intersection(self.files[path].get("deduped_against", ()))]:
+            entry = self.files[file_path]
+            plan.unchanged_files.remove(file_path)
+            plan.changed_files.append(file_path)
+            plan.stale_ids.extend(entry.get("chunk_ids", []))
+            self._pending[file_path] = {"hash": entry["hash"], "size": entry["size"], "mtime": entry["mtime"]}
+        return plan
+
+    def assign_chunk_ids(self, chunks: List[Document]) -> List[str]:
+        """Give each chunk a deterministic ID and record it against its file.
+
+        Chunks are numbered in order within each source file. Call commit()
+        once the vectors have been written to persist the new file versions.
+        """
+        ids = []
+        counters: Dict[str, int] = {}
+        for chunk in chunks:
+            source = chunk.metadata.get("source", "")
+            pending = self._pending.get(source)
+            content_hash = pending["hash"] if pending else hashlib.sha256(
+                chunk.page_content.encode("utf-8")).hexdigest()
+            index = counters.get(source, 0)
+            counters[source] = index + 1
+            new_id = chunk_id(source, content_hash, index)
+            if pending is not None:
+                pending.setdefault("chunk_ids", []).append(new_id)
+            ids.append(new_id)
+        return ids
+
+    def commit(self, plan: IngestPlan):
+        """Apply a completed plan: record processed files and drop deleted ones."""
+        for file_path in plan.files_to_process:
+            pending = self._pending.pop(file_path, None)
+            if pending is not None:
+                pending.setdefault("chunk_ids", [])
+                self.files[file_path] = pending
+        for file_path in plan.deleted_files:
+            self.files.pop(file_path, None)
+        if plan.chunking is not None:
+            self.chunking = plan.chunking
+        self.save()
+
+    def record_duplicates(self, dependencies: Dict[str, Iterable[str]]):
+        """Record, per processed file, the files holding the chunks its duplicates were dropped for.
+
+        ``dependencies`` is ChunkDeduplicator.dependencies. Call before commit().
+        """
+        for file_path, sources in dependencies.items():
+            pending = self._pending.get(file_path)
+            if pending is not None:
+                pending["deduped_against"] = sorted(sources)
+
+    def skip(self, file_path: str):
+        """Leave a file that failed to load out of the commit.
+
+        The file is planned as new next time. Its old vectors, if any, were
+        already removed as stale, so its old entry is dropped too.
+        """
+        self._pending.pop(file_path, None)
+        self.files.pop(file_path, None)
+
+    def adopt(self, file_path: str, ids: List[str]):
+        """Record vectors that were ingested before the manifest existed.
+
+        Vectors whose source file no longer exists are recorded too, so the
+        next plan() reports them as stale.
+        """
+        if not os.path.exists(file_path):
+            self.files[file_path] = {"hash": "", "size": -1, "mtime": 0, "chunk_ids": list(ids)}
+            return
+        stat = os.stat(file_path)
+        self.files[file_path] = {
+            "hash": file_hash(file_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "chunk_ids": list(ids),
+        }
+
+    def reset(self):
+        """Forget every file, e.g. when the vector store was recreated."""
+        self.files = {}
+        self.chunking = None
+        self._pending = {}
+
+    def save(self):
+        """Atomically write the manifest to disk."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "chunking": self.chunking, "files": self.files}, f)
+        os.replace(tmp_path, self.path)
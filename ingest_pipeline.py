@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Streaming ingest engine shared by ingest.py and pinecone_ingest.py.
+
+Files flow through four concurrent stages connected by bounded queues:
+
+    loader pool -> splitter -> embedder -> writer
+
+Only a handful of files and batches are in flight at any time, so memory
+stays flat regardless of corpus size, and the loader, the embedding model
+and the vector store writes all overlap instead of running one after another.
+
+Loading runs on the shared, persistent pool of loader_pool.py, largest files
+first. Files that fail to load are quarantined and listed in
+``failed_files``; the rest of the run carries on.
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from tqdm import tqdm
+from langchain.docstore.document import Document
+
+from loader_pool import (FileLoad, LoaderStats, Quarantine, get_loader_pool, loader_workers,
+                         order_by_size, quarantine_path)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+# The most recently started pipeline, for progress reporting
+_current: Optional["IngestPipeline"] = None
+
+
+class IngestPipeline:
+    """Run load, split, embed and write stages concurrently with backpressure.
+
+    Args:
+        load_fn: Picklable function loading one file into a list of Documents.
+        split_fn: Splits one file's Documents into chunks.
+        embed_fn: Embeds a list of texts (e.g. ``embeddings.embed_documents``).
+        write_fn: Called as ``write_fn(chunks, vectors, ids)`` for each batch.
+        ids_fn: Optional function returning one ID per chunk, called once per file.
+        plan_fn: Optional function splitting a file into loader tasks (e.g. the
+            page ranges of a large PDF, see pdf_extract.plan_load_tasks).
+            load_fn is then called once per task, in parallel, and the
+            results are joined in task order before splitting.
+        workers: Loader processes (defaults to LOADER_WORKERS, else the CPU count).
+        batch_size: Chunks per embedding/write batch.
+        queue_size: Batches buffered between the splitter, embedder and writer.
+        max_pending_files: Files loaded or loading but not yet split.
+        write_workers: Concurrent ``write_fn`` calls, for network-bound stores.
+        quarantine_path: JSON file of files that failed to load (LOADER_QUARANTINE).
+            They are skipped until they change; an empty path disables this.
+    """
+
+    def __init__(
+        self,
+        load_fn: Callable[[str], List[Document]],
+        split_fn: Callable[[List[Document]], List[Document]],
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        write_fn: Callable[[List[Document], List[List[float]], Optional[List[str]]], None],
+        ids_fn: Optional[Callable[[List[Document]], List[str]]] = None,
+        plan_fn: Optional[Callable[[str], List[Any]]] = None,
+        workers: Optional[int] = None,
+        batch_size: int = 64,
+        queue_size: int = 4,
+        max_pending_files: Optional[int] = None,
+        write_workers: int = 1,
+        quarantine_path: str = quarantine_path,
+    ):
+        self.load_fn = load_fn
+        self.split_fn = split_fn
+        self.embed_fn = embed_fn
+        self.write_fn = write_fn
+        self.ids_fn = ids_fn
+        self.plan_fn = plan_fn
+        self.workers = workers or loader_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_pending_files = max_pending_files or self.workers * 2
+        self.write_workers = max(1, write_workers)
+        self.quarantine_path = quarantine_path
+        self.failed_files: List[str] = []
+        self.loader_stats = LoaderStats()
+        self._error: Optional[BaseException] = None
+        self._stats: Dict[str, float] = {}
+        self._stats_lock = threading.Lock()
+        self._running = False
+        self._started = 0.0
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+
+    def _add_stat(self, key: str, value: float):
+        with self._stats_lock:
+            self._stats[key] = self._stats.get(key, 0) + value
+
+    def _split_stage(self, docs_q: queue.Queue, batch_q: queue.Queue,
+                     slots: threading.BoundedSemaphore, total_files: int, quarantine: Quarantine):
+        chunks: List[Document] = []
+        ids: List[str] = []
+        with tqdm(total=total_files, desc='Loading new documents', ncols=80) as pbar:
+            while True:
+                item = docs_q.get()
+                if item is _DONE:
+                    break
+                slots.release()
+                pbar.update()
+                self._add_stat("files_loaded", 1)
+                self.loader_stats.record(item)
+                quarantine.record(item)
+                if item.error is not None:
+                    print(f"Failed to load {item.file_path}: {item.error}; quarantined")
+                    self.failed_files.append(item.file_path)
+                    self._add_stat("files_failed", 1)
+                    continue
+                if self._error is not None:
+                    continue
+                try:
+                    start = time.time()
+                    new_chunks = self.split_fn(item.documents)
+                    chunks.extend(new_chunks)
+                    if self.ids_fn is not None:
+                        ids.extend(self.ids_fn(new_chunks))
+                    self._add_stat("documents", len(item.documents))
+                    self._add_stat("split_seconds", time.time() - start)
+                    while len(chunks) >= self.batch_size:
+                        batch_q.put((chunks[:self.batch_size], ids[:self.batch_size] if ids else None))
+                        chunks = chunks[self.batch_size:]
+                        ids = ids[self.batch_size:]
+                except Exception as e:
+                    self._fail(e)
+        if chunks and self._error is None:
+            batch_q.put((chunks, ids or None))
+        batch_q.put(_DONE)
+
+    def _embed_stage(self, batch_q: queue.Queue, vector_q: queue.Queue):
+        while True:
+            item = batch_q.get()
+            if item is _DONE:
+                break
+            if self._error is not None:
+                continue
+            chunks, ids = item
+            try:
+                start = time.time()
+                vectors = self.embed_fn([chunk.page_content for chunk in chunks])
+                self._add_stat("embed_seconds", time.time() - start)
+                vector_q.put((chunks, vectors, ids))
+            except Exception as e:
+                self._fail(e)
+        vector_q.put(_DONE)
+
+    def _write_batch(self, chunks: List[Document], vectors: List[List[float]], ids: Optional[List[str]]):
+        if self._error is not None:
+            return
+        try:
+            start = time.time()
+            self.write_fn(chunks, vectors, ids)
+            self._add_stat("write_seconds", time.time() - start)
+            self._add_stat("chunks", len(chunks))
+        except Exception as e:
+            self._fail(e)
+
+    def _write_stage(self, vector_q: queue.Queue):
+        # Writes run on a small thread pool; in_flight bounds outstanding batches
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+            while True:
+                item = vector_q.get()
+                if item is _DONE:
+                    break
+                if self._error is not None:
+                    continue
+                while len(in_flight) >= self.write_workers:
+                    in_flight.popleft().result()
+                in_flight.append(executor.submit(self._write_batch, *item))
+
+    def run(self, file_paths: List[str]) -> Dict[str, float]:
+        """Ingest the given files and return per-stage statistics.
+
+        Files that fail to load, or were quarantined by an earlier run, are
+        left out and listed in ``failed_files``.
+        """
+        global _current
+        self._error = None
+        quarantine = Quarantine(self.quarantine_path)
+        file_paths, skipped = quarantine.partition(file_paths)
+        if skipped:
+            print(f"Skipping {len(skipped)} quarantined files (see {quarantine.path}); "
+                  f"they are retried once they change")
+        self.failed_files = list(skipped)
+        self.loader_stats = LoaderStats()
+        self._stats = {"files": len(file_paths), "files_loaded": 0, "files_failed": 0,
+                       "files_quarantined": len(skipped), "documents": 0, "chunks": 0}
+        start = self._started = time.time()
+        self._running = True
+        _current = self
+
+        # docs_q is bounded by the slots semaphore rather than maxsize, so pool
+        # callbacks never block the pool's result handler thread
+        docs_q: queue.Queue = queue.Queue()
+        batch_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        vector_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        slots = threading.BoundedSemaphore(self.max_pending_files)
+
+        stages = [
+            threading.Thread(target=self._split_stage,
+                             args=(docs_q, batch_q, slots, len(file_paths), quarantine), daemon=True),
+            threading.Thread(target=self._embed_stage, args=(batch_q, vector_q), daemon=True),
+            threading.Thread(target=self._write_stage, args=(vector_q,), daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        pool = get_loader_pool(self.workers)
+        try:
+            loads: List[FileLoad] = []
+            for file_path in order_by_size(file_paths):
+                slots.acquire()
+                if self._error is not None:
+                    slots.release()
+                    break
+                load = pool.submit_file(self.load_fn, file_path, self.plan_fn, docs_q.put)
+                self._add_stat("load_tasks", load.tasks)
+                loads.append(load)
+            # The pool outlives the run, so wait for this run's files rather than joining it
+            for load in loads:
+                load.wait()
+        finally:
+            docs_q.put(_DONE)
+            for stage in stages:
+                stage.join()
+            self._running = False
+            quarantine.save()
+
+        if self._error is not None:
+            raise self._error
+
+        self._stats["elapsed_seconds"] = time.time() - start
+        rate = self._stats['chunks'] / self._stats['elapsed_seconds'] if self._stats['elapsed_seconds'] > 0 else 0
+        print(f"Ingested {self._stats['chunks']} chunks from {self._stats['files']} files "
+              f"in {self._stats['elapsed_seconds']:.1f}s ({rate:.1f} vectors/s) "
+              f"(split {self._stats.get('split_seconds', 0):.1f}s, "
+              f"embed {self._stats.get('embed_seconds', 0):.1f}s, "
+              f"write {self._stats.get('write_seconds', 0):.1f}s)")
+        if self.failed_files:
+            print(f"{len(self.failed_files)} files were not loaded; see {quarantine.path or 'the log above'}")
+        print(self.loader_stats.report())
+        return dict(self._stats, by_extension=self.loader_stats.as_dict())
+
+    def progress(self) -> Dict[str, float]:
+        """Live counters of the current or last run."""
+        with self._stats_lock:
+            progress = dict(self._stats)
+        progress["running"] = self._running
+        progress["by_extension"] = self.loader_stats.as_dict()
+        progress["elapsed_seconds"] = progress.get("elapsed_seconds", time.time() - self._started)
+        return progress
+
+
+def ingest_progress() -> Optional[Dict[str, float]]:
+    """Progress of the running (or last) ingest in this process, if any."""
+    return _current.progress() if _current is not None else None
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Intent routing for incoming queries.
+
+Payment, form and map queries get canned responses and never reach the LLM.
+Instead of scanning a keyword list per intent, all phrases are compiled into
+one regular expression that finds every phrase occurring in the query in a
+single pass. Queries that match no phrase can be routed by comparing their
+embedding against precomputed exemplar questions for each intent, so
+paraphrases such as "settle my utility invoice" still reach the payment
+portal. Every route carries a confidence score: 1.0 for a phrase match, the
+exemplar cosine similarity for an embedding match.
+"""
+
+import os
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from vector_utils import normalize_rows
+
+# Load environment variables
+intent_embedding_routing = os.environ.get('INTENT_EMBEDDING_ROUTING', '1').lower() not in ('0', 'false', 'no', 'off')
+intent_similarity_threshold = float(os.environ.get('INTENT_SIMILARITY_THRESHOLD', 0.82))
+
+# Queries that match no special intent go to retrieval and the LLM
+DEFAULT_INTENT = "rag"
+
+
+class PhraseMatcher:
+    """Find which of many phrases occur in a text with one compiled regex.
+
+    Matching is substring-based and case-insensitive, like ``phrase in
+    text.lower()``. A lookahead at every position finds the longest phrase
+    starting there, and each phrase also reports the phrases it contains, so
+    overlapping phrases (e.g. "permit" inside "permits") are never missed.
+    """
+
+    def __init__(self, phrases: Iterable[str]):
+        self.phrases = list(dict.fromkeys(phrase.lower() for phrase in phrases))
+        ordered = sorted(self.phrases, key=len, reverse=True)
+        self._contains = {phrase: [other for other in self.phrases if other in phrase] for phrase in self.phrases}
+        self._pattern = (re.compile("(?=(" + "|".join(re.escape(phrase) for phrase in ordered) + "))")
+                         if ordered else None)
+
+    def find_all(self, text: str) -> List[str]:
+        """Every phrase occurring in text, in the order the phrases were given."""
+        if self._pattern is None:
+            return []
+        found = set()
+        for match in self._pattern.finditer(text.lower()):
+            found.update(self._contains[match.group(1)])
+        return [phrase for phrase in self.phrases if phrase in found]
+
+    def first(self, text: str) -> Optional[str]:
+        """The earliest-listed phrase occurring in text, or None."""
+        found = self.find_all(text)
+        return found[0] if found else None
+
+
+class Route:
+    """The intent chosen for a query and how it was chosen."""
+
+    def __init__(self, intent: str, confidence: float, method: str, matched: Optional[List[str]] = None):
+        self.intent = intent
+        self.confidence = confidence
+        self.method = method
+        self.matched = matched or []
+
+    def to_dict(self) -> dict:
+        return {"intent": self.intent, "confidence": self.confidence,
+                "method": self.method, "matched": self.matched}
+
+    def __repr__(self) -> str:
+        return f"Route({self.intent!r}, confidence={self.confidence:.2f}, method={self.method!r})"
+
+
+class IntentRouter:
+    """Route queries by phrase match, then by similarity to intent exemplars.
+
+    Args:
+        intents: Intent name -> trigger phrases, in priority order (the
+            first listed intent wins when phrases of several intents match).
+        exemplars: Intent name -> example questions for the embedding
+            fallback. Exemplars are embedded once, on first use.
+        embed_fn: Returns an embedding for a text; typically the retrieval
+            embeddings' embed_query, so the query vector is cached for the
+            search that follows. Without it only phrases are used.
+        threshold: Minimum cosine similarity for an embedding route.
+    """
+
+    def __init__(self, intents: Dict[str, Sequence[str]],
+                 exemplars: Optional[Dict[str, Sequence[str]]] = None,
+                 embed_fn: Optional[Callable[[str], List[float]]] = None,
+                 threshold: float = intent_similarity_threshold):
+        self.intents = list(intents)
+        self._phrase_intents: Dict[str, List[str]] = {}
+        for intent, phrases in intents.items():
+            for phrase in phrases:
+                self._phrase_intents.setdefault(phrase.lower(), []).append(intent)
+        self.matcher = PhraseMatcher(self._phrase_intents)
+        self.exemplars = {intent: list(texts) for intent, texts in (exemplars or {}).items()}
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self._exemplar_matrix = None
+        self._exemplar_intents: List[str] = []
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def _exemplar_vectors(self):
+        if self._exemplar_matrix is None:
+            with self._lock:
+                if self._exemplar_matrix is None:
+                    intents, vectors = [], []
+                    for intent, texts in self.exemplars.items():
+                        for text in texts:
+                            intents.append(intent)
+                            vectors.append(self.embed_fn(text))
+                    self._exemplar_intents = intents
+                    self._exemplar_matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        return self._exemplar_intents, self._exemplar_matrix
+
+    def _classify(self, query: str) -> Optional[Route]:
+        intents, matrix = self._exemplar_vectors()
+        if not len(intents):
+            return None
+        vector = normalize_rows(np.asarray([self.embed_fn(query)], dtype=np.float32))[0]
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score >= self.threshold:
+            return Route(intents[best], score, "embedding")
+        # Confidence that the query is none of the special intents
+        return Route(DEFAULT_INTENT, 1.0 - max(score, 0.0), "embedding")
+
+    def route(self, query: str) -> Route:
+        """Choose the intent for a query."""
+        matched = self.matcher.find_all(query)
+        route = None
+        if matched:
+            hit = {intent for phrase in matched for intent in self._phrase_intents[phrase]}
+            intent = next(intent for intent in self.intents if intent in hit)
+            route = Route(intent, 1.0, "phrase",
+                          [phrase for phrase in matched if intent in self._phrase_intents[phrase]])
+        elif self.embed_fn is not None and self.exemplars and intent_embedding_routing:
+            try:
+                route = self._classify(query)
+            except Exception as e:
+                # Embeddings unavailable (e.g. not initialized yet): phrases only
+                print(f"Embedding intent routing failed, using phrase routing only: {e}")
+        if route is None:
+            route = Route(DEFAULT_INTENT, 1.0, "default")
+        with self._lock:
+            self.counts[route.intent] = self.counts.get(route.intent, 0) + 1
+        return route
+
+    def fall_back(self, route: Route) -> Route:
+        """Re-route a query whose special intent had no answer (e.g. no matching form).
+
+        The query goes to retrieval and the LLM like any other, so it is
+        counted, reported and observed as DEFAULT_INTENT.
+        """
+        with self._lock:
+            self.counts[route.intent] -= 1
+            self.counts[DEFAULT_INTENT] = self.counts.get(DEFAULT_INTENT, 0) + 1
+        return Route(DEFAULT_INTENT, 1.0, "fallback", route.matched)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "intents": self.intents,
+                "phrases": len(self._phrase_intents),
+                "exemplars": sum(len(texts) for texts in self.exemplars.values()),
+                "embedding_routing": intent_embedding_routing and self.embed_fn is not None,
+                "threshold": self.threshold,
+                "routed": dict(self.counts),
+            }
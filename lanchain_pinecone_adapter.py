@@ -1,26 +1,51 @@
 # Replace your current lanchain_pinecone_adapter.py with this improved version
 
+import os
 from langchain.embeddings.base import Embeddings
 from sentence_transformers import SentenceTransformer
 import numpy as np
+from embedding_cache import get_embedding_cache, embed_with_cache
+
+def parse_target_dim(value):
+    """Parse a target dimension setting; "native" (or empty) means no padding"""
+    if value is None or str(value).strip().lower() in ("", "native", "none", "0"):
+        return None
+    return int(value)
+
+# Dimension of the Pinecone index the embeddings are written to. Legacy
+# indexes are 1024-d; set EMBEDDING_TARGET_DIM=native for a model-sized index.
+DEFAULT_TARGET_DIM = parse_target_dim(os.environ.get("EMBEDDING_TARGET_DIM", "1024"))
 
 class CustomHuggingFaceEmbeddings(Embeddings):
     """
     Enhanced implementation of Embeddings using HuggingFace's SentenceTransformers
-    with dimension padding for Pinecone compatibility
+    with optional dimension padding for Pinecone compatibility
     """
     
-    def __init__(self, model_name="all-MiniLM-L6-v2", target_dim=1024):
-        """Initialize with a SentenceTransformer model"""
+    def __init__(self, model_name="all-MiniLM-L6-v2", target_dim=DEFAULT_TARGET_DIM):
+        """Initialize with a SentenceTransformer model.
+        
+        target_dim=None keeps the model's native dimension (no padding).
+        """
         self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.native_dim = self.model.get_sentence_embedding_dimension()
         self.target_dim = target_dim
+        
+        # Native (unpadded) vectors are cached on disk by model + text hash
+        self.cache = get_embedding_cache(model_name)
+    
+    @property
+    def dimension(self) -> int:
+        """Dimension of the vectors this adapter produces"""
+        return self.target_dim or self.native_dim
     
     def _pad_embedding(self, embedding):
         """Pad or truncate embedding to target dimension"""
         current_dim = len(embedding)
         
-        # If already correct dimension, return as is
-        if current_dim == self.target_dim:
+        # Native mode, or already correct dimension: return as is
+        if self.target_dim is None or current_dim == self.target_dim:
             return embedding
         
         # If smaller, pad with zeros
@@ -42,21 +67,27 @@ class CustomHuggingFaceEmbeddings(Embeddings):
         # Preprocess texts
         processed_texts = [self._preprocess_text(text) for text in texts]
         
-        # Get embeddings
-        embeddings = self.model.encode(processed_texts)
+        # Get embeddings, encoding only texts that aren't cached
+        embeddings = embed_with_cache(self.cache, processed_texts, self.model.encode)
         
-        # Pad embeddings to target dimension
+        # Pad embeddings to target dimension (no-op in native mode)
         return [self._pad_embedding(emb) for emb in embeddings]
     
+    def embed_queries(self, texts):
+        """Embed several queries in one encode call (for BatchedQueryEmbeddings)"""
+        processed_texts = [self._preprocess_text(text) for text in texts]
+        embeddings = embed_with_cache(self.cache, processed_texts, self.model.encode, "query")
+        return [np.asarray(self._pad_embedding(emb)).tolist() for emb in embeddings]
+    
     def embed_query(self, text):
         """Embed a query"""
         # Preprocess text
         processed_text = self._preprocess_text(text)
         
-        # Get embedding
-        embedding = self.model.encode(processed_text)
+        # Get embedding, reusing a cached one when available
+        embedding = embed_with_cache(self.cache, [processed_text], self.model.encode, "query")[0]
         
-        # Pad embedding to target dimension
+        # Pad embedding to target dimension (no-op in native mode)
         padded_embedding = self._pad_embedding(embedding)
         
         # Convert NumPy array to list before returning
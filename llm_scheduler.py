@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Admission control and scheduling for Ollama generations.
+
+Ollama serves one (or a few) generations at a time. Without limits every
+extra request just waits longer until clients time out. The scheduler:
+
+- admits a query only if the client is within its token-bucket rate limit
+  (HTTP 429 otherwise) and the wait queue is not full (HTTP 503 otherwise),
+  both with a Retry-After estimate, before any work is done;
+- runs at most LLM_CONCURRENCY generations at once; ScheduledOllama waits
+  for a slot inside the LLM call, so retrieval still overlaps generation;
+- records queue depth, wait times and rejections for /status.
+
+The client identity is carried in a context variable set by the endpoint,
+so it follows the query onto the worker thread.
+"""
+
+import os
+import math
+import ipaddress
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from langchain.llms import Ollama
+from langchain.schema import LLMResult
+from ollama_warmup import ollama_base_url, ollama_keep_alive, ollama_num_ctx
+from query_timing import stage, record_stage, record_count
+
+# Load environment variables
+llm_concurrency = int(os.environ.get('LLM_CONCURRENCY', 1))
+llm_max_queue = int(os.environ.get('LLM_MAX_QUEUE', 16))
+llm_queue_timeout = float(os.environ.get('LLM_QUEUE_TIMEOUT', 120))
+rate_limit_per_minute = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+rate_limit_burst = int(os.environ.get('RATE_LIMIT_BURST', 10))
+# Reverse proxies (addresses or CIDRs) whose X-Forwarded-For and X-Client-ID are believed
+trusted_proxies = [ipaddress.ip_network(proxy.strip(), strict=False)
+                   for proxy in os.environ.get('TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+
+# Identifies the client on whose behalf the current query runs
+current_client: contextvars.ContextVar = contextvars.ContextVar('current_client', default=None)
+
+# Forget idle clients once this many are tracked
+MAX_TRACKED_CLIENTS = 10000
+
+
+class SchedulerRejected(Exception):
+    """A query was refused; carries the HTTP status and Retry-After seconds."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """Per-client token buckets refilled at rate_per_minute, holding up to burst tokens."""
+
+    def __init__(self, rate_per_minute: float = rate_limit_per_minute, burst: int = rate_limit_burst):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self._buckets: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, client: str) -> float:
+        """Take a token; return 0 on success or the seconds until one is available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                if len(self._buckets) >= MAX_TRACKED_CLIENTS:
+                    self._prune(now)
+                bucket = self._buckets[client] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        # Buckets that have refilled completely carry no state worth keeping
+        full = [client for client, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for client in full:
+            del self._buckets[client]
+
+    def clients(self) -> int:
+        return len(self._buckets)
+
+
+class Admission:
+    """An admitted query's place in the scheduler; release() exactly once."""
+
+    def __init__(self, scheduler: "LLMScheduler"):
+        self._scheduler = scheduler
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        # Safe to call more than once, from any thread
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler._release()
+
+    def __enter__(self) -> "Admission":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class LLMScheduler:
+    """Bounded generation concurrency with a bounded wait queue."""
+
+    def __init__(self, concurrency: int = llm_concurrency, max_queue: int = llm_max_queue,
+                 queue_timeout: float = llm_queue_timeout, limiter: Optional[TokenBucketLimiter] = None):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.limiter = limiter if limiter is not None else TokenBucketLimiter()
+        self._condition = threading.Condition()
+        self.admitted = 0
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected_rate_limited = 0
+        self.rejected_queue_full = 0
+        self.timed_out = 0
+        self._wait_times = deque(maxlen=1000)
+        self._generation_times = deque(maxlen=100)
+
+    def retry_after(self) -> int:
+        """Seconds until a queued request would likely get a slot."""
+        average = (sum(self._generation_times) / len(self._generation_times)) if self._generation_times else 10.0
+        return max(1, math.ceil(average * (self.waiting + 1) / self.concurrency))
+
+    def admit(self, client: Optional[str] = None) -> "Admission":
+        """Admit a query, raising SchedulerRejected (429 or 503) without waiting.
+
+        The returned Admission must be released when the query finishes; it
+        can be used as a context manager. The client is recorded in
+        current_client for the rest of the caller's context.
+        """
+        client = client or current_client.get() or "anonymous"
+        wait = self.limiter.try_acquire(client)
+        if wait > 0:
+            with self._condition:
+                self.rejected_rate_limited += 1
+            raise SchedulerRejected(429, "Too many requests; please slow down", max(1, math.ceil(wait)))
+        with self._condition:
+            if self.admitted >= self.concurrency + self.max_queue:
+                self.rejected_queue_full += 1
+                raise SchedulerRejected(503, "Server is busy; please retry shortly", self.retry_after())
+            self.admitted += 1
+        current_client.set(client)
+        return Admission(self)
+
+    def _release(self):
+        with self._condition:
+            self.admitted -= 1
+
+    @contextmanager
+    def generation(self):
+        """Hold one of the generation slots, waiting in line for it if needed."""
+        start = time.monotonic()
+        with self._condition:
+            if self.running >= self.concurrency and self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                raise SchedulerRejected(503, "Server is busy; please retry shortly", self.retry_after())
+            self.waiting += 1
+            try:
+                acquired = self._condition.wait_for(lambda: self.running < self.concurrency, self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not acquired:
+                self.timed_out += 1
+                raise SchedulerRejected(503, "Timed out waiting for the language model", self.retry_after())
+            self.running += 1
+            self._wait_times.append(time.monotonic() - start)
+        generation_start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.running -= 1
+                self.completed += 1
+                self._generation_times.append(time.monotonic() - generation_start)
+                self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            waits = sorted(self._wait_times)
+            generations = list(self._generation_times)
+            return {
+                "concurrency": self.concurrency,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "queue_depth": self.waiting,
+                "admitted_in_flight": self.admitted,
+                "completed": self.completed,
+                "rejected_rate_limited": self.rejected_rate_limited,
+                "rejected_queue_full": self.rejected_queue_full,
+                "timed_out": self.timed_out,
+                "wait_time_avg": sum(waits) / len(waits) if waits else 0.0,
+                "wait_time_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "wait_time_max": waits[-1] if waits else 0.0,
+                "generation_time_avg": sum(generations) / len(generations) if generations else 0.0,
+                "tracked_clients": self.limiter.clients(),
+            }
+
+
+# Shared by every LLM in the process so the limits hold across chains
+scheduler = LLMScheduler()
+
+
+class ScheduledOllama(Ollama):
+    """Ollama LLM whose generations run under the process-wide scheduler.
+
+    Defaults to the same base URL, context size and keep-alive as the
+    warm-up in ollama_warmup, so queries never force a model reload.
+    """
+
+    base_url: str = ollama_base_url
+    num_ctx: Optional[int] = ollama_num_ctx
+    keep_alive: Optional[str] = ollama_keep_alive
+
+    @property
+    def _default_params(self) -> Dict[str, Any]:
+        params = super()._default_params
+        if self.keep_alive is not None:
+            params["keep_alive"] = self.keep_alive
+        return params
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> LLMResult:
+        queued = time.perf_counter()
+        with scheduler.generation():
+            record_stage("llm_queue", time.perf_counter() - queued)
+            with stage("llm"):
+                result = super()._generate(prompts, stop=stop, run_manager=run_manager, **kwargs)
+        # Ollama reports token counts and timings in the final chunk
+        for generations in result.generations:
+            info = (generations[0].generation_info or {}) if generations else {}
+            record_count("llm_tokens", info.get("eval_count", 0))
+            record_count("llm_prompt_tokens", info.get("prompt_eval_count", 0))
+            record_count("llm_eval_seconds", info.get("eval_duration", 0) / 1e9)
+        return result
+
+
+def _trusted(address: Optional[str]) -> bool:
+    try:
+        ip = ipaddress.ip_address((address or "").strip())
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxies)
+
+
+def client_id(headers, host: Optional[str]) -> str:
+    """Identify a client for rate limiting.
+
+    The socket address is used unless the connection comes from one of
+    TRUSTED_PROXIES. Only then are X-Client-ID and X-Forwarded-For believed,
+    taking the rightmost forwarded address that is not itself a trusted
+    proxy, since clients can put anything at the left of the header.
+    """
+    if not _trusted(host):
+        return host or "anonymous"
+    explicit = headers.get("x-client-id")
+    if explicit:
+        return explicit
+    forwarded = [address.strip() for address in headers.get("x-forwarded-for", "").split(",") if address.strip()]
+    for address in reversed(forwarded):
+        if not _trusted(address):
+            return address
+    return forwarded[0] if forwarded else host
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Persistent, size-aware loader process pool shared by every ingest in a process.
+
+The pool is created once (``get_loader_pool``) and kept for the life of the
+process, so the API server's repeated ingests do not re-fork workers. Each
+worker imports the heavy loader modules (LOADER_PRELOAD) when it starts
+rather than while loading its first file. Files are dispatched largest
+first, one task at a time, so a big file found late in the glob does not
+stretch the end of the run.
+
+Every task runs under LOADER_TIMEOUT seconds. A file that fails or times
+out is recorded in the quarantine file (LOADER_QUARANTINE) and skipped by
+later runs until its size or mtime changes. The other files carry on; one
+bad file no longer aborts the ingest. LoaderStats reports files, bytes and
+worker time per file extension.
+
+The timeout is enforced twice. Inside the worker, SIGALRM interrupts the
+loader between Python bytecodes so it fails cleanly. The parent watches
+every running task and kills the worker once LOADER_KILL_GRACE more
+seconds have passed, which also covers loaders stuck in native code and
+platforms without ``signal.setitimer``. A worker that dies mid-task
+(a segfault in a PDF parser, an OOM kill) fails that task with
+LoaderCrash. multiprocessing.Pool replaces lost workers but never reports
+their tasks, so without the watchdog the ingest would wait forever.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import signal
+import importlib
+import threading
+import multiprocessing
+from multiprocessing import Pool
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+from langchain.docstore.document import Document
+
+# Load environment variables
+loader_workers = int(os.environ.get('LOADER_WORKERS', 0))  # 0: one per CPU
+loader_timeout = float(os.environ.get('LOADER_TIMEOUT', 600))  # seconds per task, 0 disables
+loader_kill_grace = float(os.environ.get('LOADER_KILL_GRACE', 30))  # seconds past the timeout before a kill
+quarantine_path = os.environ.get('LOADER_QUARANTINE', 'loader_quarantine.json')
+preload_modules = [name.strip() for name in os.environ.get('LOADER_PRELOAD', ','.join([
+    'langchain.document_loaders',
+    'fitz',
+    'unstructured.partition.html',
+    'unstructured.partition.md',
+    'unstructured.partition.docx',
+    'unstructured.partition.pptx',
+    'unstructured.partition.email',
+    'unstructured.partition.epub',
+])).split(',') if name.strip()]
+
+# Quarantine entries keep this much of the error message
+MAX_ERROR_CHARS = 500
+
+# How often the parent checks running tasks for deadlines and dead workers
+WATCHDOG_INTERVAL = 0.5
+
+
+class LoadTimeout(TimeoutError):
+    """A loader task exceeded LOADER_TIMEOUT."""
+
+
+class LoaderCrash(RuntimeError):
+    """The loader worker running a task died before returning a result."""
+
+
+# Set in each worker: the pipe (and its lock) on which it announces the tasks it starts
+_task_events = None
+
+
+def _init_worker(modules: List[str], events):
+    # Pool initializer: pay for the loader imports once per worker, up front
+    global _task_events
+    _task_events = events
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+
+
+def _run_task(load_fn: Callable[[Any], List[Document]], task: Any, timeout: float,
+              task_id: int) -> Tuple[List[Document], float]:
+    """Run one loader task in a worker; returns (documents, seconds)."""
+    def expire(signum, frame):
+        raise LoadTimeout(f"Loading timed out after {timeout:g}s (LOADER_TIMEOUT)")
+
+    start = time.time()
+    if _task_events is not None:
+        # Lets the parent's watchdog time the task and notice if this worker dies.
+        # Sent synchronously, unlike a multiprocessing.Queue, so it is out before the loader runs.
+        writer, lock = _task_events
+        with lock:
+            writer.send((task_id, os.getpid(), start))
+    timer = timeout > 0 and hasattr(signal, 'setitimer')
+    if timer:
+        signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        documents = load_fn(task)
+    finally:
+        if timer:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return documents, time.time() - start
+
+
+def _alive(pid: int) -> bool:
+    # The pool reaps a dead worker within a fraction of a second, after which its pid is gone.
+    # On Windows os.kill(pid, 0) would terminate the process, so only deadlines apply there.
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def file_size(file_path: str) -> int:
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def order_by_size(file_paths: List[str]) -> List[str]:
+    """Largest files first, so the longest loads start while the pool is full."""
+    return sorted(file_paths, key=file_size, reverse=True)
+
+
+class FileLoad:
+    """Collects the loader results of one file's tasks and joins them in task order.
+
+    Results arrive on the pool's result-handler thread, and failures also
+    from the pool's watchdog, so updates are locked. ``on_done`` is called
+    with this object once every task has finished; ``error`` is then set if
+    any task failed.
+    """
+
+    def __init__(self, file_path: str, tasks: int, on_done: Callable[["FileLoad"], None]):
+        self.file_path = file_path
+        self.extension = os.path.splitext(file_path)[1].lower() or file_path
+        self.size = file_size(file_path)
+        self.tasks = tasks
+        self.documents: List[Document] = []
+        self.error: Optional[BaseException] = None
+        self.seconds = 0.0
+        self._parts: List[Optional[List[Document]]] = [None] * tasks
+        self._remaining = tasks
+        self._on_done = on_done
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        if tasks == 0:
+            self._complete()
+
+    def done(self, index: int, result: Tuple[List[Document], float]):
+        with self._lock:
+            self._parts[index], seconds = result
+            self.seconds += seconds
+            last = self._finish_one()
+        if last:
+            self._complete()
+
+    def failed(self, index: int, error: BaseException, seconds: float = 0.0):
+        with self._lock:
+            self.error = self.error or error
+            self.seconds += seconds
+            last = self._finish_one()
+        if last:
+            self._complete()
+
+    def fail(self, error: BaseException):
+        """Fail the file before any task was submitted (e.g. planning failed)."""
+        self.error = error
+        self._complete()
+
+    def _finish_one(self) -> bool:
+        self._remaining -= 1
+        return self._remaining == 0
+
+    def _complete(self):
+        if self.error is None:
+            self.documents = [doc for part in self._parts for doc in part]
+        self._parts = []
+        self._finished.set()
+        self._on_done(self)
+
+    @property
+    def timed_out(self) -> bool:
+        return isinstance(self.error, LoadTimeout)
+
+    def wait(self):
+        self._finished.wait()
+
+
+class Quarantine:
+    """JSON-backed record of files that failed to load, skipped until they change.
+
+    An empty path keeps the record in memory only.
+    """
+
+    def __init__(self, path: str = quarantine_path):
+        self.path = path
+        self.files: Dict[str, dict] = {}
+        self._dirty = False
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.files = json.load(f).get("files", {})
+
+    def partition(self, file_paths: List[str]) -> Tuple[List[str], List[str]]:
+        """Split files into (to load, quarantined and unchanged since)."""
+        to_load, skipped = [], []
+        for file_path in file_paths:
+            entry = self.files.get(file_path)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                stat = None
+            if entry and stat and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                skipped.append(file_path)
+            else:
+                to_load.append(file_path)
+        return to_load, skipped
+
+    def record(self, load: FileLoad):
+        """Quarantine a failed file, or release a file that now loads."""
+        if load.error is None:
+            if self.files.pop(load.file_path, None) is not None:
+                self._dirty = True
+            return
+        try:
+            stat = os.stat(load.file_path)
+            size, mtime = stat.st_size, stat.st_mtime
+        except OSError:
+            size, mtime = -1, 0
+        previous = self.files.get(load.file_path, {})
+        self.files[load.file_path] = {
+            "size": size,
+            "mtime": mtime,
+            "error": f"{type(load.error).__name__}: {load.error}"[:MAX_ERROR_CHARS],
+            "failures": previous.get("failures", 0) + 1,
+            "quarantined_at": time.time(),
+        }
+        self._dirty = True
+
+    def save(self):
+        """Atomically write the quarantine file if it changed."""
+        if not self.path or not self._dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"files": self.files}, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+class LoaderStats:
+    """Files, bytes, documents and worker seconds per file extension."""
+
+    def __init__(self):
+        self.extensions: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, load: FileLoad):
+        with self._lock:
+            entry = self.extensions.setdefault(load.extension, {
+                "files": 0, "bytes": 0, "documents": 0, "seconds": 0.0, "failed": 0, "timed_out": 0})
+            entry["files"] += 1
+            entry["bytes"] += load.size
+            entry["documents"] += len(load.documents)
+            entry["seconds"] += load.seconds
+            entry["failed"] += load.error is not None
+            entry["timed_out"] += load.timed_out
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        """Per-extension counters with throughput per second of worker time."""
+        with self._lock:
+            extensions = {extension: dict(entry) for extension, entry in self.extensions.items()}
+        for entry in extensions.values():
+            seconds = entry["seconds"]
+            entry["files_per_second"] = entry["files"] / seconds if seconds > 0 else 0.0
+            entry["mb_per_second"] = entry["bytes"] / 1e6 / seconds if seconds > 0 else 0.0
+        return extensions
+
+    def report(self) -> str:
+        """One line per extension, slowest in total first."""
+        lines = ["Loader throughput by extension (worker time):"]
+        for extension, entry in sorted(self.as_dict().items(), key=lambda item: -item[1]["seconds"]):
+            line = (f"  {extension:<6} {entry['files']:>6} files {entry['bytes'] / 1e6:>9.1f} MB "
+                    f"{entry['seconds']:>8.1f}s {entry['files_per_second']:>8.2f} files/s "
+                    f"{entry['mb_per_second']:>7.2f} MB/s")
+            if entry["failed"]:
+                line += f"  {entry['failed']} failed ({entry['timed_out']} timed out)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class LoaderPool:
+    """A long-lived worker pool running loader tasks with a per-task timeout.
+
+    Args:
+        workers: Worker processes (defaults to LOADER_WORKERS, else the CPU count).
+        timeout: Seconds per task before it is abandoned with LoadTimeout.
+        kill_grace: Further seconds before the parent kills the worker.
+        preload: Modules each worker imports when it starts.
+    """
+
+    def __init__(self, workers: Optional[int] = None, timeout: float = loader_timeout,
+                 kill_grace: float = loader_kill_grace, preload: Optional[List[str]] = None):
+        self.workers = workers or loader_workers or os.cpu_count()
+        self.timeout = timeout
+        self.kill_grace = kill_grace
+        self.preload = preload_modules if preload is None else preload
+        self._events, writer = multiprocessing.Pipe(duplex=False)
+        self._pool = Pool(processes=self.workers, initializer=_init_worker,
+                          initargs=(self.preload, (writer, multiprocessing.Lock())))
+        # Submitted tasks not yet finished: task id -> (FileLoad, task index)
+        self._pending: Dict[int, Tuple[FileLoad, int]] = {}
+        # Started tasks: task id -> (worker pid, start time)
+        self._running: Dict[int, Tuple[int, float]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def _finish(self, task_id: int) -> Optional[Tuple[FileLoad, int]]:
+        # Whichever of the result callback and the watchdog comes first owns the task
+        with self._lock:
+            self._running.pop(task_id, None)
+            return self._pending.pop(task_id, None)
+
+    def _on_result(self, task_id: int, result: Tuple[List[Document], float]):
+        entry = self._finish(task_id)
+        if entry is not None:
+            entry[0].done(entry[1], result)
+
+    def _on_error(self, task_id: int, error: BaseException):
+        entry = self._finish(task_id)
+        if entry is not None:
+            # A timed-out task held its worker for the whole timeout
+            entry[0].failed(entry[1], error, self.timeout if isinstance(error, LoadTimeout) else 0.0)
+
+    def _watch(self):
+        while not self._closed.is_set():
+            try:
+                while self._events.poll(WATCHDOG_INTERVAL):
+                    task_id, pid, started = self._events.recv()
+                    with self._lock:
+                        if task_id in self._pending:
+                            self._running[task_id] = (pid, started)
+                    if not self._events.poll():
+                        break
+            except (EOFError, OSError):
+                return
+            now = time.time()
+            with self._lock:
+                running = list(self._running.items())
+            for task_id, (pid, started) in running:
+                if self.timeout > 0 and now - started > self.timeout + self.kill_grace:
+                    try:
+                        os.kill(pid, signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+                    except OSError:
+                        pass
+                    self._on_error(task_id, LoadTimeout(
+                        f"Loading did not finish within {self.timeout + self.kill_grace:g}s; worker {pid} killed"))
+                elif not _alive(pid):
+                    self._on_error(task_id, LoaderCrash(f"Loader worker {pid} exited while loading"))
+                else:
+                    continue
+                print(f"Loader task {task_id} failed in worker {pid}; the pool replaces the worker")
+
+    def submit_file(self, load_fn: Callable[[Any], List[Document]], file_path: str,
+                    plan_fn: Optional[Callable[[str], List[Any]]],
+                    on_done: Callable[[FileLoad], None]) -> FileLoad:
+        """Queue the tasks of one file; ``on_done`` receives its FileLoad when they finish.
+
+        ``plan_fn`` splits a file into tasks (e.g. pdf_extract.plan_load_tasks)
+        and runs in the calling process; without it the path is the only task.
+        """
+        try:
+            tasks = plan_fn(file_path) if plan_fn is not None else [file_path]
+        except Exception as e:
+            load = FileLoad(file_path, 1, on_done)
+            load.fail(e)
+            return load
+        load = FileLoad(file_path, len(tasks), on_done)
+        for index, task in enumerate(tasks):
+            with self._lock:
+                task_id = self._next_id
+                self._next_id += 1
+                self._pending[task_id] = (load, index)
+            self._pool.apply_async(
+                _run_task, (load_fn, task, self.timeout, task_id),
+                callback=lambda result, task_id=task_id: self._on_result(task_id, result),
+                error_callback=lambda e, task_id=task_id: self._on_error(task_id, e)
+            )
+        return load
+
+    def imap_files(self, load_fn: Callable[[Any], List[Document]], file_paths: List[str],
+                   plan_fn: Optional[Callable[[str], List[Any]]] = None,
+                   max_pending: Optional[int] = None) -> Iterator[FileLoad]:
+        """Load files largest first, yielding each FileLoad as it completes, failed or not."""
+        finished: queue.Queue = queue.Queue()
+        max_pending = max_pending or self.workers * 2
+        pending = 0
+        for file_path in order_by_size(file_paths):
+            if pending >= max_pending:
+                yield finished.get()
+                pending -= 1
+            self.submit_file(load_fn, file_path, plan_fn, finished.put)
+            pending += 1
+        for _ in range(pending):
+            yield finished.get()
+
+    def close(self):
+        self._closed.set()
+        self._pool.terminate()
+        self._pool.join()
+
+
+_pool: Optional[LoaderPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_loader_pool(workers: Optional[int] = None) -> LoaderPool:
+    """Return the process-wide loader pool, starting it on first use.
+
+    Asking for a different number of workers replaces the pool.
+    """
+    global _pool
+    with _pool_lock:
+        workers = workers or loader_workers or os.cpu_count()
+        if _pool is not None and _pool.workers != workers:
+            _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = LoaderPool(workers)
+    return _pool
+
+
+@atexit.register
+def close_loader_pool():
+    """Stop the process-wide loader pool, if one was started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def load_files(load_fn: Callable[[Any], List[Document]], file_paths: List[str],
+               plan_fn: Optional[Callable[[str], List[Any]]] = None) -> List[Document]:
+    """Load files on the shared pool, skipping and quarantining files that fail.
+
+    Prints the per-extension throughput when done.
+    """
+    quarantine = Quarantine()
+    file_paths, skipped = quarantine.partition(file_paths)
+    if skipped:
+        print(f"Skipping {len(skipped)} quarantined files (see {quarantine.path}); "
+              f"they are retried once they change")
+    stats = LoaderStats()
+    results = []
+    try:
+        with tqdm(total=len(file_paths), desc='Loading new documents', ncols=80) as pbar:
+            for load in get_loader_pool().imap_files(load_fn, file_paths, plan_fn):
+                stats.record(load)
+                quarantine.record(load)
+                if load.error is not None:
+                    print(f"Failed to load {load.file_path}: {load.error}; quarantined")
+                else:
+                    results.extend(load.documents)
+                pbar.update()
+    finally:
+        quarantine.save()
+    print(stats.report())
+    return results
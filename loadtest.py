@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+HTTP load testing for the /query endpoint without production Ollama or Pinecone.
+
+Three parts, each a subcommand:
+
+    ollama-stub   An Ollama-compatible /api/generate server that streams tokens
+                  at a configurable rate after a configurable first-token
+                  latency, serving at most --parallel generations at once
+                  (like OLLAMA_NUM_PARALLEL).
+    serve         Runs pinecone_api against the stub and an in-memory
+                  MockPineconeIndex holding a synthetic municipal-code corpus
+                  (real cosine search; see benchmark.py for the corpus).
+    run           Replays a query mix against a server at several
+                  concurrency levels and reports p50/p95/p99 latency,
+                  throughput and error rates.
+
+Typical session (three terminals):
+
+    python loadtest.py ollama-stub --port 11500 --tokens-per-second 25
+    python loadtest.py serve --port 8001 --ollama-url http://localhost:11500
+    python loadtest.py run --url http://localhost:8001 --concurrency 1,4,16 --requests 200
+"""
+
+import os
+import json
+import time
+import random
+import argparse
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from benchmark import HashEmbeddings, generate_corpus, percentile
+
+# Load environment variables
+results_path = os.environ.get('LOADTEST_RESULTS', 'loadtest_results.json')
+
+# Default query mix: (weight, query). Document questions dominate, as in production.
+DEFAULT_QUERY_MIX = [
+    (6, "What are the rules for snow removal from sidewalks?"),
+    (6, "How tall can a fence be in a residential district?"),
+    (5, "Do I need a permit for a swimming pool?"),
+    (5, "What are the refuse collection requirements?"),
+    (4, "What penalties apply for noise violations?"),
+    (4, "How do I appeal a zoning decision?"),
+    (2, "How do I pay my water bill?"),
+    (1, "Where is borough hall?"),
+    (1, "I need a deck permit application"),
+]
+
+STUB_WORDS = ("The Borough requires the owner to obtain a permit before starting work and to "
+              "schedule an inspection with the Code Enforcement Officer within thirty days.").split()
+
+
+# Ollama stub --------------------------------------------------------------
+
+class OllamaStubHandler(BaseHTTPRequestHandler):
+    """Answers /api/generate like Ollama, timing tokens per the server's settings."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = b"Ollama is running" if self.path.rstrip('/') in ('', '/') else json.dumps(
+            {"models": [{"name": self.server.model}]}).encode()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/api/generate':
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = request.get("prompt", "")
+        num_predict = (request.get("options") or {}).get("num_predict")
+        tokens = self.server.tokens if num_predict is None else min(self.server.tokens, num_predict)
+        if not prompt:
+            tokens = 0  # keep-alive ping: load the model, generate nothing
+
+        with self.server.slots:
+            start = time.perf_counter()
+            time.sleep(self.server.latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            words = []
+            for i in range(tokens):
+                if i:
+                    time.sleep(self.server.token_interval)
+                word = STUB_WORDS[i % len(STUB_WORDS)] + " "
+                words.append(word)
+                if request.get("stream", True):
+                    self._write({"model": request.get("model"), "response": word, "done": False})
+            final = {
+                "model": request.get("model"),
+                "response": "" if request.get("stream", True) else "".join(words),
+                "done": True,
+                "prompt_eval_count": len(prompt) // 4,
+                "eval_count": tokens,
+                "eval_duration": int((time.perf_counter() - start - self.server.latency) * 1e9),
+                "total_duration": int((time.perf_counter() - start) * 1e9),
+            }
+            self._write(final)
+
+    def _write(self, message: dict):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+
+def run_ollama_stub(args):
+    server = ThreadingHTTPServer((args.host, args.port), OllamaStubHandler)
+    server.daemon_threads = True
+    server.model = args.model
+    server.tokens = args.tokens
+    server.latency = args.latency_ms / 1000
+    server.token_interval = 1.0 / args.tokens_per_second if args.tokens_per_second > 0 else 0.0
+    server.slots = threading.BoundedSemaphore(args.parallel)
+    print(f"Ollama stub on http://{args.host}:{args.port}: {args.tokens} tokens at {args.tokens_per_second}/s "
+          f"after {args.latency_ms:.0f}ms, {args.parallel} at a time")
+    server.serve_forever()
+
+
+# API server against the stubs -------------------------------------------------
+
+def run_server(args):
+    from benchmark import offline_environment
+    workdir = offline_environment(prefix='rag-loadtest-')
+    os.environ['OLLAMA_BASE_URL'] = args.ollama_url
+    os.environ['ANSWER_CACHE'] = '1' if args.answer_cache else '0'
+    os.environ['QUERY_COALESCING'] = '1' if args.coalescing else '0'
+    # Every request comes from the same client; rate limiting would cap the test
+    os.environ.setdefault('RATE_LIMIT_PER_MINUTE', '0')
+
+    import uvicorn
+    import pinecone_api
+    from pinecone_ingest import load_single_document, split_documents, build_pinecone_vectors
+    from pinecone_final_doc_processor import MockPineconeIndex
+    from retrieval_context import RetrievalContext, use_retrieval_context
+
+    corpus_dir = os.path.join(workdir, 'corpus')
+    generate_corpus(corpus_dir, args.files, args.sections, args.seed)
+    chunks = split_documents([doc for name in sorted(os.listdir(corpus_dir))
+                              for doc in load_single_document(os.path.join(corpus_dir, name))])
+    embeddings = HashEmbeddings()
+    vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+    index = MockPineconeIndex("loadtest", dimension=embeddings.dimension)
+    index.upsert(build_pinecone_vectors(chunks, vectors, [f"chunk-{i}" for i in range(len(chunks))]))
+
+    use_retrieval_context(RetrievalContext(backend='pinecone', index="loadtest").warm_up(
+        embeddings=embeddings, index=index))
+    try:
+        uvicorn.run(pinecone_api.app, host=args.host, port=args.port, log_level="warning")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Load driver -------------------------------------------------------------
+
+def load_queries(path: Optional[str]) -> List[Tuple[int, str]]:
+    """Read a query mix: one query per line, optionally prefixed with "weight<TAB>"."""
+    if not path:
+        return DEFAULT_QUERY_MIX
+    mix = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            weight, _, query = line.partition("\t")
+            mix.append((int(weight), query) if query and weight.isdigit() else (1, line))
+    return mix
+
+
+def send_query(session: requests.Session, url: str, query: str, timeout: float) -> Tuple[float, str, Optional[str]]:
+    """Return (latency seconds, outcome, intent); outcome is "ok", an HTTP status or an error class."""
+    start = time.perf_counter()
+    try:
+        response = session.post(url, json={"query": query}, timeout=timeout)
+        latency = time.perf_counter() - start
+        if response.status_code != 200:
+            return latency, str(response.status_code), None
+        return latency, "ok", response.json().get("intent")
+    except requests.RequestException as e:
+        return time.perf_counter() - start, type(e).__name__, None
+
+
+def run_level(url: str, mix: List[Tuple[int, str]], concurrency: int, total: int,
+              timeout: float, seed: int) -> Dict[str, object]:
+    """Send ``total`` requests with ``concurrency`` in flight and summarize them."""
+    rng = random.Random(seed)
+    weights, queries = zip(*mix)
+    plan = rng.choices(queries, weights=weights, k=total)
+    sessions = threading.local()
+
+    def worker(query: str):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        return send_query(sessions.session, url, query, timeout)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, plan))
+    elapsed = time.perf_counter() - start
+
+    ok = [latency for latency, outcome, _ in results if outcome == "ok"]
+    outcomes = Counter(outcome for _, outcome, _ in results)
+    by_intent: Dict[str, List[float]] = {}
+    for latency, outcome, intent in results:
+        if outcome == "ok":
+            by_intent.setdefault(intent or "unknown", []).append(latency)
+
+    def summary(latencies: List[float]) -> Dict[str, float]:
+        if not latencies:
+            return {}
+        return {f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)}
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "error_rate": round(1 - len(ok) / total, 4) if total else 0.0,
+        "outcomes": dict(outcomes),
+        "latency": summary(ok),
+        "latency_by_intent": {intent: summary(latencies) for intent, latencies in sorted(by_intent.items())},
+    }
+
+
+def run_driver(args):
+    url = args.url.rstrip('/') + args.endpoint
+    mix = load_queries(args.queries)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    report = {"url": url, "queries": len(mix), "levels": []}
+
+    print(f"{'concurrency':>11} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}  outcomes")
+    for level in levels:
+        result = run_level(url, mix, level, args.requests, args.timeout, args.seed)
+        report["levels"].append(result)
+        latency = result["latency"]
+        print(f"{level:>11} {result['throughput_rps']:>8.2f} {latency.get('p50_ms', 0):>9.1f} "
+              f"{latency.get('p95_ms', 0):>9.1f} {latency.get('p99_ms', 0):>9.1f} "
+              f"{result['error_rate']:>7.1%}  {result['outcomes']}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test /query against local Ollama and Pinecone stand-ins.')
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stub = commands.add_parser("ollama-stub", help='Serve an Ollama-compatible token streamer.')
+    stub.add_argument("--host", default="127.0.0.1")
+    stub.add_argument("--port", type=int, default=11500)
+    stub.add_argument("--model", default=os.environ.get("MODEL", "mistral"))
+    stub.add_argument("--tokens", type=int, default=120, help='Tokens per answer.')
+    stub.add_argument("--tokens-per-second", type=float, default=25.0)
+    stub.add_argument("--latency-ms", type=float, default=300.0, help='Delay before the first token.')
+    stub.add_argument("--parallel", type=int, default=1, help='Generations served at once.')
+
+    serve = commands.add_parser("serve", help='Run pinecone_api against the stubs.')
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8001)
+    serve.add_argument("--ollama-url", default="http://127.0.0.1:11500")
+    serve.add_argument("--files", type=int, default=40, help='Synthetic chapters in the index.')
+    serve.add_argument("--sections", type=int, default=30)
+    serve.add_argument("--seed", type=int, default=42)
+    serve.add_argument("--answer-cache", action='store_true', help='Keep the answer cache on.')
+    serve.add_argument("--coalescing", action='store_true', help='Keep request coalescing on.')
+
+    run = commands.add_parser("run", help='Replay a query mix and report latency and throughput.')
+    run.add_argument("--url", default="http://127.0.0.1:8001")
+    run.add_argument("--endpoint", default="/query")
+    run.add_argument("--queries", help='File with one query per line, optionally "weight<TAB>query".')
+    run.add_argument("--concurrency", default="1,4,16", help='Comma-separated concurrency levels.')
+    run.add_argument("--requests", type=int, default=100, help='Requests per concurrency level.')
+    run.add_argument("--timeout", type=float, default=300.0)
+    run.add_argument("--seed", type=int, default=42)
+    run.add_argument("--output", default=results_path)
+
+    args = parser.parse_args()
+    {"ollama-stub": run_ollama_stub, "serve": run_server, "run": run_driver}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
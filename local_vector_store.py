@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+In-process vector index for corpora that fit in RAM.
+
+LocalVectorIndex implements the subset of the Pinecone ``Index`` API used by
+this project (upsert, query, fetch, delete, describe_index_stats), so the
+ingest code and PineconeVectorStore work with it unchanged. Vectors are kept
+L2-normalized in one contiguous float32 matrix and searched exactly with a
+single matrix-vector product. For larger corpora an approximate HNSW graph
+(via the optional ``hnswlib`` package) is used instead.
+
+LocalVectorStore is the LangChain vectorstore on top of it, with the same
+interface as PineconeVectorStore.
+"""
+
+import os
+import json
+import threading
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from pinecone_langchain_adapter import PineconeVectorStore
+from vector_utils import normalize_rows, top_k_indices
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Load environment variables
+local_index_directory = os.environ.get('LOCAL_INDEX_DIRECTORY', 'local_index')
+local_index_type = os.environ.get('LOCAL_INDEX_TYPE', 'auto')
+hnsw_min_vectors = int(os.environ.get('LOCAL_INDEX_HNSW_MIN_VECTORS', 50000))
+hnsw_ef_search = int(os.environ.get('LOCAL_INDEX_HNSW_EF', 128))
+
+_hnswlib_warned = False
+
+VECTORS_FILE = 'vectors.npy'
+RECORDS_FILE = 'records.json'
+HNSW_FILE = 'hnsw.bin'
+
+
+def matches_filter(metadata: dict, filter: Optional[dict]) -> bool:
+    """Evaluate a Pinecone-style metadata filter ($eq, $ne, $in, $nin, $and, $or)."""
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == '$and':
+            if not all(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == '$or':
+            if not any(matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for op, operand in condition.items():
+            if op == '$eq' and value != operand:
+                return False
+            if op == '$ne' and value == operand:
+                return False
+            if op == '$in' and value not in operand:
+                return False
+            if op == '$nin' and value in operand:
+                return False
+    return True
+
+
+class LocalVectorIndex:
+    """Pinecone-compatible index held in memory and persisted to a directory.
+
+    Args:
+        directory: Where persist() writes the index.
+        dimension: Vector size; inferred from the first upsert if omitted.
+        index_type: ``exact``, ``hnsw`` or ``auto`` (HNSW once the index has
+            at least LOCAL_INDEX_HNSW_MIN_VECTORS vectors and hnswlib is installed).
+    """
+
+    def __init__(self, directory: str = local_index_directory, dimension: Optional[int] = None,
+                 index_type: str = local_index_type):
+        if index_type not in ('exact', 'hnsw', 'auto'):
+            raise ValueError(f"Unknown local index type '{index_type}'")
+        if index_type == 'hnsw' and hnswlib is None:
+            print("hnswlib is not installed; using exact search for the local index")
+            index_type = 'exact'
+        self.directory = directory
+        self.dimension = dimension
+        self.index_type = index_type
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._vectors = np.zeros((0, self.dimension or 0), dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+        self._ids: List[Optional[str]] = []
+        self._metadata: List[Optional[dict]] = []
+        self._rows: Dict[str, int] = {}
+        self._hnsw = None
+
+    @staticmethod
+    def exists(directory: str = local_index_directory) -> bool:
+        return os.path.exists(os.path.join(directory, RECORDS_FILE))
+
+    @classmethod
+    def load(cls, directory: str = local_index_directory, index_type: str = local_index_type) -> "LocalVectorIndex":
+        """Load a persisted index."""
+        with open(os.path.join(directory, RECORDS_FILE), 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        index = cls(directory, records.get('dimension'), index_type)
+        vectors = np.load(os.path.join(directory, VECTORS_FILE))
+        index._append(records['ids'], vectors, records['metadata'])
+
+        hnsw_path = os.path.join(directory, HNSW_FILE)
+        if index._wants_hnsw() and os.path.exists(hnsw_path):
+            try:
+                graph = hnswlib.Index(space='ip', dim=index.dimension)
+                graph.load_index(hnsw_path, max_elements=max(len(vectors), 1))
+                graph.set_ef(hnsw_ef_search)
+                index._hnsw = graph
+            except Exception as e:
+                print(f"Rebuilding unreadable HNSW graph {hnsw_path}: {e}")
+        return index
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    # Storage ------------------------------------------------------------
+
+    def _reserve(self, rows: int):
+        """Grow the matrix geometrically so repeated upserts stay amortized O(1)."""
+        needed = self._size + rows
+        if needed <= len(self._vectors):
+            return
+        capacity = max(needed, 2 * len(self._vectors), 1024)
+        vectors = np.zeros((capacity, self.dimension), dtype=np.float32)
+        vectors[:self._size] = self._vectors[:self._size]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._size] = self._alive[:self._size]
+        self._vectors = vectors
+        self._alive = alive
+
+    def _append(self, ids: List[str], vectors: np.ndarray, metadata: List[dict]) -> List[int]:
+        """Write vectors, overwriting rows of existing IDs; returns the rows written."""
+        vectors = normalize_rows(vectors)
+        if vectors.ndim != 2 or len(vectors) == 0:
+            return []
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            self._vectors = np.zeros((0, self.dimension), dtype=np.float32)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {vectors.shape[1]} does not match index dimension {self.dimension}")
+
+        self._reserve(len(ids))
+        rows = []
+        for id, vector, meta in zip(ids, vectors, metadata):
+            row = self._rows.get(id)
+            if row is None:
+                row = self._size
+                self._size += 1
+                self._ids.append(id)
+                self._metadata.append(None)
+                self._rows[id] = row
+            self._vectors[row] = vector
+            self._alive[row] = True
+            self._metadata[row] = dict(meta or {})
+            rows.append(row)
+        return rows
+
+    def _wants_hnsw(self) -> bool:
+        global _hnswlib_warned
+        if self.index_type == 'exact':
+            return False
+        wanted = self.index_type == 'hnsw' or len(self._rows) >= hnsw_min_vectors
+        if wanted and hnswlib is None:
+            if not _hnswlib_warned:
+                print(f"Warning: hnswlib is not installed; searching {len(self._rows)} vectors exactly. "
+                      f"Install hnswlib for approximate search on indexes this large.")
+                _hnswlib_warned = True
+            return False
+        return wanted
+
+    def _build_hnsw(self):
+        """Build the HNSW graph over live rows; row numbers are the graph labels."""
+        rows = np.flatnonzero(self._alive[:self._size])
+        graph = hnswlib.Index(space='ip', dim=self.dimension)
+        graph.init_index(max_elements=max(self._size, 1), ef_construction=200, M=16)
+        if len(rows):
+            graph.add_items(self._vectors[rows], rows)
+        graph.set_ef(hnsw_ef_search)
+        self._hnsw = graph
+
+    # Pinecone Index API -------------------------------------------------
+
+    def upsert(self, vectors: List[Any], namespace: Optional[str] = None, **kwargs) -> dict:
+        """Insert or replace vectors given as dicts or (id, values, metadata) tuples."""
+        ids, values, metadata = [], [], []
+        for vector in vectors:
+            if isinstance(vector, dict):
+                ids.append(vector['id'])
+                values.append(vector['values'])
+                metadata.append(vector.get('metadata') or {})
+            else:
+                ids.append(vector[0])
+                values.append(vector[1])
+                metadata.append(vector[2] if len(vector) > 2 else {})
+        with self._lock:
+            rows = self._append(ids, np.asarray(values, dtype=np.float32), metadata)
+            if self._hnsw is not None and rows:
+                if self._size > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(max(self._size, 2 * self._hnsw.get_max_elements()))
+                self._hnsw.add_items(self._vectors[rows], np.asarray(rows))
+        return {'upserted_count': len(ids)}
+
+    def delete(self, ids: Optional[List[str]] = None, delete_all: bool = False,
+               namespace: Optional[str] = None, **kwargs) -> dict:
+        with self._lock:
+            if delete_all:
+                self._reset()
+                return {}
+            for id in ids or []:
+                row = self._rows.pop(id, None)
+                if row is None:
+                    continue
+                self._alive[row] = False
+                self._ids[row] = None
+                self._metadata[row] = None
+                if self._hnsw is not None:
+                    self._hnsw.mark_deleted(row)
+        return {}
+
+    def fetch(self, ids: List[str], namespace: Optional[str] = None, **kwargs):
+        vectors = {}
+        with self._lock:
+            for id in ids:
+                row = self._rows.get(id)
+                if row is not None:
+                    vectors[id] = SimpleNamespace(id=id, values=self._vectors[row].tolist(),
+                                                  metadata=dict(self._metadata[row]))
+        return SimpleNamespace(vectors=vectors, namespace=namespace or '')
+
+    def query(self, vector: List[float], top_k: int = 10, include_metadata: bool = False,
+              include_values: bool = False, namespace: Optional[str] = None,
+              filter: Optional[dict] = None, **kwargs):
+        """Return the top_k live vectors by cosine similarity."""
+        query = normalize_rows(vector)
+        with self._lock:
+            if self._size == 0 or top_k <= 0:
+                return SimpleNamespace(matches=[], namespace=namespace or '')
+
+            if filter:
+                # Filtered queries scan only the rows that pass the filter
+                candidates = np.fromiter(
+                    (row for row in np.flatnonzero(self._alive[:self._size])
+                     if matches_filter(self._metadata[row], filter)),
+                    dtype=np.int64
+                )
+                scores = self._vectors[candidates] @ query
+                order = top_k_indices(scores, top_k)
+                rows, scores = candidates[order], scores[order]
+            elif self._wants_hnsw():
+                if self._hnsw is None:
+                    self._build_hnsw()
+                k = min(top_k, len(self._rows))
+                labels, distances = self._hnsw.knn_query(query, k=k)
+                rows, scores = labels[0].astype(np.int64), 1.0 - distances[0]
+            else:
+                scores = self._vectors[:self._size] @ query
+                scores[~self._alive[:self._size]] = -np.inf
+                order = top_k_indices(scores, min(top_k, len(self._rows)))
+                rows, scores = order, scores[order]
+
+            matches = [
+                SimpleNamespace(
+                    id=self._ids[row],
+                    score=float(score),
+                    metadata=dict(self._metadata[row]) if include_metadata else None,
+                    values=self._vectors[row].tolist() if include_values else None,
+                )
+                for row, score in zip(rows.tolist(), scores.tolist())
+            ]
+        return SimpleNamespace(matches=matches, namespace=namespace or '')
+
+    def describe_index_stats(self, **kwargs):
+        count = len(self._rows)
+        return SimpleNamespace(
+            dimension=self.dimension,
+            total_vector_count=count,
+            index_fullness=0.0,
+            namespaces={'': SimpleNamespace(vector_count=count)} if count else {},
+        )
+
+    # Persistence --------------------------------------------------------
+
+    def persist(self):
+        """Compact deleted rows and atomically write the index to its directory."""
+        with self._lock:
+            live = np.flatnonzero(self._alive[:self._size])
+            if len(live) != self._size:
+                ids = [self._ids[row] for row in live]
+                metadata = [self._metadata[row] for row in live]
+                vectors = self._vectors[live]
+                self._reset()
+                self._append(ids, vectors, metadata)
+
+            os.makedirs(self.directory, exist_ok=True)
+            vectors_tmp = os.path.join(self.directory, VECTORS_FILE + '.tmp.npy')
+            np.save(vectors_tmp, self._vectors[:self._size])
+            records_tmp = os.path.join(self.directory, RECORDS_FILE + '.tmp')
+            with open(records_tmp, 'w', encoding='utf-8') as f:
+                json.dump({'dimension': self.dimension, 'ids': self._ids, 'metadata': self._metadata}, f)
+            os.replace(vectors_tmp, os.path.join(self.directory, VECTORS_FILE))
+            os.replace(records_tmp, os.path.join(self.directory, RECORDS_FILE))
+
+            hnsw_path = os.path.join(self.directory, HNSW_FILE)
+            if self._wants_hnsw():
+                if self._hnsw is None:
+                    self._build_hnsw()
+                self._hnsw.save_index(hnsw_path)
+            elif os.path.exists(hnsw_path):
+                os.remove(hnsw_path)
+        print(f"Saved {self._size} vectors to local index {self.directory}")
+
+
+def open_local_index(directory: str = local_index_directory, dimension: Optional[int] = None) -> LocalVectorIndex:
+    """Load the local index if it has been persisted, otherwise start an empty one."""
+    if LocalVectorIndex.exists(directory):
+        return LocalVectorIndex.load(directory)
+    return LocalVectorIndex(directory, dimension)
+
+
+class LocalVectorStore(PineconeVectorStore):
+    """Drop-in replacement for PineconeVectorStore backed by a LocalVectorIndex."""
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: str = local_index_directory,
+        text_key: str = "text",
+        index: Optional[LocalVectorIndex] = None
+    ):
+        super().__init__(
+            pinecone_api_key=None,
+            index_name=persist_directory,
+            embedding=embedding,
+            text_key=text_key,
+            index=index if index is not None else open_local_index(persist_directory)
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        persist_directory: str = local_index_directory,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        """Create a LocalVectorStore from a list of texts and persist it."""
+        vectorstore = cls(embedding=embedding, persist_directory=persist_directory,
+                          text_key=kwargs.get("text_key", "text"))
+        vectorstore.add_texts(texts, metadatas, ids)
+        vectorstore.persist()
+        return vectorstore
+
+    def persist(self):
+        self.index.persist()
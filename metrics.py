@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Dependency-free Prometheus metrics for the API servers.
+
+Request handlers only update counters and histogram buckets: a lock and a
+binary search per observation. Everything else (cache statistics, scheduler
+state, ingest progress, vector counts) is read by collectors when /metrics
+is scraped, so it costs nothing between scrapes. render() produces the
+Prometheus text exposition format (version 0.0.4).
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from embedding_cache import cache_stats
+from ingest_pipeline import ingest_progress
+from llm_scheduler import scheduler
+from ollama_warmup import model_state
+from query_coalescer import coalescing_stats
+from query_executor import executor_stats
+
+# Latency buckets in seconds, from cached answers up to long generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# LLM generation speed in tokens per second
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# A collected sample: (metric name, type, help, [(labels, value), ...])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labels, key))
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing count per label set."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self._labels(key))} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Counter):
+    """A value that can go up and down per label set."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative ``le`` buckets per label set."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket counts..., +Inf count, sum]
+        self._values: Dict[tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=_format_value(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics owned by this process plus collectors evaluated at scrape time."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        """Register a function returning metric families when /metrics is scraped."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                # One failing source (e.g. the vector index) must not hide the rest
+                print(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    "rag_requests_total", "Queries answered, by routed intent, endpoint and outcome.",
+    ("intent", "endpoint", "outcome"))
+request_latency = registry.histogram(
+    "rag_request_duration_seconds", "End-to-end query latency.", ("intent", "endpoint"))
+stage_latency = registry.histogram(
+    "rag_stage_duration_seconds", "Latency of each query stage (cache, embed, retrieve, pack, llm_queue, llm).",
+    ("intent", "stage"))
+requests_in_flight = registry.gauge(
+    "rag_requests_in_flight", "Queries currently being answered.", ("intent", "endpoint"))
+llm_tokens_total = registry.counter(
+    "rag_llm_generated_tokens_total", "Tokens generated by the LLM.", ("intent",))
+llm_prompt_tokens_total = registry.counter(
+    "rag_llm_prompt_tokens_total", "Prompt tokens evaluated by the LLM.", ("intent",))
+llm_throughput = registry.histogram(
+    "rag_llm_tokens_per_second", "LLM generation speed per answer.", ("intent",), THROUGHPUT_BUCKETS)
+
+
+class track_in_flight:
+    """Count a query as in flight for the duration of a with block."""
+
+    def __init__(self, intent: str, endpoint: str):
+        self.labels = {"intent": intent, "endpoint": endpoint}
+
+    def __enter__(self):
+        requests_in_flight.inc(**self.labels)
+        return self
+
+    def __exit__(self, *exc_info):
+        requests_in_flight.dec(**self.labels)
+
+
+def observe_query(intent: str, endpoint: str, seconds: float, result: Optional[dict] = None,
+                  outcome: Optional[str] = None):
+    """Record a finished query: latency, per-stage timings and LLM usage."""
+    result = result or {}
+    if outcome is None:
+        outcome = "error" if result.get("error") else ("cached" if result.get("cached") else "ok")
+    requests_total.inc(intent=intent, endpoint=endpoint, outcome=outcome)
+    if outcome == "rejected":
+        # Turned away before any work; keep these out of the latency distribution
+        return
+    request_latency.observe(seconds, intent=intent, endpoint=endpoint)
+    for name, value in (result.get("timings") or {}).items():
+        if name != "total":
+            stage_latency.observe(value, intent=intent, stage=name)
+    usage = result.get("usage") or {}
+    if usage.get("llm_tokens"):
+        llm_tokens_total.inc(usage["llm_tokens"], intent=intent)
+        if usage.get("llm_eval_seconds"):
+            llm_throughput.observe(usage["llm_tokens"] / usage["llm_eval_seconds"], intent=intent)
+    if usage.get("llm_prompt_tokens"):
+        llm_prompt_tokens_total.inc(usage["llm_prompt_tokens"], intent=intent)
+
+
+def observe_events(intent: str, endpoint: str, events: Iterator[dict]) -> Iterator[dict]:
+    """Pass streamed query events through, recording the query when it finishes."""
+    start = time.perf_counter()
+    with track_in_flight(intent, endpoint):
+        for event in events:
+            if event.get("type") == "done":
+                observe_query(intent, endpoint, time.perf_counter() - start, event)
+            elif event.get("type") == "error":
+                observe_query(intent, endpoint, time.perf_counter() - start, outcome="error")
+            yield event
+
+
+def gauge_family(name: str, help: str, samples: List[Tuple[Dict[str, str], float]]) -> Family:
+    return (name, "gauge", help, samples)
+
+
+def counter_family(name: str, help: str, samples: List[Tuple[Dict[str, str], float]]) -> Family:
+    return (name, "counter", help, samples)
+
+
+def runtime_families() -> List[Family]:
+    """Process-wide state: LLM scheduler, executor, caches, coalescing and ingest progress."""
+    llm = scheduler.stats()
+    executor = executor_stats()
+    families = [
+        gauge_family("rag_llm_model_ready", "1 once the LLM has been warmed up.", [({}, int(model_state.ready))]),
+        gauge_family("rag_llm_running", "Generations currently running.", [({}, llm["running"])]),
+        gauge_family("rag_llm_queue_depth", "Generations waiting for a slot.", [({}, llm["queue_depth"])]),
+        counter_family("rag_llm_rejections_total", "Queries turned away by the LLM scheduler.", [
+            ({"reason": "rate_limited"}, llm["rejected_rate_limited"]),
+            ({"reason": "queue_full"}, llm["rejected_queue_full"]),
+            ({"reason": "timed_out"}, llm["timed_out"]),
+        ]),
+        gauge_family("rag_query_executor_running", "Queries running on the query executor.", [({}, executor["running"])]),
+        gauge_family("rag_query_executor_waiting", "Queries waiting for a query executor worker.", [({}, executor["waiting"])]),
+    ]
+
+    embedding = cache_stats()
+    families.append(counter_family("rag_embedding_cache_lookups_total", "Embedding cache lookups.",
+                                   [({"model": cache["model"], "result": result}, cache[result])
+                                    for cache in embedding for result in ("hits", "misses")]))
+    families.append(gauge_family("rag_embedding_cache_hit_ratio", "Embedding cache hit ratio.",
+                                 [({"model": cache["model"]}, cache["hit_ratio"]) for cache in embedding]))
+
+    coalescing = coalescing_stats()
+    families.append(counter_family("rag_coalesced_queries_total", "Queries that shared an identical in-flight query's answer.",
+                                   [({}, sum(flight["coalesced"] for flight in coalescing["single_flight"]))]))
+
+    progress = ingest_progress()
+    if progress is not None:
+        families.extend([
+            gauge_family("rag_ingest_running", "1 while an ingest is running.", [({}, int(progress["running"]))]),
+            gauge_family("rag_ingest_files", "Files in the current or last ingest.", [({}, progress["files"])]),
+            gauge_family("rag_ingest_files_loaded", "Files loaded so far by the current or last ingest.",
+                         [({}, progress["files_loaded"])]),
+            gauge_family("rag_ingest_files_failed", "Files that failed to load (and were quarantined) in the current or last ingest.",
+                         [({}, progress["files_failed"])]),
+            gauge_family("rag_ingest_loader_bytes", "Bytes loaded by the current or last ingest, by file extension.",
+                         [({"extension": extension}, entry["bytes"])
+                          for extension, entry in progress["by_extension"].items()]),
+            gauge_family("rag_ingest_loader_seconds", "Loader worker time of the current or last ingest, by file extension.",
+                         [({"extension": extension}, entry["seconds"])
+                          for extension, entry in progress["by_extension"].items()]),
+            gauge_family("rag_ingest_chunks_written", "Chunks written so far by the current or last ingest.",
+                         [({}, progress["chunks"])]),
+            gauge_family("rag_ingest_elapsed_seconds", "Duration of the current or last ingest.",
+                         [({}, progress["elapsed_seconds"])]),
+        ])
+    return families
+
+
+def answer_cache_families(cache) -> List[Family]:
+    """Answer cache lookups by result and the overall hit ratio."""
+    if cache is None:
+        return []
+    stats = cache.stats()
+    return [
+        counter_family("rag_answer_cache_lookups_total", "Answer cache lookups.", [
+            ({"result": "hit_exact"}, stats["hits_exact"]),
+            ({"result": "hit_semantic"}, stats["hits_semantic"]),
+            ({"result": "miss"}, stats["misses"]),
+        ]),
+        gauge_family("rag_answer_cache_hit_ratio", "Answer cache hit ratio.", [({}, stats["hit_ratio"])]),
+        gauge_family("rag_answer_cache_entries", "Answers held in the cache.", [({}, stats["entries"])]),
+    ]
+
+
+def index_families(stats, backend: str) -> List[Family]:
+    """Vector counts from a describe_index_stats() result."""
+    namespaces = getattr(stats, "namespaces", None) or {}
+    per_namespace = [({"backend": backend, "namespace": name or "default"},
+                      getattr(summary, "vector_count", None) or (summary.get("vector_count", 0) if isinstance(summary, dict) else 0))
+                     for name, summary in namespaces.items()]
+    return [
+        gauge_family("rag_index_vectors", "Vectors in the index.",
+                     [({"backend": backend}, getattr(stats, "total_vector_count", 0) or 0)]),
+        gauge_family("rag_index_namespace_vectors", "Vectors per index namespace.", per_namespace),
+    ]
+
+
+registry.add_collector(runtime_families)
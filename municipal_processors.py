@@ -1,25 +1,40 @@
 # Add this to your project
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import os
 
-def process_municipal_code(document):
+from code_chunker import CodeChunker
+
+# Load environment variables
+embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME', 'all-MiniLM-L6-v2')
+chunk_size = 500
+chunk_overlap = 50
+
+# Custom chunking for code documents, sized in the embedding model's tokens
+# (built on first use, since it loads the model's tokenizer)
+code_chunker = None
+
+def get_code_chunker(embeddings=None) -> CodeChunker:
+    """Chunker for the given embeddings, or for the default embedding model"""
+    global code_chunker
+    if embeddings is not None:
+        return CodeChunker.for_embeddings(embeddings, chunk_size, chunk_overlap)
+    if code_chunker is None:
+        from langchain.embeddings import HuggingFaceEmbeddings
+        from embedding_cache import CachedEmbeddings
+        embeddings = CachedEmbeddings(HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name)
+        code_chunker = CodeChunker.for_embeddings(embeddings, chunk_size, chunk_overlap)
+    return code_chunker
+
+def process_municipal_code(document, embeddings=None):
     """Special processor for municipal code documents"""
     # Extract metadata
     metadata = {
         "source": document.metadata.get("source", "Unknown"),
         "document_type": "municipal_code",
     }
-    
-    # Custom chunking for code documents
-    code_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        separators=["\nChapter ", "\nPart ", "\n§ ", "\n"]
-    )
-    
-    # Extract section information
-    for chunk in code_splitter.split_documents([document]):
-        # Extract section headings
-        heading = extract_heading(chunk.page_content)
-        chunk.metadata = {**metadata, "section_heading": heading}
-        
-    return chunks
\ No newline at end of file
+
+    # Chunks carry their Chapter/Part/§ path and offsets
+    chunks = get_code_chunker(embeddings).split_documents([document])
+    for chunk in chunks:
+        chunk.metadata = {**chunk.metadata, **metadata}
+
+    return chunks
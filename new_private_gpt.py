@@ -3,10 +3,16 @@ from langchain.chains import RetrievalQA
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.vectorstores import Chroma
-from langchain.llms import Ollama
 import os
 import time
 from constants import CHROMA_SETTINGS
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache, cached_answer, file_version, answer_cache_enabled, normalize_query
+from query_coalescer import new_single_flight, coalesce, batch_query_embeddings
+from ingest import manifest_path
+from query_stream import stream_answer
+from llm_scheduler import ScheduledOllama
+from query_timing import stage, timed_answer, timed_events
 
 # Global configuration
 model = os.environ.get("MODEL", "mistral")
@@ -16,15 +22,35 @@ target_source_chunks = int(os.environ.get("TARGET_SOURCE_CHUNKS", 4))
 
 # Global QA chain instance
 qa_chain = None
+embeddings = None
+
+def embed_query(query: str):
+    """Embed a query with the QA chain's embedding model."""
+    if qa_chain is None:
+        create_qa_chain()
+    return embeddings.embed_query(query)
+
+# Answers are cached until the ingest manifest changes
+answer_cache = AnswerCache(
+    embed_fn=embed_query,
+    version_fn=file_version(manifest_path)
+) if answer_cache_enabled else None
+
+# Identical concurrent queries share one computation
+single_flight = new_single_flight()
 
 def create_qa_chain(hide_source: bool = False, mute_stream: bool = False):
     """Initializes and returns the QA chain for processing queries."""
-    global qa_chain
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+    global qa_chain, embeddings
+    if embeddings is None:
+        # Concurrent queries share batched model.encode calls
+        embeddings = batch_query_embeddings(
+            CachedEmbeddings(HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name)
+        )
     db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
     retriever = db.as_retriever(search_kwargs={"k": target_source_chunks})
     callbacks = [] if mute_stream else [StreamingStdOutCallbackHandler()]
-    llm = Ollama(model=model, callbacks=callbacks)
+    llm = ScheduledOllama(model=model, callbacks=callbacks)
     qa_chain = RetrievalQA.from_chain_type(
         llm=llm,
         chain_type="stuff",
@@ -36,8 +62,17 @@ def create_qa_chain(hide_source: bool = False, mute_stream: bool = False):
 def process_query(query: str):
     """
     Processes a query string using the QA chain and returns a dictionary
-    with the answer, source documents, and processing time.
+    with the answer, source documents, and processing time. Repeated and
+    near-identical questions are answered from the answer cache, and
+    identical concurrent ones share a single computation.
     """
+    if not query or not isinstance(query, str):
+        return answer_query(query or "")
+    return timed_answer(query, lambda: coalesce(single_flight, normalize_query(query),
+                                                lambda: cached_answer(answer_cache, query, answer_query)))
+
+def answer_query(query: str):
+    """Answer a query with retrieval and the LLM, bypassing the answer cache."""
     global qa_chain
     if qa_chain is None:
         # Initialize with default settings if not already done.
@@ -50,6 +85,22 @@ def process_query(query: str):
     res["processing_time"] = end - start
     return res
 
+def stream_query(query: str):
+    """Yield source documents, then answer tokens, then a timing record (see query_stream)."""
+    global qa_chain
+    if qa_chain is None:
+        qa_chain = create_qa_chain()
+    
+    def retrieve(query):
+        with stage("retrieve"):
+            return qa_chain.retriever.get_relevant_documents(query), {}
+    
+    def generate(documents, query, callbacks=None):
+        return qa_chain.combine_documents_chain.run(input_documents=documents, question=query, callbacks=callbacks)
+    
+    query = query.strip()
+    return timed_events(query, lambda: stream_answer(query, retrieve, generate, cache=answer_cache))
+
 def main():
     import argparse
     parser = argparse.ArgumentParser(
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Keep the Ollama model loaded and hot.
+
+Ollama loads a model on its first request and unloads it after a period of
+inactivity, so the first query after a deploy or a quiet spell pays the full
+load time. At startup the API servers send a one-token warm-up generation,
+then a background thread pings the model periodically with the configured
+keep-alive so it stays resident. Queries use the same ``num_ctx``; a
+different context size would make Ollama reload the model.
+"""
+
+import os
+import time
+import threading
+from typing import Optional
+
+import requests
+
+# Load environment variables
+model = os.environ.get("MODEL", "mistral")
+ollama_base_url = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+ollama_keep_alive = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+ollama_num_ctx = int(os.environ.get('OLLAMA_NUM_CTX', 4096))
+keep_alive_interval = float(os.environ.get('OLLAMA_KEEPALIVE_INTERVAL', 240))
+warmup_timeout = float(os.environ.get('OLLAMA_WARMUP_TIMEOUT', 300))
+
+
+class ModelState:
+    """Whether the model is loaded, and how long loading it took."""
+
+    def __init__(self):
+        self.ready = False
+        self.warmup_time: Optional[float] = None
+        self.last_keep_alive: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "model": model,
+            "ready": self.ready,
+            "warmup_time": self.warmup_time,
+            "last_keep_alive": self.last_keep_alive,
+            "keep_alive": ollama_keep_alive,
+            "num_ctx": ollama_num_ctx,
+            "error": self.error,
+        }
+
+
+model_state = ModelState()
+_keep_alive_thread = None
+_keep_alive_lock = threading.Lock()
+
+
+def _generate(prompt: str, num_predict: Optional[int] = None, timeout: float = warmup_timeout):
+    options = {"num_ctx": ollama_num_ctx}
+    if num_predict is not None:
+        options["num_predict"] = num_predict
+    response = requests.post(
+        f"{ollama_base_url}/api/generate",
+        json={"model": model, "prompt": prompt, "stream": False,
+              "keep_alive": ollama_keep_alive, "options": options},
+        timeout=timeout,
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"Ollama returned {response.status_code}: {response.text[:200]}")
+
+
+def warm_up_model() -> bool:
+    """Load the model and run a one-token generation; returns True when it is hot."""
+    start = time.time()
+    try:
+        _generate("Hello", num_predict=1)
+    except Exception as e:
+        model_state.ready = False
+        model_state.error = str(e)
+        print(f"Ollama warm-up failed for '{model}': {e}")
+        return False
+    model_state.warmup_time = time.time() - start
+    model_state.last_keep_alive = time.time()
+    model_state.ready = True
+    model_state.error = None
+    print(f"Ollama model '{model}' warmed up in {model_state.warmup_time:.2f}s "
+          f"(keep_alive={ollama_keep_alive}, num_ctx={ollama_num_ctx})")
+    return True
+
+
+def _keep_alive_loop(stop: threading.Event):
+    while not stop.wait(keep_alive_interval):
+        if not model_state.ready:
+            # Never came up, or was lost: try a full warm-up again
+            warm_up_model()
+            continue
+        try:
+            # An empty prompt loads the model (if needed) without generating
+            _generate("", timeout=warmup_timeout)
+            model_state.last_keep_alive = time.time()
+        except Exception as e:
+            model_state.ready = False
+            model_state.error = str(e)
+            print(f"Ollama keep-alive failed for '{model}': {e}")
+
+
+def start_keep_alive() -> threading.Event:
+    """Start the background keep-alive thread once; set the returned event to stop it."""
+    global _keep_alive_thread
+    with _keep_alive_lock:
+        if _keep_alive_thread is None:
+            stop = threading.Event()
+            _keep_alive_thread = (threading.Thread(target=_keep_alive_loop, args=(stop,),
+                                                   daemon=True, name='ollama-keep-alive'), stop)
+            _keep_alive_thread[0].start()
+        return _keep_alive_thread[1]
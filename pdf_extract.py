@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Cached, page-parallel PDF text extraction.
+
+Page text is extracted with PyMuPDF and stored in a SQLite database keyed by
+the file's content hash and page number, so an unchanged PDF is never parsed
+twice, even if it is renamed or touched. Large PDFs are split into page
+ranges (``plan_load_tasks``) which the ingest loader pool extracts in
+parallel; IngestPipeline reassembles the pages in order before splitting.
+
+Documents carry the same metadata as LangChain's PyMuPDFLoader (source,
+file_path, page, total_pages and the PDF's string/int metadata), so chunks
+and IDs do not change when a file comes from the cache.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from langchain.docstore.document import Document
+
+from ingest_manifest import file_hash
+
+# Load environment variables
+page_cache_enabled = os.environ.get('PDF_PAGE_CACHE', '1').lower() not in ('0', 'false', 'no', 'off')
+page_cache_path = os.environ.get('PDF_PAGE_CACHE_PATH', 'pdf_page_cache.sqlite')
+pages_per_task = int(os.environ.get('PDF_PAGES_PER_TASK', 50))
+parallel_min_pages = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 100))
+
+
+class PageRange(NamedTuple):
+    """Pages [start, end) of one PDF: a unit of work for the loader pool."""
+    file_path: str
+    start: int
+    end: int
+    content_hash: str
+
+
+class PageCache:
+    """SQLite store of extracted page text and per-file PDF metadata.
+
+    Safe to share between the loader processes: each process (and thread)
+    opens its own connection, and WAL mode lets readers run beside a writer.
+    """
+
+    def __init__(self, path: str = page_cache_path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so they are keyed by process too
+        if getattr(self._local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS files "
+                               "(hash TEXT PRIMARY KEY, pages INTEGER NOT NULL, metadata TEXT NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS pages "
+                               "(hash TEXT NOT NULL, page INTEGER NOT NULL, text TEXT NOT NULL, PRIMARY KEY (hash, page))")
+            connection.commit()
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def file_info(self, content_hash: str) -> Optional[Tuple[int, dict]]:
+        row = self._connection().execute(
+            "SELECT pages, metadata FROM files WHERE hash = ?", (content_hash,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def put_file(self, content_hash: str, pages: int, metadata: dict):
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                               (content_hash, pages, json.dumps(metadata)))
+
+    def get_pages(self, content_hash: str, start: int, end: int) -> Dict[int, str]:
+        rows = self._connection().execute(
+            "SELECT page, text FROM pages WHERE hash = ? AND page >= ? AND page < ?", (content_hash, start, end))
+        return dict(rows.fetchall())
+
+    def put_pages(self, content_hash: str, pages: List[Tuple[int, str]]):
+        connection = self._connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                                   [(content_hash, page, text) for page, text in pages])
+
+    def stats(self) -> dict:
+        connection = self._connection()
+        return {
+            "path": self.path,
+            "files": connection.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+            "pages": connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0],
+        }
+
+
+page_cache = PageCache() if page_cache_enabled else None
+
+
+def pdf_info(file_path: str, content_hash: str) -> Tuple[int, dict]:
+    """Page count and document metadata of a PDF, from the cache when possible."""
+    cached = page_cache.file_info(content_hash) if page_cache is not None else None
+    if cached is not None:
+        return cached
+    import fitz
+    with fitz.open(file_path) as pdf:
+        pages = len(pdf)
+        metadata = {key: value for key, value in (pdf.metadata or {}).items() if type(value) in (str, int)}
+    if page_cache is not None:
+        page_cache.put_file(content_hash, pages, metadata)
+    return pages, metadata
+
+
+def extract_pages(file_path: str, start: int = 0, end: Optional[int] = None,
+                  content_hash: Optional[str] = None) -> List[Document]:
+    """One Document per page in [start, end), parsing only pages missing from the cache."""
+    content_hash = content_hash or file_hash(file_path)
+    total_pages, pdf_metadata = pdf_info(file_path, content_hash)
+    end = total_pages if end is None else min(end, total_pages)
+
+    texts = page_cache.get_pages(content_hash, start, end) if page_cache is not None else {}
+    missing = [page for page in range(start, end) if page not in texts]
+    if missing:
+        import fitz
+        with fitz.open(file_path) as pdf:
+            extracted = [(page, pdf[page].get_text()) for page in missing]
+        texts.update(extracted)
+        if page_cache is not None:
+            page_cache.put_pages(content_hash, extracted)
+
+    return [
+        Document(
+            page_content=texts[page],
+            metadata=dict({"source": file_path, "file_path": file_path, "page": page, "total_pages": total_pages},
+                          **pdf_metadata)
+        )
+        for page in range(start, end)
+    ]
+
+
+def load_page_range(task: PageRange) -> List[Document]:
+    """Extract one page range; the loader pool's work function for PDFs."""
+    return extract_pages(task.file_path, task.start, task.end, task.content_hash)
+
+
+def plan_load_tasks(file_path: str) -> List[Any]:
+    """Loader pool tasks for a file: the path itself, or page ranges of a PDF.
+
+    PDFs with at least PDF_PARALLEL_MIN_PAGES pages are split into ranges of
+    PDF_PAGES_PER_TASK pages so several workers share them. The content hash
+    is computed once here and carried by every range.
+    """
+    if not file_path.endswith('.pdf'):
+        return [file_path]
+    try:
+        content_hash = file_hash(file_path)
+        total_pages, _ = pdf_info(file_path, content_hash)
+    except Exception:
+        # Let the loader report the failure for this file
+        return [file_path]
+    step = pages_per_task if total_pages >= parallel_min_pages else max(total_pages, 1)
+    return [PageRange(file_path, start, min(start + step, total_pages), content_hash)
+            for start in range(0, max(total_pages, 1), step)]
+
+
+class CachedPDFLoader:
+    """Drop-in replacement for PyMuPDFLoader in LOADER_MAPPING that reads through the page cache."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def load(self) -> List[Document]:
+        return extract_pages(self.file_path)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File
+from fastapi import FastAPI, HTTPException, Body, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import uvicorn
@@ -8,14 +9,24 @@ import os
 import sys
 import shutil
 import random
+import time
 from datetime import datetime
-from typing import List, Optional
-from fastapi.responses import FileResponse
-from pinecone import Pinecone
+from typing import Dict, List, Optional
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from llm_scheduler import scheduler, client_id, SchedulerRejected
+from ollama_warmup import warm_up_model, start_keep_alive, model_state
+from context_packer import get_tokenizer
+from intent_router import IntentRouter, PhraseMatcher, DEFAULT_INTENT
+from metrics import (
+    registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE, observe_query, observe_events,
+    track_in_flight, answer_cache_families, index_families
+)
 
 class QueryRequest(BaseModel):
     query: str
+    chapter: Optional[str] = None  # restrict retrieval to one chapter, e.g. "27"
 
 class Document(BaseModel):
     content: str
@@ -26,6 +37,9 @@ class QueryResponse(BaseModel):
     source_documents: Optional[List[Document]] = None
     processing_time: Optional[float] = None
     map_data: Optional[dict] = None  # Add this line
+    intent: Optional[str] = None
+    intent_confidence: Optional[float] = None
+    timings: Optional[Dict[str, float]] = None  # Seconds per stage (embed, retrieve, pack, llm, ...)
 
 class IngestResponse(BaseModel):
     status: str
@@ -51,6 +65,30 @@ FORM_KEYWORDS = [
     "home improvement", "how to apply", "permit application"
 ]
 
+# Payment-related keywords to detect water bill payment queries
+PAYMENT_KEYWORDS = [
+    "pay water bill", "water bill payment", "pay my water",
+    "how do i pay my water", "pay utility bill", "water payment"
+]
+
+# Example questions per intent, used to route paraphrases that contain none of the keywords
+INTENT_EXEMPLARS = {
+    "payment": [
+        "I want to pay my water bill online",
+        "How can I settle my utility invoice?",
+        "Where do I make a payment for my water and sewer account?",
+    ],
+    "form": [
+        "I need the application to build a deck in my backyard",
+        "Can I get the paperwork for adding a patio?",
+    ],
+    "map": [
+        "Show me a map of the borough",
+        "Where is Borough Hall located?",
+        "Which zoning district is my property in?",
+    ],
+}
+
 # Mapping of form types to their details
 FORM_MAPPINGS = {
     "deck": {
@@ -66,34 +104,24 @@ FORM_MAPPINGS = {
    
 }
 
-def is_form_query(query: str) -> bool:
-    """
-    Check if the query is asking for permit form information.
-    """
-    query_lower = query.lower()
-    return any(keyword in query_lower for keyword in FORM_KEYWORDS)
+form_type_matcher = PhraseMatcher(FORM_MAPPINGS)
 
-def get_form_type(query: str) -> dict:
+def get_form_type(query: str) -> Optional[dict]:
     """
     Determine which specific form the user is asking about.
-    Returns form details if a match is found.
+    Returns form details if a match is found, otherwise None.
     """
-    query_lower = query.lower()
-    
-    # First check for specific form types
-    for form_type, details in FORM_MAPPINGS.items():
-        if form_type in query_lower:
-            return details
-    
-    # If no specific form type is mentioned, default to building permit
-    # since it's the most general form
-    return FORM_MAPPINGS["building"]
+    form_type = form_type_matcher.first(query)
+    return FORM_MAPPINGS[form_type] if form_type else None
 
-def generate_form_response(query: str) -> dict:
+def generate_form_response(query: str) -> Optional[dict]:
     """
     Generate a response for form-related queries.
+    Returns None when no online form matches, so the query is answered from the documents.
     """
     form_details = get_form_type(query)
+    if form_details is None:
+        return None
     
     # Create contextual message based on the query and form type
     message = f"Here's the {form_details['title']} you requested. You can fill it out directly or download it for submission to the Borough offices."
@@ -128,23 +156,21 @@ LOCATION_MAPPINGS = {
     "permits": {"lat": 40.1308, "lng": -75.5146, "zoom": 15, "layer": "permits"}
 }
 
-def is_map_query(query: str) -> bool:
-    """
-    Check if the query is asking for map-related information.
-    """
-    query_lower = query.lower()
-    return any(keyword in query_lower for keyword in MAP_KEYWORDS)
+# Named places that get their own map message
+MAP_PLACES = ["borough hall", "police", "fire", "library", "reeves park", "black rock"]
+
+location_matcher = PhraseMatcher(LOCATION_MAPPINGS)
+place_matcher = PhraseMatcher(MAP_PLACES)
 
 def get_location_focus(query: str) -> dict:
     """
     Determine if the query is focusing on a specific location.
     Returns map coordinates if a match is found.
     """
-    query_lower = query.lower()
-    
-    for location, coords in LOCATION_MAPPINGS.items():
-        if location in query_lower:
-            return coords
+    location = location_matcher.first(query)
+    if location:
+        # Copy so the layer override below never changes the mapping itself
+        return dict(LOCATION_MAPPINGS[location])
     
     # Default to center of Phoenixville
     return {"lat": 40.1308, "lng": -75.5146, "zoom": 14, "layer": "locations"}
@@ -165,8 +191,8 @@ def generate_map_response(query: str) -> dict:
     elif "permit" in query.lower():
         message = "Here's a map showing recent permits issued in Phoenixville Borough. Click on the markers for details about each permit."
         location_focus["layer"] = "permits"
-    elif any(place in query.lower() for place in ["borough hall", "police", "fire", "library", "reeves park", "black rock"]):
-        place = next((place for place in ["borough hall", "police", "fire", "library", "reeves park", "black rock"] if place in query.lower()), "")
+    elif place_matcher.first(query):
+        place = place_matcher.first(query)
         message = f"Here's the location of {place.title()} in Phoenixville Borough. You can click on the marker for more details."
     else:
         message = "Here's an interactive map of Phoenixville Borough. You can toggle between different map layers using the controls below the map."
@@ -189,30 +215,67 @@ def generate_map_response(query: str) -> dict:
 # First create the FastAPI app instance
 app = FastAPI(title="Phoenixville Municipal AI")
 
-@app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest = Body(...)):
-    if not request.query:
-        raise HTTPException(status_code=400, detail="Query cannot be empty")
-    
-    # Check if this is a payment-related query
-    payment_keywords = ["pay water bill", "water bill payment", "pay my water", 
-                      "how do i pay my water", "pay utility bill", "water payment"]
+def embed_intent_text(text: str) -> List[float]:
+    """Embed with the retrieval embeddings, so the query vector is cached for the search."""
+    return get_retrieval_context().query_embeddings.embed_query(text)
+
+# Payment, form and map queries are deterministic; everything else goes to the LLM
+intent_router = IntentRouter(
+    {"payment": PAYMENT_KEYWORDS, "form": FORM_KEYWORDS, "map": MAP_KEYWORDS},
+    exemplars=INTENT_EXEMPLARS,
+    embed_fn=embed_intent_text,
+)
+
+def special_query_response(query: str, route=None):
+    """Return the route and the canned response for payment, form and map queries.
+
+    The response is None for document queries. A special intent with no
+    canned answer (a form query naming no known form) is re-routed to rag.
+    """
+    route = route or intent_router.route(query)
+    response = None
     
-    # If the query contains payment keywords, return the payment portal indicator
-    if any(keyword in request.query.lower() for keyword in payment_keywords):
-        return {
+    # If the query is about paying a bill, return the payment portal indicator
+    if route.intent == "payment":
+        response = {
             "result": "<payment_portal>I can help you pay your water bill right here. Please use the secure payment form below:</payment_portal>",
             "processing_time": 0.1,
             "source_documents": []
         }
+    elif route.intent == "form":
+        response = generate_form_response(query)
+    elif route.intent == "map":
+        response = generate_map_response(query)
     
-    # Check if this is a form-related query
-    if is_form_query(request.query):
-        return generate_form_response(request.query)
+    if response is not None:
+        response["intent"] = route.intent
+        response["intent_confidence"] = route.confidence
+    elif route.intent != DEFAULT_INTENT:
+        route = intent_router.fall_back(route)
+    return route, response
+
+@app.exception_handler(SchedulerRejected)
+async def scheduler_rejected(http_request: Request, exc: SchedulerRejected):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+def admit(http_request: Request):
+    """Rate-limit and queue-limit a query before doing any work."""
+    host = http_request.client.host if http_request.client else None
+    return scheduler.admit(client_id(http_request.headers, host))
+
+@app.post("/query", response_model=QueryResponse)
+async def query(http_request: Request, request: QueryRequest = Body(...)):
+    if not request.query:
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
     
-    # Check if this is a map-related query
-    if is_map_query(request.query):
-        return generate_map_response(request.query)
+    # Payment, form and map queries are answered without the LLM
+    start = time.perf_counter()
+    route = await run_in_threadpool(intent_router.route, request.query)
+    route, special = special_query_response(request.query, route)
+    if special is not None:
+        observe_query(route.intent, "query", time.perf_counter() - start)
+        return special
     
     try:
         # Sanitize the query
@@ -220,12 +283,18 @@ async def query(request: QueryRequest = Body(...)):
         if not clean_query:
             raise HTTPException(status_code=400, detail="Query cannot be empty")
             
-        result = process_query(clean_query)
+        # Run the blocking query on the bounded pool so the event loop stays free
+        with admit(http_request), track_in_flight(route.intent, "query"):
+            result = await run_query(process_query, clean_query, request.chapter)
+        observe_query(route.intent, "query", time.perf_counter() - start, result)
         
         # Format the response with better error handling
         response = {
             "result": str(result.get("result", "An error occurred during processing.")),
-            "processing_time": result.get("processing_time", 0)
+            "processing_time": result.get("processing_time", 0),
+            "timings": result.get("timings"),
+            "intent": route.intent,
+            "intent_confidence": route.confidence
         }
         
         # Include source documents if available
@@ -242,7 +311,11 @@ async def query(request: QueryRequest = Body(...)):
         
         return response
     
+    except SchedulerRejected:
+        observe_query(route.intent, "query", time.perf_counter() - start, outcome="rejected")
+        raise
     except Exception as e:
+        observe_query(route.intent, "query", time.perf_counter() - start, outcome="error")
         import traceback
         print(f"Error in query endpoint: {e}")
         print(traceback.format_exc())
@@ -253,6 +326,44 @@ async def query(request: QueryRequest = Body(...)):
             "source_documents": []
         }
 
+@app.post("/query/stream")
+async def query_stream(http_request: Request, request: QueryRequest = Body(...)):
+    """Stream the answer as NDJSON: sources, then tokens, then a timing record."""
+    if not request.query or not request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    
+    start = time.perf_counter()
+    route = await run_in_threadpool(intent_router.route, request.query)
+    route, special = special_query_response(request.query, route)
+    if special is not None:
+        observe_query(route.intent, "stream", time.perf_counter() - start)
+        events = iter([
+            {"type": "sources", "source_documents": special.get("source_documents", []), "retrieval_time": 0.0},
+            {"type": "token", "token": special["result"]},
+            dict(special, type="done"),
+        ])
+        return StreamingResponse(ndjson(events), media_type="application/x-ndjson")
+    
+    try:
+        admission = admit(http_request)
+    except SchedulerRejected:
+        observe_query(route.intent, "stream", time.perf_counter() - start, outcome="rejected")
+        raise
+    
+    async def events():
+        try:
+            async for line in stream_query_events(
+                    lambda: ndjson(observe_events(route.intent, "stream", stream_query(request.query, request.chapter)))):
+                yield line
+        finally:
+            admission.release()
+    
+    # A client that disconnects before the first chunk cancels the response
+    # before events() starts, so its finally never runs; the background task
+    # runs either way (release() is idempotent)
+    return StreamingResponse(events(), media_type="application/x-ndjson",
+                             background=BackgroundTask(admission.release))
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -292,14 +403,29 @@ async def simulate_payment(request: PaymentRequest):
 # Import your privateGPT modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
-    from pinecone_new_private_gpt import create_qa_chain, process_query
-    from pinecone_ingest import process_documents, initialize_pinecone, does_index_exist
-    from langchain.embeddings import HuggingFaceEmbeddings
-    # Import our custom embeddings adapter
-    from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings
+    from pinecone_new_private_gpt import create_qa_chain, process_query, stream_query, answer_cache
+    from query_stream import ndjson
+    from query_executor import run_query, stream_query_events, executor_stats
+    from query_coalescer import coalescing_stats
+    from pinecone_ingest import process_documents, initialize_pinecone, does_index_exist, ingest_incremental
+    from retrieval_context import (
+        get_embeddings, get_retrieval_context, init_retrieval_context,
+        refresh_retrieval_context, current_retrieval_context, IndexNotFoundError
+    )
+    from embedding_cache import cache_stats
 except ImportError as e:
     print(f"Warning: Could not import some modules: {e}")
 
+def vector_index_families():
+    """Vector counts for /metrics, once the retrieval context exists."""
+    context = current_retrieval_context()
+    if context is None:
+        return []
+    return index_families(context.describe_index_stats(), context.backend)
+
+metrics_registry.add_collector(lambda: answer_cache_families(answer_cache))
+metrics_registry.add_collector(vector_index_families)
+
 @app.get("/")
 async def root():
     return FileResponse("static/modern-index.html")
@@ -312,28 +438,30 @@ index_name = os.environ.get('PINECONE_INDEX_NAME', 'phoenixville-municipal-code'
 # Initialize the QA chain on startup
 @app.on_event("startup")
 async def startup_event():
+    # Load the LLM before accepting traffic, then keep it resident
+    await run_in_threadpool(warm_up_model)
+    start_keep_alive()
+    
+    # Load the context packer's tokenizer now rather than on the first query
+    await run_in_threadpool(get_tokenizer)
+    
+    # Warm the shared retrieval context once; a missing index is fatal
     try:
-        # Initialize Pinecone
-        pc = Pinecone(api_key=pinecone_api_key)
-        
-        # Check if the index exists
-        indexes = pc.list_indexes()
-        index_exists = index_name in indexes.names()
-        
-        # If index exists, try to create QA chain
-        if index_exists:
-            print(f"Initializing QA chain with existing Pinecone index: {index_name}")
-            try:
-                create_qa_chain()
-                print("QA chain initialized with Pinecone vectorstore")
-            except Exception as e:
-                print(f"Error initializing QA chain: {e}")
-                print("You can still use the API, but you'll need to ingest documents first")
-        else:
-            print(f"Pinecone index '{index_name}' does not exist. Upload documents to create it.")
+        context = init_retrieval_context()
+    except IndexNotFoundError as e:
+        print(f"{e}. Run pinecone_ingest.py to create it before starting the API.")
+        raise
     except Exception as e:
         print(f"Error during startup: {e}")
-        print("Application will start, but you may need to create a Pinecone index first")
+        print("Application will start, but retrieval will be initialized on the first query")
+        return
+    
+    print(f"Initializing QA chain with existing {context.backend} index: {context.index_name}")
+    try:
+        create_qa_chain()
+        print(f"QA chain initialized (retrieval warm-up took {context.warmup_time:.2f}s)")
+    except Exception as e:
+        print(f"Error initializing QA chain: {e}")
 
 # Models for request/response
 
@@ -374,45 +502,19 @@ async def upload_documents(files: List[UploadFile] = File(...)):
 @app.post("/ingest", response_model=IngestResponse)
 async def ingest():
     try:
-        # Process documents from your source directory
-        texts = process_documents()
-        if not texts:
-            return {
-                "status": "no_documents",
-                "documents_processed": 0
-            }
-        
-        # Create embeddings using the specified model
-        print("Creating embeddings...")
-        try:
-            # Try using our custom embeddings adapter for 1024 dimensions
-            embeddings = CustomHuggingFaceEmbeddings()
-            print("Using custom 1024-dimensional embeddings compatible with llama-text-embed-v2")
-        except Exception as e:
-            # Fall back to standard embeddings if there's any issue
-            print(f"Error with custom embeddings: {e}")
-            embeddings = HuggingFaceEmbeddings(
-                model_name=os.environ.get("EMBEDDINGS_MODEL_NAME", "all-MiniLM-L6-v2")
-            )
-            print(f"Using standard embeddings")
-        
-        # Initialize or get existing Pinecone index
-        pc = Pinecone(api_key=pinecone_api_key)
-        index = initialize_pinecone()
+        # Reuse the process-wide embedding model instead of loading a new one
+        embeddings = get_embeddings()
         
-        # We'll use our custom function to add vectors directly to Pinecone
-        # This is imported from pinecone_ingest.py
-        from pinecone_ingest import add_embeddings_to_pinecone
-        add_embeddings_to_pinecone(texts, embeddings)
+        # Only new or changed files are embedded; stale vectors are removed
+        chunks_added = await run_in_threadpool(ingest_incremental, embeddings)
         
-        print("Vectors added to Pinecone successfully!")
-        
-        # Reinitialize the QA chain to use the updated vectorstore
+        # Pick up the updated index and rebuild the QA chain around it
+        await run_in_threadpool(refresh_retrieval_context)
         create_qa_chain()
         
         return {
-            "status": "success",
-            "documents_processed": len(texts)
+            "status": "success" if chunks_added else "no_documents",
+            "documents_processed": chunks_added
         }
     
     except Exception as e:
@@ -438,24 +540,39 @@ async def analyze_documents():
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics in the text exposition format."""
+    # Collectors query the index and caches, so render off the event loop
+    body = await run_in_threadpool(metrics_registry.render)
+    return Response(content=body, media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 only once the LLM has been warmed up."""
+    if not model_state.ready:
+        return JSONResponse(status_code=503, content={"ready": False, "llm": model_state.to_dict()})
+    return {"ready": True, "llm": model_state.to_dict()}
+
 @app.get("/status")
 async def status():
-    # Initialize Pinecone
+    # Reuse the warmed retrieval context rather than creating a new client;
+    # a cold one is built off the event loop
     try:
-        pc = Pinecone(api_key=pinecone_api_key)
-        
-        # Check if the index exists
-        indexes = pc.list_indexes()
-        index_exists = index_name in indexes.names()
-        
-        # If index exists, get stats
-        stats = None
-        if index_exists:
-            index = pc.Index(index_name)
-            stats = index.describe_index_stats()
+        context = await run_in_threadpool(get_retrieval_context)
+        stats = await run_in_threadpool(context.describe_index_stats)
             
         return {
-            "database_initialized": index_exists,
+            "database_initialized": True,
+            "llm": model_state.to_dict(),
+            "vector_backend": context.backend,
+            "retrieval_warmup_time": context.warmup_time,
+            "embedding_cache": cache_stats(),
+            "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+            "query_executor": executor_stats(),
+            "coalescing": coalescing_stats(),
+            "llm_scheduler": scheduler.stats(),
+            "intent_router": intent_router.stats(),
             "model": os.environ.get("MODEL", "mistral"),
             "embeddings_model": os.environ.get("EMBEDDINGS_MODEL_NAME", "llama-text-embed-v2"),
             "vector_count": stats.total_vector_count if stats else 0,
@@ -2,6 +2,7 @@ import os
 import numpy as np
 from sentence_transformers import SentenceTransformer
 from pinecone import Pinecone
+from lanchain_pinecone_adapter import DEFAULT_TARGET_DIM
 
 # Load environment variables
 pinecone_api_key = os.environ.get('PINECONE_API_KEY', 'pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e')
@@ -17,8 +18,8 @@ def initialize_embedding_model():
     
     return model
 
-def padded_embedding(model, text, target_dim=1024):
-    """Create an embedding and pad it to the target dimension"""
+def padded_embedding(model, text, target_dim=DEFAULT_TARGET_DIM):
+    """Create an embedding and pad it to the target dimension (None keeps the native size)"""
     # Get the original embedding
     original_embedding = model.encode(text)
     original_dim = len(original_embedding)
@@ -26,8 +27,8 @@ def padded_embedding(model, text, target_dim=1024):
     # Print the original dimension
     print(f"Original embedding dimension: {original_dim}")
     
-    # If already at target dimension, return as is
-    if original_dim == target_dim:
+    # If native mode or already at target dimension, return as is
+    if target_dim is None or original_dim == target_dim:
         return original_embedding
     
     # If smaller than target, pad with zeros
@@ -55,16 +56,17 @@ def test_embedding_model():
     text = "This is a test document to check embedding dimensions."
     
     # Get padded embedding vector
-    embedding = padded_embedding(model, text, target_dim=1024)
+    embedding = padded_embedding(model, text)
+    expected_dim = DEFAULT_TARGET_DIM or model.get_sentence_embedding_dimension()
     
     # Print the dimension
     print(f"Final embedding dimension: {len(embedding)}")
     
     # Confirm if it matches what we need for Pinecone
-    if len(embedding) == 1024:
-        print("✅ Embedding dimension matches Pinecone index requirement (1024)")
+    if len(embedding) == expected_dim:
+        print(f"✅ Embedding dimension matches Pinecone index requirement ({expected_dim})")
     else:
-        print(f"❌ Embedding dimension ({len(embedding)}) does not match Pinecone requirement (1024)")
+        print(f"❌ Embedding dimension ({len(embedding)}) does not match Pinecone requirement ({expected_dim})")
     
     return embedding
 
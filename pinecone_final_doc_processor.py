@@ -4,6 +4,8 @@ import re
 from typing import List, Dict, Any, Optional
 import numpy as np
 from datetime import datetime
+from types import SimpleNamespace
+from local_vector_store import LocalVectorIndex
 
 # Step 1: Document Text Extraction and Processing
 class DocumentProcessor:
@@ -219,23 +221,43 @@ class PineconeClient:
             # Mock implementation:
             index.upsert(vectors)
 
-class MockPineconeIndex:
-    """Mock Pinecone index for demonstration purposes only"""
+class _MockResult(SimpleNamespace):
+    """Query result readable both as attributes (like the Pinecone client) and as a dict"""
     
-    def __init__(self, name: str):
+    def __getitem__(self, key):
+        return getattr(self, key)
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+class MockPineconeIndex(LocalVectorIndex):
+    """In-memory stand-in for a Pinecone index.
+    
+    Does real cosine search over a float32 matrix (see LocalVectorIndex) and
+    is never persisted. Used by this demo and by loadtest.py, which serves
+    the API against it instead of hosted Pinecone.
+    """
+    
+    def __init__(self, name: str, dimension: Optional[int] = None):
+        super().__init__(directory=None, dimension=dimension, index_type='exact')
         self.name = name
-        self.vectors = []
     
-    def upsert(self, vectors):
-        """Mock upsert method"""
-        self.vectors.extend(vectors)
-        print(f"Upserted {len(vectors)} vectors to {self.name}, total vectors: {len(self.vectors)}")
+    def upsert(self, vectors, namespace: Optional[str] = None, **kwargs):
+        """Insert or replace vectors given as dicts or (id, values, metadata) tuples"""
+        result = super().upsert(vectors, namespace=namespace, **kwargs)
+        print(f"Upserted {len(vectors)} vectors to {self.name}, total vectors: {len(self._rows)}")
+        return result
+    
+    def query(self, vector, top_k: int = 5, include_metadata: bool = True, **kwargs):
+        """Return the top_k vectors by cosine similarity"""
+        results = super().query(vector, top_k=top_k, include_metadata=include_metadata, **kwargs)
+        return _MockResult(
+            matches=[_MockResult(**vars(match)) for match in results.matches],
+            namespace=results.namespace
+        )
     
-    def query(self, vector, top_k: int = 5, include_metadata: bool = True):
-        """Mock query method"""
-        print(f"Querying {self.name} for top {top_k} results")
-        return {"matches": [{"id": v[0], "score": 0.9 - (i * 0.1), "metadata": v[2]} 
-                           for i, v in enumerate(self.vectors[:top_k])]}
+    def persist(self):
+        """Nothing to write; the mock lives only in memory"""
 
 # Main workflow function
 def process_phoenixville_documents(documents: List[Dict[str, str]], index_name: str = "phoenixville-docs"):
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 import os
+import re
 import glob
 from typing import List
-from multiprocessing import Pool
-from tqdm import tqdm
 import uuid
 import time
-
-# Import the correct version of Pinecone for direct API access
-from pinecone import Pinecone, ServerlessSpec
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # We still need these imports for document processing
 from langchain.document_loaders import (
     CSVLoader,
     EverNoteLoader,
-    PyMuPDFLoader,
     TextLoader,
     UnstructuredEmailLoader,
     UnstructuredEPubLoader,
@@ -25,17 +24,30 @@ from langchain.document_loaders import (
     UnstructuredWordDocumentLoader,
 )
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
-from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings
+from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings, DEFAULT_TARGET_DIM
+from ingest_manifest import IngestManifest
+from ingest_pipeline import IngestPipeline
+from loader_pool import load_files
+from code_chunker import CodeChunker
+from chunk_dedup import ChunkDeduplicator
+from pdf_extract import CachedPDFLoader, PageRange, load_page_range, plan_load_tasks
+from embedding_cache import CachedEmbeddings, cache_stats
+from local_vector_store import LocalVectorIndex, open_local_index, local_index_directory
 
 # Load environment variables
 pinecone_api_key = os.environ.get('PINECONE_API_KEY', 'pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e')
 pinecone_environment = os.environ.get('PINECONE_ENVIRONMENT', 'us-east-1')
 index_name = os.environ.get('PINECONE_INDEX_NAME', 'phoenixville-municipal-code')
 source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')
+vector_backend = os.environ.get('VECTOR_BACKEND', 'pinecone').lower()
+manifest_path = os.environ.get('INGEST_MANIFEST', os.path.join(local_index_directory, 'ingest_manifest.json')
+                               if vector_backend == 'local' else f'ingest_manifest_{index_name}.json')
+upsert_workers = int(os.environ.get('PINECONE_UPSERT_WORKERS', 4))
+upsert_max_retries = int(os.environ.get('PINECONE_UPSERT_RETRIES', 5))
 chunk_size = 500
 chunk_overlap = 50
+code_chunker = CodeChunker(chunk_size, chunk_overlap)
 
 # Custom document loader for emails
 class MyElmLoader(UnstructuredEmailLoader):
@@ -65,7 +77,7 @@ LOADER_MAPPING = {
     ".html": (UnstructuredHTMLLoader, {}),
     ".md": (UnstructuredMarkdownLoader, {}),
     ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PyMuPDFLoader, {}),
+    ".pdf": (CachedPDFLoader, {}),
     ".ppt": (UnstructuredPowerPointLoader, {}),
     ".pptx": (UnstructuredPowerPointLoader, {}),
     ".txt": (TextLoader, {"encoding": "utf8"}),
@@ -79,179 +91,325 @@ def load_single_document(file_path: str) -> List[Document]:
         return loader.load()
     raise ValueError(f"Unsupported file extension '{ext}'")
 
-def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+def load_task(task) -> List[Document]:
+    """Load a file, or a page range of a PDF (see pdf_extract.plan_load_tasks)"""
+    if isinstance(task, PageRange):
+        return load_page_range(task)
+    return load_single_document(task)
+
+def list_source_files(source_dir: str) -> List[str]:
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True))
-    filtered_files = [file_path for file_path in all_files if file_path not in ignored_files]
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        with tqdm(total=len(filtered_files), desc='Loading new documents', ncols=80) as pbar:
-            for i, docs in enumerate(pool.imap_unordered(load_single_document, filtered_files)):
-                results.extend(docs)
-                pbar.update()
-    return results
+    return all_files
+
+def load_documents(source_dir: str, ignored_files: List[str] = []) -> List[Document]:
+    ignored = set(ignored_files)
+    filtered_files = [file_path for file_path in list_source_files(source_dir) if file_path not in ignored]
+    # Largest files first on the shared loader pool; files that fail are quarantined
+    return load_files(load_task, filtered_files, plan_fn=plan_load_tasks)
+
+def embedding_dimension(embeddings) -> int:
+    """Dimension of the vectors produced by an embeddings model"""
+    if hasattr(embeddings, 'dimension'):
+        return embeddings.dimension
+    return len(embeddings.embed_query("dimension probe"))
 
-# Custom separators to capture municipal code structure
-custom_separators = [
-    "\nChapter ",   # Separate by chapter headings
-    "\nPart ",      # Separate by parts within chapters
-    "\n§ ",         # Separate by section symbol (common in codes)
-    "\n"           # Fallback: newline
-]
+def pinecone_client():
+    """Pinecone client for direct API access.
 
-def extract_heading(text: str) -> str:
-    # Look for common code markers in the first few lines
-    for line in text.split("\n"):
-        stripped = line.strip()
-        if stripped.startswith("Chapter") or stripped.startswith("Part") or stripped.startswith("§"):
-            return stripped
-    return "Unknown Section"
+    The SDK is imported here, not at module level, so the local backend and
+    the offline benchmark run without it installed.
+    """
+    from pinecone import Pinecone
+    return Pinecone(api_key=pinecone_api_key)
 
-def initialize_pinecone():
-    """Initialize Pinecone client and ensure the index exists"""
-    pc = Pinecone(api_key=pinecone_api_key)
+def initialize_pinecone(dimension: int = None, name: str = None):
+    """Initialize Pinecone client and ensure the index exists.
+    
+    dimension defaults to the legacy padded size (1024) unless
+    EMBEDDING_TARGET_DIM asks for the model's native size; pass the
+    embeddings' dimension to create a native-dimension index.
+    """
+    from pinecone import ServerlessSpec
+    pc = pinecone_client()
+    name = name or index_name
+    dimension = dimension or DEFAULT_TARGET_DIM
+    if dimension is None:
+        raise ValueError("A dimension is required to create a native-dimension index")
     
     # Check if index already exists
     indexes = pc.list_indexes()
-    if index_name not in indexes.names():
+    if name not in indexes.names():
         # Create the index with appropriate dimension
         pc.create_index(
-            name=index_name,
-            dimension=1024,
+            name=name,
+            dimension=dimension,
             metric="cosine",
             spec=ServerlessSpec(
                 cloud="aws",
                 region="us-east-1"
             )
         )
-        print(f"Created new Pinecone index: {index_name}")
+        print(f"Created new Pinecone index: {name} ({dimension} dimensions)")
     
-    return pc.Index(index_name)
+    return pc.Index(name)
+
+def check_index_dimension(index, dimension: int):
+    """Fail early when the index and the embeddings disagree on dimension"""
+    index_dimension = index.describe_index_stats().dimension
+    if index_dimension and index_dimension != dimension:
+        raise ValueError(
+            f"Pinecone index '{index_name}' has dimension {index_dimension} but the embeddings "
+            f"produce {dimension}. Set EMBEDDING_TARGET_DIM={index_dimension}, or run "
+            f"pinecone_migrate_index.py to move to a native-dimension index."
+        )
 
-def process_documents(ignored_files: List[str] = []) -> List[Document]:
+def split_documents(documents: List[Document], chunker: CodeChunker = code_chunker) -> List[Document]:
+    # Chunks follow Chapter/Part/§ boundaries and carry their heading path
+    return chunker.split_documents(documents)
+
+def process_documents(ignored_files: List[str] = [], embeddings=None) -> List[Document]:
     print(f"Loading documents from {source_directory}")
     documents = load_documents(source_directory, ignored_files)
     if not documents:
         print("No new documents to load")
         return []
     print(f"Loaded {len(documents)} new documents from {source_directory}")
-    # Use our custom separators in the text splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size, 
-        chunk_overlap=chunk_overlap,
-        separators=custom_separators
-    )
-    texts = text_splitter.split_documents(documents)
-    # Attach metadata to each chunk
-    for chunk in texts:
-        heading = extract_heading(chunk.page_content)
-        if not chunk.metadata:
-            chunk.metadata = {}
-        chunk.metadata["section_heading"] = heading
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} tokens each)")
+    # Chunks are sized in the embedding model's tokens, so none is truncated when embedded
+    chunker = CodeChunker.for_embeddings(embeddings or load_embeddings(), chunk_size, chunk_overlap)
+    # Repeated headers/footers are stripped and duplicate chunks dropped before embedding
+    deduplicator = ChunkDeduplicator()
+    texts = deduplicator.split_documents(documents, lambda docs: split_documents(docs, chunker))
+    print(f"Split into {len(texts)} chunks of text (max. {chunker.chunk_size} {chunker.unit} each)")
+    print(deduplicator.report())
+    deduplicator.write_report()
     return texts
 
 def does_index_exist() -> bool:
     """Check if Pinecone index exists"""
+    if vector_backend == 'local':
+        return LocalVectorIndex.exists(local_index_directory)
     try:
-        pc = Pinecone(api_key=pinecone_api_key)
+        pc = pinecone_client()
         indexes = pc.list_indexes()
         return index_name in indexes.names()
     except Exception as e:
         print(f"Error checking Pinecone index: {e}")
         return False
 
-def add_embeddings_to_pinecone(texts, embeddings_model):
-    """Add document embeddings directly to Pinecone using the new API"""
+def open_index(dimension: int = None):
+    """Return the configured index: the local index, or the Pinecone index handle"""
+    if vector_backend == 'local':
+        return open_local_index(local_index_directory, dimension)
+    return pinecone_client().Index(index_name)
+
+def delete_vectors_from_pinecone(ids: List[str], batch_size: int = 1000, index=None):
+    """Delete vectors by ID, in batches the Pinecone API accepts"""
+    if index is None:
+        pc = pinecone_client()
+        index = pc.Index(index_name)
+    for i in range(0, len(ids), batch_size):
+        index.delete(ids=ids[i:i + batch_size])
+    print(f"Deleted {len(ids)} stale vectors from {vector_backend} index")
+
+def build_pinecone_vectors(docs: List[Document], embeddings, ids: List[str]) -> List[dict]:
+    """Pair chunks with their embeddings and the metadata used for retrieval"""
+    vectors = []
+    for doc, embedding, id in zip(docs, embeddings, ids):
+        metadata = doc.metadata
+        
+        # Add the text content to metadata for retrieval
+        metadata['text'] = doc.page_content
+        
+        # Add document type inference based on content
+        if "Zoning Hearing Board" in doc.page_content:
+            metadata['document_type'] = 'zoning_board'
+        
+        # Add more specific metadata extraction here
+        
+        vectors.append({
+            'id': id,
+            'values': embedding,
+            'metadata': metadata
+        })
+    return vectors
+
+# "429" only as a whole number, so vector IDs and counts containing it don't match
+RATE_LIMIT_MESSAGE = re.compile(r"\b429\b|too many requests|rate limit", re.IGNORECASE)
+
+def is_rate_limited(error: Exception) -> bool:
+    """Check whether a Pinecone error is a rate-limit (HTTP 429) response"""
+    response = getattr(error, 'response', None)
+    status = (getattr(error, 'status', None) or getattr(error, 'status_code', None)
+              or getattr(response, 'status_code', None))
+    if status is not None:
+        return str(status) == '429'
+    return RATE_LIMIT_MESSAGE.search(str(error)) is not None
+
+def upsert_with_retry(index, vectors: List[dict], max_retries: int = None, base_delay: float = 1.0,
+                      namespace: str = None):
+    """Upsert a batch, backing off exponentially (with jitter) when rate limited"""
+    max_retries = upsert_max_retries if max_retries is None else max_retries
+    kwargs = {'namespace': namespace} if namespace else {}
+    for attempt in range(max_retries + 1):
+        try:
+            return index.upsert(vectors=vectors, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_rate_limited(e):
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+            print(f"Pinecone rate limit hit, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+
+def add_embeddings_to_pinecone(texts, embeddings_model, ids: List[str] = None, max_workers: int = None):
+    """Add document embeddings directly to Pinecone using the new API.
+
+    The next batch is embedded while up to ``max_workers`` upserts are in
+    flight on a thread pool. ``max_workers=1`` upserts each batch before
+    embedding the next one.
+    """
     # Initialize Pinecone
-    pc = Pinecone(api_key=pinecone_api_key)
+    pc = pinecone_client()
     index = pc.Index(index_name)
     
     # Process in smaller batches to avoid timeouts
     batch_size = 50
     total_vectors = len(texts)
+    total_batches = (total_vectors + batch_size - 1) // batch_size
+    max_workers = max_workers or upsert_workers
     
-    print(f"Adding {total_vectors} vectors to Pinecone in batches of {batch_size}")
+    print(f"Adding {total_vectors} vectors to Pinecone in batches of {batch_size} "
+          f"({max_workers} concurrent upserts)")
     
-    for i in range(0, total_vectors, batch_size):
-        batch_end = min(i + batch_size, total_vectors)
-        current_batch = texts[i:batch_end]
-        
-        # Generate IDs for the batch
-        ids = [str(uuid.uuid4()) for _ in range(len(current_batch))]
-        
-        # Create embeddings for the texts
-        texts_to_embed = [doc.page_content for doc in current_batch]
-        embeddings = embeddings_model.embed_documents(texts_to_embed)
-        
-        # Create metadata
-        metadatas = [doc.metadata for doc in current_batch]
+    start = time.time()
+    in_flight = deque()
+    completed = [0]
+    completed_lock = threading.Lock()
+    
+    def report(future):
+        if future.exception() is None:
+            with completed_lock:
+                completed[0] += 1
+                print(f"Added batch {completed[0]}/{total_batches}")
     
-        # Prepare vectors with enhanced metadata
-        vectors = []
-        for j, (id, embedding, metadata) in enumerate(zip(ids, embeddings, metadatas)):
-            # Add the text content to metadata for retrieval
-            metadata['text'] = texts_to_embed[j]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, total_vectors, batch_size):
+            batch_end = min(i + batch_size, total_vectors)
+            current_batch = texts[i:batch_end]
             
-            # Add document type inference based on content
-            if "Zoning Hearing Board" in texts_to_embed[j]:
-                metadata['document_type'] = 'zoning_board'
+            # Use the caller's deterministic IDs, or generate random ones
+            if ids is not None:
+                batch_ids = ids[i:batch_end]
+            else:
+                batch_ids = [str(uuid.uuid4()) for _ in range(len(current_batch))]
             
-            # Add more specific metadata extraction here
+            # Create embeddings for the texts while earlier batches upload
+            texts_to_embed = [doc.page_content for doc in current_batch]
+            embeddings = embeddings_model.embed_documents(texts_to_embed)
             
-            vectors.append({
-                'id': id,
-                'values': embedding,
-                'metadata': metadata
-        })
-        
-        # Upsert to Pinecone
-        index.upsert(vectors=vectors)
+            vectors = build_pinecone_vectors(current_batch, embeddings, batch_ids)
+            
+            # Bound the number of in-flight upserts; surfaces errors early
+            while len(in_flight) >= max_workers:
+                in_flight.popleft().result()
+            
+            future = executor.submit(upsert_with_retry, index, vectors)
+            future.add_done_callback(report)
+            in_flight.append(future)
         
-        print(f"Added batch {i//batch_size + 1}/{(total_vectors + batch_size - 1)//batch_size}")
+        # Wait for the remaining upserts
+        for future in in_flight:
+            future.result()
     
-    print(f"Successfully added {total_vectors} vectors to Pinecone")
+    elapsed = time.time() - start
+    rate = total_vectors / elapsed if elapsed > 0 else 0
+    print(f"Successfully added {total_vectors} vectors to Pinecone in {elapsed:.1f}s ({rate:.1f} vectors/s)")
 
-def main():
-    # Initialize embeddings
+def load_embeddings():
+    """Initialize the embedding model used for ingestion"""
     try:
-        # Try using our custom embeddings adapter for 1024 dimensions
+        # Try using our custom embeddings adapter (padded or native dimension)
         embeddings = CustomHuggingFaceEmbeddings()
-        print("Using custom 1024-dimensional embeddings compatible with llama-text-embed-v2")
+        print(f"Using custom {embeddings.dimension}-dimensional embeddings ({embeddings.model_name})")
     except Exception as e:
         print(f"Error initializing custom embeddings: {e}")
         from langchain.embeddings import HuggingFaceEmbeddings
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        embeddings = CachedEmbeddings(HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2"), "all-MiniLM-L6-v2")
         print("Using standard HuggingFace embeddings model: all-MiniLM-L6-v2")
+    return embeddings
+
+def ingest_incremental(embeddings) -> int:
+    """Ingest new and changed files, removing vectors of changed or deleted files.
+
+    Writes to Pinecone, or to the local index when VECTOR_BACKEND=local.
+    Returns the number of chunks written.
+    """
+    manifest = IngestManifest(manifest_path)
+    dimension = embedding_dimension(embeddings)
     
     # Check if index exists
     if does_index_exist():
-        print(f"Appending to existing Pinecone index: {index_name}")
-        
-        # Process new documents
-        texts = process_documents([])
-        if not texts:
-            print("No new documents to process")
-            return
-            
-        print("Creating embeddings. May take some minutes...")
-        add_embeddings_to_pinecone(texts, embeddings)
+        print(f"Appending to existing {vector_backend} index: {index_name if vector_backend == 'pinecone' else local_index_directory}")
+        if not manifest.exists():
+            print("Warning: no ingest manifest found. Vectors ingested by earlier versions "
+                  "cannot be tracked; run pinecone_clear_vectors.py first to avoid duplicates.")
+        index = open_index()
+        check_index_dimension(index, dimension)
     else:
-        print("Creating new Pinecone index")
-        
-        # Process documents
-        texts = process_documents()
-        if not texts:
-            print("No documents to process")
-            return
-            
-        print("Creating embeddings. May take some minutes...")
-        # Initialize Pinecone index
-        initialize_pinecone()
-        
-        # Add embeddings directly to Pinecone
-        add_embeddings_to_pinecone(texts, embeddings)
+        print(f"Creating new {vector_backend} index")
+        if vector_backend == 'pinecone':
+            initialize_pinecone(dimension=dimension)
+        index = open_index(dimension)
+        manifest.reset()
+    
+    # Every file is re-chunked when the chunking settings changed since the last ingest
+    chunker = CodeChunker.for_embeddings(embeddings, chunk_size, chunk_overlap)
+    deduplicator = ChunkDeduplicator()
+    plan = manifest.plan(list_source_files(source_directory),
+                         {"chunker": chunker.settings, "dedup": deduplicator.settings})
+    print(f"Ingest plan: {plan.summary()}")
+    if plan.stale_ids:
+        delete_vectors_from_pinecone(plan.stale_ids, index=index)
+    
+    if not plan.files_to_process:
+        print("No new documents to process")
+        if vector_backend == 'local':
+            index.persist()
+        manifest.commit(plan)
+        return 0
+    
+    # Stream files through load -> split -> embed -> upsert
+    print(f"Loading, embedding and upserting {len(plan.files_to_process)} files...")
+    pipeline = IngestPipeline(
+        load_fn=load_task,
+        plan_fn=plan_load_tasks,
+        split_fn=lambda docs: deduplicator.split_documents(docs, chunker.split_documents),
+        embed_fn=embeddings.embed_documents,
+        write_fn=lambda docs, vectors, ids: upsert_with_retry(index, build_pinecone_vectors(docs, vectors, ids)),
+        ids_fn=manifest.assign_chunk_ids,
+        batch_size=50,
+        write_workers=upsert_workers if vector_backend == 'pinecone' else 1
+    )
+    stats = pipeline.run(plan.files_to_process)
+    print(chunker.report())
+    print(deduplicator.report())
+    deduplicator.write_report()
+    manifest.record_duplicates(deduplicator.dependencies)
+    # Files that failed to load are retried once they change
+    for file_path in pipeline.failed_files:
+        manifest.skip(file_path)
+    for cache in cache_stats():
+        print(f"Embedding cache: {cache['hits']} hits, {cache['misses']} misses ({cache['entries']} entries)")
+    
+    if vector_backend == 'local':
+        index.persist()
+    manifest.commit(plan)
+    return int(stats["chunks"])
+
+def main():
+    embeddings = load_embeddings()
+    ingest_incremental(embeddings)
     
     print("Ingestion complete! You can now run privateGPT.py to query your documents")
     
@@ -2,8 +2,8 @@ from langchain.vectorstores.base import VectorStore
 from langchain.embeddings.base import Embeddings
 from langchain.schema import Document, BaseRetriever
 from typing import List, Optional, Any, Dict, Tuple, Iterable
-from pinecone import Pinecone
 import uuid
+from vector_utils import maximal_marginal_relevance
 
 class PineconeVectorStore(VectorStore):
     """Adapter for using Pinecone with LangChain, compatible with Pinecone SDK v2+"""
@@ -14,16 +14,23 @@ class PineconeVectorStore(VectorStore):
         index_name: str,
         embedding: Embeddings,
         text_key: str = "text",
-        namespace: Optional[str] = None
+        namespace: Optional[str] = None,
+        index: Optional[Any] = None
     ):
-        """Initialize with Pinecone client"""
+        """Initialize with Pinecone client, or reuse an already resolved index"""
         self.embedding = embedding
         self.text_key = text_key
         self.namespace = namespace
         self.pinecone_api_key = pinecone_api_key
         self.index_name = index_name
         
+        # Reuse the caller's index handle to avoid creating a new client
+        if index is not None:
+            self.index = index
+            return
+        
         # Initialize the modern Pinecone client (v2+)
+        from pinecone import Pinecone
         pc = Pinecone(api_key=pinecone_api_key)
         self.index = pc.Index(index_name)
     
@@ -138,11 +145,13 @@ class PineconeVectorStore(VectorStore):
             query_embedding = query_embedding.tolist()
         
         # Using the modern Pinecone API
+        query_kwargs = {"filter": kwargs["filter"]} if kwargs.get("filter") else {}
         results = self.index.query(
             vector=query_embedding,
             top_k=k,
             include_metadata=True,
-            namespace=self.namespace
+            namespace=self.namespace,
+            **query_kwargs
         )
         
         # Convert to LangChain documents
@@ -164,17 +173,26 @@ class PineconeVectorStore(VectorStore):
     ) -> List[Tuple[Document, float]]:
         """Return documents and relevance scores in the range [0, 1]."""
         query_embedding = self.embedding.embed_query(query)
+        return self.similarity_search_with_score_by_vector(query_embedding, k=k, **kwargs)
+    
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        """Return documents and relevance scores for an already embedded query."""
+        query_embedding = embedding
         
         # Convert numpy array to list if needed
         if hasattr(query_embedding, 'tolist'):
             query_embedding = query_embedding.tolist()
             
         # Using the modern Pinecone API
+        query_kwargs = {"filter": kwargs["filter"]} if kwargs.get("filter") else {}
         results = self.index.query(
             vector=query_embedding,
             top_k=k,
             include_metadata=True,
-            namespace=self.namespace
+            namespace=self.namespace,
+            **query_kwargs
         )
         
         # Convert to LangChain documents with scores
@@ -192,18 +210,73 @@ class PineconeVectorStore(VectorStore):
         
         return documents_with_scores
     
+    def max_marginal_relevance_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        """Return (document, similarity) pairs selected using the maximal marginal relevance.
+        
+        Fetches ``fetch_k`` candidates together with their vectors in a single
+        query, then picks ``k`` of them that are relevant but not redundant.
+        ``lambda_mult`` runs from 0 (maximum diversity) to 1 (pure relevance).
+        """
+        if hasattr(embedding, 'tolist'):
+            embedding = embedding.tolist()
+        
+        query_kwargs = {"filter": kwargs["filter"]} if kwargs.get("filter") else {}
+        results = self.index.query(
+            vector=embedding,
+            top_k=max(fetch_k, k),
+            include_metadata=True,
+            include_values=True,
+            namespace=self.namespace,
+            **query_kwargs
+        )
+        matches = [match for match in results.matches if self.text_key in (match.metadata or {})]
+        if not matches:
+            return []
+        
+        selected = maximal_marginal_relevance(
+            embedding, [match.values for match in matches], k=k, lambda_mult=lambda_mult
+        )
+        documents_with_scores = []
+        for i in selected:
+            metadata = dict(matches[i].metadata)
+            page_content = metadata.pop(self.text_key)
+            documents_with_scores.append((Document(page_content=page_content, metadata=metadata), matches[i].score))
+        return documents_with_scores
+    
+    def max_marginal_relevance_search_by_vector(
+        self, embedding: List[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
+    ) -> List[Document]:
+        """Return docs selected using the maximal marginal relevance."""
+        return [doc for doc, _ in self.max_marginal_relevance_search_with_score_by_vector(
+            embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs
+        )]
+    
+    def max_marginal_relevance_search_with_score(
+        self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        """Return MMR-selected docs with their similarity to the query."""
+        query_embedding = self.embedding.embed_query(query)
+        return self.max_marginal_relevance_search_with_score_by_vector(
+            query_embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs
+        )
+    
     def max_marginal_relevance_search(
         self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs
     ) -> List[Document]:
         """Return docs selected using the maximal marginal relevance."""
-        # Not fully implemented - this is a placeholder that falls back to regular search
-        print("Warning: MMR search not implemented for PineconeVectorStore, falling back to regular search")
-        return self.similarity_search(query, k, **kwargs)
+        query_embedding = self.embedding.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(
+            query_embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, **kwargs
+        )
     
     # Custom retriever implementation compatible with newer LangChain versions
-    def as_retriever(self, search_kwargs=None):
-        """Create a retriever from this vectorstore"""
+    def as_retriever(self, search_kwargs=None, search_type: str = "similarity"):
+        """Create a retriever from this vectorstore (search_type "similarity" or "mmr")"""
         search_kwargs = search_kwargs or {}
+        if search_type not in ("similarity", "mmr"):
+            raise ValueError(f"Unsupported search_type '{search_type}'")
         
         # Create a simple retriever that delegates to our vectorstore
         class CustomRetriever(BaseRetriever):
@@ -213,6 +286,8 @@ class PineconeVectorStore(VectorStore):
                 self.search_kwargs = search_kwargs
             
             def get_relevant_documents(self, query):
+                if search_type == "mmr":
+                    return self.vectorstore.max_marginal_relevance_search(query, **self.search_kwargs)
                 return self.vectorstore.similarity_search(query, **self.search_kwargs)
             
             async def aget_relevant_documents(self, query):
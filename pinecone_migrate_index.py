@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Migrate a zero-padded Pinecone index to a native-dimension index.
+
+Older ingests padded 384-d MiniLM embeddings with zeros to fit a 1024-d index.
+Because the padding is all zeros, truncating the stored vectors gives exactly
+the native embeddings (cosine similarity is unchanged), so the migration
+copies vectors and metadata straight from the old index without re-loading
+or re-embedding any documents.
+
+Usage:
+    python pinecone_migrate_index.py --target phoenixville-municipal-code-native
+    PINECONE_INDEX_NAME=phoenixville-municipal-code-native EMBEDDING_TARGET_DIM=native python pinecone_api.py
+"""
+
+import os
+import shutil
+import argparse
+from typing import List
+
+from pinecone import Pinecone
+from pinecone_ingest import initialize_pinecone, upsert_with_retry, manifest_path
+
+# Load environment variables
+pinecone_api_key = os.environ.get('PINECONE_API_KEY', 'pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e')
+index_name = os.environ.get('PINECONE_INDEX_NAME', 'phoenixville-municipal-code')
+embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME', 'all-MiniLM-L6-v2')
+
+
+def native_dimension(model_name: str) -> int:
+    """Look up the model's native embedding size"""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name).get_sentence_embedding_dimension()
+
+
+def migrate_namespace(source, target, namespace: str, dimension: int, batch_size: int) -> int:
+    """Copy one namespace, truncating vectors to the native dimension"""
+    copied = 0
+    nonzero_tails = 0
+    for id_batch in source.list(namespace=namespace, limit=batch_size):
+        ids: List[str] = list(id_batch)
+        if not ids:
+            continue
+        fetched = source.fetch(ids=ids, namespace=namespace)
+        vectors = []
+        for id, vector in fetched.vectors.items():
+            values = list(vector.values)
+            if any(values[dimension:]):
+                nonzero_tails += 1
+            vectors.append({
+                'id': id,
+                'values': values[:dimension],
+                'metadata': vector.metadata or {}
+            })
+        upsert_with_retry(target, vectors, namespace=namespace)
+        copied += len(vectors)
+        print(f"Copied {copied} vectors from namespace '{namespace or 'default'}'")
+
+    if nonzero_tails:
+        print(f"Warning: {nonzero_tails} vectors had non-zero values beyond dimension {dimension}; "
+              f"they were not produced by zero-padding and have been truncated")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Copy a zero-padded Pinecone index into a native-dimension index.'
+    )
+    parser.add_argument("--source", default=index_name,
+                        help='Padded index to read from (default: PINECONE_INDEX_NAME).')
+    parser.add_argument("--target", default=None,
+                        help='Native-dimension index to create (default: <source>-native).')
+    parser.add_argument("--dimension", type=int, default=None,
+                        help="Native dimension (default: the embedding model's own size).")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help='Vectors fetched and upserted per request.')
+    args = parser.parse_args()
+
+    target_name = args.target or f"{args.source}-native"
+    dimension = args.dimension or native_dimension(embeddings_model_name)
+
+    pc = Pinecone(api_key=pinecone_api_key)
+    if args.source not in pc.list_indexes().names():
+        print(f"Index '{args.source}' doesn't exist")
+        raise SystemExit(1)
+
+    source = pc.Index(args.source)
+    stats = source.describe_index_stats()
+    print(f"Migrating {stats.total_vector_count} vectors from '{args.source}' "
+          f"({stats.dimension}-d) to '{target_name}' ({dimension}-d)")
+    if stats.dimension == dimension:
+        print("Source index already has the native dimension; nothing to do")
+        return
+
+    target = initialize_pinecone(dimension=dimension, name=target_name)
+
+    total = 0
+    namespaces = list(stats.namespaces.keys()) if stats.namespaces else [""]
+    for namespace in namespaces:
+        total += migrate_namespace(source, target, namespace, dimension, args.batch_size)
+
+    # Keep incremental ingest working against the new index
+    source_manifest = manifest_path if args.source == index_name else f"ingest_manifest_{args.source}.json"
+    target_manifest = source_manifest.replace(args.source, target_name)
+    if os.path.exists(source_manifest) and target_manifest != source_manifest:
+        shutil.copyfile(source_manifest, target_manifest)
+        print(f"Copied ingest manifest to {target_manifest}")
+
+    print(f"Migrated {total} vectors.")
+    print(f"Switch over with: PINECONE_INDEX_NAME={target_name} EMBEDDING_TARGET_DIM=native")
+
+
+if __name__ == "__main__":
+    main()
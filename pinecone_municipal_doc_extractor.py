@@ -12,7 +12,7 @@ from typing import Dict, List, Any, Optional
 from pinecone import Pinecone
 import uuid
 from langchain.document_loaders import TextLoader
-from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings
+from retrieval_context import get_embeddings
 
 # Load environment variables
 pinecone_api_key = os.environ.get('PINECONE_API_KEY', 'pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e')
@@ -221,13 +221,8 @@ def add_structured_info_to_pinecone(doc_info):
     pc = Pinecone(api_key=pinecone_api_key)
     index = pc.Index(index_name)
     
-    # Initialize embeddings
-    try:
-        embeddings = CustomHuggingFaceEmbeddings()
-    except Exception as e:
-        print(f"Error initializing custom embeddings: {e}")
-        from langchain.embeddings import HuggingFaceEmbeddings
-        embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    # Reuse one embedding model (and its disk cache) for every document
+    embeddings = get_embeddings()
     
     # Create a structured document for better retrieval
     structured_doc = f"""
@@ -1,75 +1,56 @@
 #!/usr/bin/env python3
 from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceEmbeddings
-from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.llms import Ollama
 from langchain.schema import Document, BaseRetriever
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 import os
 import time
-from pinecone import Pinecone
 from langchain.prompts import PromptTemplate
+from retrieval_context import get_retrieval_context, init_retrieval_context, IndexNotFoundError
+from context_packer import pack_context, count_tokens, PackedContext
+from query_stream import stream_answer
+from llm_scheduler import ScheduledOllama, SchedulerRejected
+from answer_cache import AnswerCache, cached_answer, file_version, answer_cache_enabled, normalize_query
+from query_coalescer import new_single_flight, coalesce
+from query_timing import stage, timed_answer, timed_events
+from code_chunker import chapter_filter
+from pinecone_ingest import manifest_path
 
 # Global configuration
 model = os.environ.get("MODEL", "mistral")
-embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME", "llama-text-embed-v2")
-pinecone_api_key = os.environ.get("PINECONE_API_KEY", "pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e")
-pinecone_environment = os.environ.get("PINECONE_ENVIRONMENT", "us-east-1")
-index_name = os.environ.get("PINECONE_INDEX_NAME", "phoenixville-municipal-code")
 target_source_chunks = int(os.environ.get("TARGET_SOURCE_CHUNKS", 10))
 
 # Global QA chain instance
 qa_chain = None
 
+# Answers are cached until the ingest manifest changes
+answer_cache = AnswerCache(
+    embed_fn=lambda query: get_retrieval_context().query_embeddings.embed_query(query),
+    version_fn=file_version(manifest_path)
+) if answer_cache_enabled else None
+
+# Identical concurrent queries share one computation
+single_flight = new_single_flight()
+
 # Standalone functions to avoid setting any attributes on BaseRetriever subclasses
 def get_documents_from_pinecone(query: str) -> List[Document]:
-    """Query Pinecone for relevant documents."""
+    """Query Pinecone for relevant documents using the shared retrieval context."""
     try:
-        # Initialize Pinecone client
-        pc = Pinecone(api_key=pinecone_api_key)
-        
-        # Check if index exists 
-        indexes = pc.list_indexes()
-        if index_name not in indexes.names():
-            print(f"Index {index_name} not found")
-            return []
-            
-        # Get the index
-        index = pc.Index(index_name)
-        
-        # Initialize embeddings
-        try:
-            embedding_model = CustomHuggingFaceEmbeddings()
-        except Exception as e:
-            print(f"Error with custom embeddings: {e}")
-            embedding_model = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-        
-        # Create query embedding
-        query_embedding = embedding_model.embed_query(query)
-        
-        # Convert to list if needed
-        if hasattr(query_embedding, 'tolist'):
-            query_embedding = query_embedding.tolist()
-        
-        # Query Pinecone
-        results = index.query(
-            vector=query_embedding,
-            top_k=target_source_chunks,
-            include_metadata=True
-        )
-        
-        # Convert to Documents
-        documents = []
-        for match in results.matches:
-            if 'text' in match.metadata:
-                page_content = match.metadata.pop('text')
-                doc = Document(page_content=page_content, metadata=match.metadata)
-                documents.append(doc)
-            else:
-                print(f"Warning: Missing text content in document {match.id}")
-        
-        return documents
+        context = get_retrieval_context()
+        return context.search(query, k=target_source_chunks)
+    
+    except Exception as e:
+        print(f"Error querying Pinecone: {e}")
+        import traceback
+        traceback.print_exc()
+        return []
+
+def get_scored_documents_from_pinecone(query: str, chapter: Optional[str] = None) -> List[Tuple[Document, float]]:
+    """Query Pinecone for relevant documents and their similarity scores, optionally within one chapter."""
+    try:
+        context = get_retrieval_context()
+        return context.search_with_scores(query, k=target_source_chunks,
+                                          filter=chapter_filter(chapter) if chapter else None)
     
     except Exception as e:
         print(f"Error querying Pinecone: {e}")
@@ -83,8 +64,11 @@ class MinimalRetriever(BaseRetriever):
         """Get documents relevant to the query."""
         return get_documents_from_pinecone(query)
         
-def create_qa_chain(hide_source: bool = False, mute_stream: bool = False):
-    """Initializes and returns the QA chain for processing queries."""
+def create_qa_chain(hide_source: bool = False, mute_stream: bool = False, llm=None):
+    """Initializes and returns the QA chain for processing queries.
+    
+    ``llm`` replaces the scheduled Ollama model (e.g. a fake LLM in benchmarks).
+    """
     global qa_chain
     
     try:
@@ -95,7 +79,8 @@ def create_qa_chain(hide_source: bool = False, mute_stream: bool = False):
         callbacks = [] if mute_stream else [StreamingStdOutCallbackHandler()]
         
         # Initialize the LLM
-        llm = Ollama(model=model, callbacks=callbacks)
+        if llm is None:
+            llm = ScheduledOllama(model=model, callbacks=callbacks)
         
         # Define a better prompt template that instructs the model to use the content directly
         prompt_template = """You are an AI assistant for answering questions about Phoenixville municipal documents.
@@ -133,11 +118,26 @@ Answer:"""
         traceback.print_exc()
         raise
 
-def process_query(query: str) -> Dict[str, Any]:
+def process_query(query: str, chapter: Optional[str] = None) -> Dict[str, Any]:
     """
     Processes a query string using the QA chain and returns a dictionary
-    with the answer, source documents, and processing time.
+    with the answer, source documents, and processing time. Repeated and
+    near-identical questions are answered from the answer cache, and
+    identical concurrent ones share a single computation. The result's
+    ``timings`` break the time down by stage (see query_timing).
+    ``chapter`` restricts retrieval to one chapter of the code; such
+    answers bypass the answer cache, which is keyed by query alone.
     """
+    if not query or not isinstance(query, str):
+        return answer_query(query)
+    if chapter:
+        return timed_answer(query, lambda: coalesce(single_flight, f"chapter {chapter}\n{normalize_query(query)}",
+                                                    lambda: answer_query(query, chapter)))
+    return timed_answer(query, lambda: coalesce(single_flight, normalize_query(query),
+                                                lambda: cached_answer(answer_cache, query, answer_query)))
+
+def answer_query(query: str, chapter: Optional[str] = None) -> Dict[str, Any]:
+    """Answer a query with retrieval and the LLM, bypassing the answer cache."""
     global qa_chain
     if qa_chain is None:
         # Initialize with default settings if not already done.
@@ -153,15 +153,59 @@ def process_query(query: str) -> Dict[str, Any]:
     
     try:
         start = time.time()
-        res = qa_chain(query)
+        packed = retrieve_packed_context(query, chapter)
+        answer = generate_answer(packed.documents, query)
         end = time.time()
-        res["processing_time"] = end - start
-        return res
+        return {
+            "query": query,
+            "result": answer,
+            "source_documents": packed.documents if qa_chain.return_source_documents else [],
+            "processing_time": end - start,
+            "context": packed.stats()
+        }
+    except SchedulerRejected:
+        # Surfaced to the API as 429/503 rather than as an answer
+        raise
     except Exception as e:
         import traceback
         print(f"Error processing query: {e}")
         print(traceback.format_exc())
-        return {"result": f"An error occurred while processing your query: {str(e)}", "source_documents": []}
+        return {"result": f"An error occurred while processing your query: {str(e)}", "source_documents": [],
+                "error": str(e)}
+
+def retrieve_packed_context(query: str, chapter: Optional[str] = None) -> PackedContext:
+    """Retrieve with scores, then pack only the useful context into the prompt."""
+    scored_documents = get_scored_documents_from_pinecone(query, chapter)
+    with stage("pack"):
+        packed = pack_context(scored_documents)
+        combine_chain = qa_chain.combine_documents_chain
+        prompt = combine_chain.llm_chain.prompt.format(
+            context=combine_chain.document_separator.join(doc.page_content for doc in packed.documents),
+            question=query
+        )
+        packed.prompt_chars = len(prompt)
+        packed.prompt_tokens = count_tokens([prompt])[0]
+    print(f"Packed {len(packed.documents)}/{packed.retrieved} chunks into {packed.tokens} context tokens "
+          f"(prompt: {packed.prompt_tokens} tokens)")
+    return packed
+
+def generate_answer(documents: List[Document], query: str, callbacks: list = None) -> str:
+    """Run the LLM over the packed documents; callbacks receive streamed tokens."""
+    return qa_chain.combine_documents_chain.run(input_documents=documents, question=query, callbacks=callbacks)
+
+def stream_query(query: str, chapter: Optional[str] = None) -> Iterator[dict]:
+    """Yield source documents, then answer tokens, then a timing record (see query_stream)."""
+    global qa_chain
+    if qa_chain is None:
+        qa_chain = create_qa_chain()
+    
+    def retrieve(query: str):
+        packed = retrieve_packed_context(query, chapter)
+        return packed.documents, {"context": packed.stats()}
+    
+    query = query.strip()
+    cache = answer_cache if not chapter else None
+    return timed_events(query, lambda: stream_answer(query, retrieve, generate_answer, cache=cache))
 
 def main():
     import argparse
@@ -174,6 +218,13 @@ def main():
                         help='Disable the streaming StdOut callback for LLMs.')
     args = parser.parse_args()
 
+    # Warm the retrieval context up front so the first query is fast
+    try:
+        init_retrieval_context()
+    except IndexNotFoundError as e:
+        print(f"{e}. Run pinecone_ingest.py first.")
+        raise SystemExit(1)
+
     # Initialize the QA chain with desired settings.
     create_qa_chain(hide_source=args.hide_source, mute_stream=args.mute_stream)
 
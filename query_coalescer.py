@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Request coalescing for concurrent queries.
+
+SingleFlight lets identical in-flight queries share one computation: the
+first caller runs it, later callers with the same normalized query wait for
+and reuse its result. EmbeddingBatcher gathers query embeddings from
+distinct concurrent requests into a single ``embed_documents`` call (one
+``model.encode`` batch), waiting at most QUERY_BATCH_WINDOW_MS for company
+and never waiting when it is the only caller.
+"""
+
+import os
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from langchain.embeddings.base import Embeddings
+
+# Load environment variables
+coalescing_enabled = os.environ.get('QUERY_COALESCING', '1').lower() not in ('0', 'false', 'no', 'off')
+batch_window = float(os.environ.get('QUERY_BATCH_WINDOW_MS', 5)) / 1000
+batch_max_size = int(os.environ.get('QUERY_BATCH_MAX', 32))
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one execution of fn among concurrent callers with the same key."""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True if another caller computed it."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    def stats(self) -> dict:
+        total = self.executions + self.coalesced
+        return {
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": self.coalesced / total if total else 0.0,
+        }
+
+
+class _Request:
+    def __init__(self, text: str):
+        self.text = text
+        self.event = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+class EmbeddingBatcher:
+    """Micro-batch concurrent single-text embeddings into one batched call."""
+
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]],
+                 window: float = batch_window, max_batch: int = batch_max_size):
+        self.embed_fn = embed_fn
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._thread = None
+        self.batches = 0
+        self.texts = 0
+        self.max_batch_seen = 0
+        self.batch_sizes: Dict[int, int] = {}
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True, name='embedding-batcher')
+                    self._thread.start()
+
+    def embed(self, text: str) -> List[float]:
+        self._ensure_thread()
+        request = _Request(text)
+        with self._lock:
+            self._waiting += 1
+        try:
+            self._queue.put(request)
+            request.event.wait()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if request.error is not None:
+            raise request.error
+        return request.vector
+
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            # Everyone currently waiting is already in this batch
+            if len(batch) >= self._waiting:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = list(dict.fromkeys(request.text for request in batch))
+            try:
+                vectors = dict(zip(texts, self.embed_fn(texts)))
+                for request in batch:
+                    request.vector = vectors[request.text]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.event.set()
+            with self._lock:
+                self.batches += 1
+                self.texts += len(texts)
+                self.max_batch_seen = max(self.max_batch_seen, len(texts))
+                self.batch_sizes[len(texts)] = self.batch_sizes.get(len(texts), 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_seen,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "window_ms": self.window * 1000,
+        }
+
+
+class BatchedQueryEmbeddings(Embeddings):
+    """Embeddings whose embed_query calls are micro-batched across threads.
+
+    A batch goes through the wrapped embeddings' ``embed_queries`` (see
+    CachedEmbeddings), so its vectors are cached as queries, not documents.
+    Embeddings without it are called once per query.
+    """
+
+    def __init__(self, embeddings: Embeddings, window: float = batch_window, max_batch: int = batch_max_size):
+        self.embeddings = embeddings
+        embed_queries = getattr(embeddings, 'embed_queries', None)
+        if embed_queries is None:
+            embed_queries = lambda texts: [embeddings.embed_query(text) for text in texts]
+        self.batcher = EmbeddingBatcher(embed_queries, window, max_batch)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.batcher.embed(text)
+        return vector.tolist() if hasattr(vector, 'tolist') else list(vector)
+
+
+_single_flights: List[SingleFlight] = []
+_batchers: List[EmbeddingBatcher] = []
+
+
+def new_single_flight() -> SingleFlight:
+    """Create a SingleFlight whose statistics are reported by coalescing_stats()."""
+    single_flight = SingleFlight()
+    _single_flights.append(single_flight)
+    return single_flight
+
+
+def batch_query_embeddings(embeddings: Embeddings) -> Embeddings:
+    """Wrap embeddings for micro-batched queries, unless coalescing is disabled."""
+    if not coalescing_enabled:
+        return embeddings
+    batched = BatchedQueryEmbeddings(embeddings)
+    _batchers.append(batched.batcher)
+    return batched
+
+
+def coalesce(single_flight: SingleFlight, key: str, fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Run fn once per in-flight key; callers that shared a result get a marked copy."""
+    if not coalescing_enabled:
+        return fn()
+    result, shared = single_flight.do(key, fn)
+    if shared:
+        result = dict(result)
+        result["coalesced"] = True
+    return result
+
+
+def coalescing_stats() -> dict:
+    """Single-flight and embedding batch statistics for this process."""
+    return {
+        "enabled": coalescing_enabled,
+        "single_flight": [single_flight.stats() for single_flight in _single_flights],
+        "query_embedding_batches": [batcher.stats() for batcher in _batchers],
+    }
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Bounded executor for the blocking query path.
+
+process_query embeds, searches and waits on Ollama synchronously. Running it
+directly inside an ``async def`` endpoint blocks uvicorn's event loop, so
+/status and static files stall behind every generation. The API servers run
+queries on this pool instead. QUERY_CONCURRENCY sets how many queries run at
+once; further requests wait for a free worker without blocking the loop.
+"""
+
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Callable, Iterator
+
+# Load environment variables
+query_concurrency = int(os.environ.get('QUERY_CONCURRENCY', 4))
+
+_executor = ThreadPoolExecutor(max_workers=query_concurrency, thread_name_prefix='query')
+_counts = {"submitted": 0, "running": 0, "completed": 0}
+_counts_lock = threading.Lock()
+
+# Marks the end of a streamed iterator
+_DONE = object()
+
+# Streamed items buffered ahead of a slow client; the worker waits beyond that
+STREAM_QUEUE_SIZE = 64
+# How often a worker blocked on a full queue checks whether the stream was closed
+CANCEL_POLL_SECONDS = 0.1
+
+
+def _tracked(fn: Callable, *args: Any) -> Any:
+    with _counts_lock:
+        _counts["running"] += 1
+    try:
+        return fn(*args)
+    finally:
+        with _counts_lock:
+            _counts["running"] -= 1
+            _counts["completed"] += 1
+
+
+def _submit(fn: Callable, *args: Any) -> "asyncio.Future":
+    # Copy the caller's context so context variables set by the endpoint
+    # (e.g. the client identity) are visible in the worker thread
+    context = contextvars.copy_context()
+    with _counts_lock:
+        _counts["submitted"] += 1
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(_executor, context.run, _tracked, fn, *args)
+
+
+async def run_query(fn: Callable, *args: Any) -> Any:
+    """Run a blocking query function on the bounded pool and await its result."""
+    return await _submit(fn, *args)
+
+
+async def stream_query_events(iterator_fn: Callable[[], Iterator[Any]]) -> AsyncIterator[Any]:
+    """Consume a blocking iterator on the pool, yielding its items asynchronously.
+
+    The whole iteration occupies one worker, so streamed answers count
+    against QUERY_CONCURRENCY like regular ones. At most STREAM_QUEUE_SIZE
+    items are buffered. When the stream is closed early (the client
+    disconnected), the worker closes the iterator at its next item, which
+    stops the LLM generation, and frees itself.
+    """
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def put(item) -> bool:
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=CANCEL_POLL_SECONDS)
+                return True
+            except FutureTimeoutError:
+                if cancelled.is_set():
+                    future.cancel()
+                    return False
+
+    def consume():
+        iterator = iterator_fn()
+        try:
+            for item in iterator:
+                if cancelled.is_set() or not put(item):
+                    break
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            if not cancelled.is_set():
+                put(_DONE)
+
+    task = _submit(consume)
+    try:
+        while True:
+            item = await items.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        cancelled.set()
+    await task
+
+
+def executor_stats() -> dict:
+    with _counts_lock:
+        waiting = _counts["submitted"] - _counts["completed"] - _counts["running"]
+        return {
+            "concurrency": query_concurrency,
+            "running": _counts["running"],
+            "waiting": waiting,
+            "completed": _counts["completed"],
+        }
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Streaming query answers as newline-delimited JSON events.
+
+A streamed answer is a sequence of events:
+
+    {"type": "sources", "source_documents": [...], "retrieval_time": ...}
+    {"type": "token", "token": "..."}          (one per LLM token)
+    {"type": "done", "result": "...", "processing_time": ..., ...}
+
+or an {"type": "error", "detail": "..."} event if something fails (with
+"retry_after" when the LLM scheduler turned the query away). Sources
+are sent as soon as retrieval finishes, so time to first byte is the
+retrieval time instead of the whole generation time. Closing the stream
+early (the client went away) stops the LLM at its next token.
+"""
+
+import json
+import time
+import queue
+import threading
+import contextvars
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import Document
+
+# Marks the end of the token stream
+_DONE = object()
+
+
+class GenerationCancelled(Exception):
+    """Raised inside the LLM call to stop a generation nobody is reading."""
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Forward LLM tokens to a queue as they are generated."""
+
+    # Let GenerationCancelled abort the LLM call instead of being logged
+    raise_error = True
+
+    def __init__(self, token_queue: queue.Queue, cancelled: Optional[threading.Event] = None):
+        self.queue = token_queue
+        self.cancelled = cancelled
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise GenerationCancelled()
+        self.queue.put(token)
+
+
+def generate_tokens(run_fn: Callable[[list], str]) -> Iterator[str]:
+    """Run ``run_fn(callbacks)`` on a worker thread and yield its tokens.
+
+    The generator's return value (StopIteration.value) is run_fn's result.
+    Errors raised by run_fn are re-raised in the caller. Closing the
+    generator early cancels the generation at the next token.
+    """
+    tokens: queue.Queue = queue.Queue()
+    outcome: Dict[str, Any] = {}
+    cancelled = threading.Event()
+
+    def worker():
+        try:
+            outcome["result"] = run_fn([QueueCallbackHandler(tokens, cancelled)])
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            tokens.put(_DONE)
+
+    # Run in a copy of the caller's context so per-query context variables
+    # (e.g. the stage timer) are visible to the LLM call
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            token = tokens.get()
+            if token is _DONE:
+                break
+            yield token
+    finally:
+        cancelled.set()
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("result", "")
+
+
+def source_to_dict(doc: Document) -> dict:
+    """Serialize a source document the way the /query endpoints do."""
+    return {
+        "content": str(doc.page_content),
+        "source": str(doc.metadata.get("source", "Unknown Source")),
+    }
+
+
+def stream_answer(query: str,
+                  retrieve_fn: Callable[[str], Tuple[List[Document], Dict[str, Any]]],
+                  generate_fn: Callable[[List[Document], str, Optional[list]], str],
+                  cache=None) -> Iterator[dict]:
+    """Yield sources, tokens and a final timing record for a query.
+
+    Args:
+        retrieve_fn: Returns the documents for the prompt and extra fields
+            to report in the final event.
+        generate_fn: Runs the LLM over the documents, passing the given
+            callbacks so tokens can be streamed.
+        cache: Optional AnswerCache; hits are replayed as a single token.
+    """
+    start = time.time()
+    vector = None
+    try:
+        if cache is not None:
+            cached, tier, vector = cache.lookup(query)
+            if cached is not None:
+                yield {"type": "sources", "source_documents": [source_to_dict(doc) for doc in cached.get("source_documents", [])],
+                       "retrieval_time": 0.0, "cached": tier}
+                yield {"type": "token", "token": cached.get("result", "")}
+                yield {"type": "done", "result": cached.get("result", ""), "cached": tier,
+                       "processing_time": time.time() - start}
+                return
+
+        documents, extra = retrieve_fn(query)
+        retrieval_time = time.time() - start
+        yield {"type": "sources", "source_documents": [source_to_dict(doc) for doc in documents],
+               "retrieval_time": retrieval_time}
+
+        first_token_time = None
+        tokens = generate_tokens(lambda callbacks: generate_fn(documents, query, callbacks))
+        try:
+            while True:
+                try:
+                    token = next(tokens)
+                except StopIteration as stop:
+                    answer = stop.value
+                    break
+                if first_token_time is None:
+                    first_token_time = time.time() - start
+                yield {"type": "token", "token": token}
+        finally:
+            tokens.close()
+
+        processing_time = time.time() - start
+        done = {"type": "done", "result": answer, "processing_time": processing_time,
+                "retrieval_time": retrieval_time, "first_token_time": first_token_time}
+        done.update(extra)
+        yield done
+
+        if cache is not None:
+            cache.store(query, {"query": query, "result": answer, "source_documents": documents,
+                                "processing_time": processing_time}, vector)
+    except Exception as e:
+        import traceback
+        print(f"Error streaming query: {e}")
+        print(traceback.format_exc())
+        error = {"type": "error", "detail": str(e)}
+        if hasattr(e, "retry_after"):
+            error["retry_after"] = e.retry_after
+        yield error
+
+
+def ndjson(events: Iterator[dict]) -> Iterator[str]:
+    """Encode events as newline-delimited JSON for a StreamingResponse."""
+    for event in events:
+        yield json.dumps(event) + "\n"
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Per-stage latency breakdown for queries, and the slow-query log.
+
+A QueryTimer is installed in a context variable for the duration of a
+query; code anywhere on the query path records how long it spent with
+``stage(name)`` without the timer being passed around. The stages are:
+
+    cache      answer cache lookup (including its query embedding)
+    embed      query embedding for retrieval
+    retrieve   vector index query (and MMR selection)
+    pack       context packing and prompt construction
+    llm_queue  waiting for a generation slot in the LLM scheduler
+    llm        LLM generation
+
+Counts such as LLM tokens are recorded alongside with ``record_count`` and
+returned as the result's ``usage``.
+
+Queries slower than SLOW_QUERY_THRESHOLD seconds are written as JSON lines
+to a rotating log (SLOW_QUERY_LOG) with their breakdown and prompt size.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Load environment variables
+slow_query_threshold = float(os.environ.get('SLOW_QUERY_THRESHOLD', 10))
+slow_query_log_path = os.environ.get('SLOW_QUERY_LOG', 'logs/slow_queries.log')
+slow_query_log_max_bytes = int(os.environ.get('SLOW_QUERY_LOG_MAX_BYTES', 5 * 1024 * 1024))
+slow_query_log_backups = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 3))
+
+# The timer of the query running in the current context, if any
+current_timer: contextvars.ContextVar = contextvars.ContextVar('current_timer', default=None)
+
+
+class QueryTimer:
+    """Accumulated seconds per stage, and counts, for one query."""
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, float] = {}
+        self.start = time.perf_counter()
+        self.total: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        # Stages may be recorded from the LLM's token-streaming thread
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: float):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def stop(self) -> float:
+        if self.total is None:
+            self.total = time.perf_counter() - self.start
+        return self.total
+
+    def breakdown(self) -> Dict[str, float]:
+        """Seconds per stage plus the total, rounded to milliseconds."""
+        with self._lock:
+            timings = {name: round(seconds, 3) for name, seconds in self.stages.items()}
+        total = self.total if self.total is not None else time.perf_counter() - self.start
+        timings["total"] = round(total, 3)
+        return timings
+
+
+@contextmanager
+def stage(name: str):
+    """Time the enclosed block as ``name`` on the current query's timer, if any."""
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def record_stage(name: str, seconds: float):
+    """Add an already measured duration to the current query's timer, if any."""
+    timer = current_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+def record_count(name: str, value: float):
+    """Add to a count (e.g. generated tokens) on the current query's timer, if any."""
+    timer = current_timer.get()
+    if timer is not None:
+        timer.count(name, value)
+
+
+@contextmanager
+def timed_query():
+    """Install a fresh QueryTimer for the enclosed block and yield it."""
+    timer = QueryTimer()
+    token = current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        timer.stop()
+        current_timer.reset(token)
+
+
+_slow_log = None
+_slow_log_lock = threading.Lock()
+
+
+def _slow_query_logger() -> logging.Logger:
+    global _slow_log
+    if _slow_log is None:
+        with _slow_log_lock:
+            if _slow_log is None:
+                directory = os.path.dirname(slow_query_log_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                logger = logging.getLogger('slow_queries')
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(RotatingFileHandler(slow_query_log_path, maxBytes=slow_query_log_max_bytes,
+                                                      backupCount=slow_query_log_backups, encoding='utf-8'))
+                _slow_log = logger
+    return _slow_log
+
+
+def log_if_slow(query: str, timer: QueryTimer, context: Optional[dict] = None, **extra) -> bool:
+    """Write the query to the slow-query log if it exceeded the threshold.
+
+    ``context`` is the packed-context statistics of the answer; its prompt
+    size and chunk count are included in the entry.
+    """
+    total = timer.stop()
+    if slow_query_threshold <= 0 or total < slow_query_threshold:
+        return False
+    context = context or {}
+    entry = {
+        "time": datetime.now().isoformat(timespec='seconds'),
+        "query": query,
+        "timings": timer.breakdown(),
+        "prompt_tokens": context.get("prompt_tokens"),
+        "prompt_chars": context.get("prompt_chars"),
+        "chunks": context.get("packed_chunks"),
+        "retrieved_chunks": context.get("retrieved_chunks"),
+    }
+    entry.update(extra)
+    try:
+        _slow_query_logger().info(json.dumps(entry))
+    except Exception as e:
+        print(f"Could not write slow-query log: {e}")
+    print(f"Slow query ({total:.2f}s): {timer.breakdown()}")
+    return True
+
+
+def timed_answer(query: str, answer_fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Run answer_fn under a fresh timer; return a copy of its result with ``timings``."""
+    with timed_query() as timer:
+        result = answer_fn()
+    result = dict(result)
+    result["timings"] = timer.breakdown()
+    if timer.counts:
+        result["usage"] = dict(timer.counts)
+    log_if_slow(query, timer, result.get("context"),
+                cached=result.get("cached"), coalesced=result.get("coalesced", False))
+    return result
+
+
+def timed_events(query: str, events_fn: Callable[[], Iterator[dict]]) -> Iterator[dict]:
+    """Like timed_answer for streamed answers: timings are added to the "done" event."""
+    with timed_query() as timer:
+        for event in events_fn():
+            if event.get("type") == "done":
+                timer.stop()
+                event["timings"] = timer.breakdown()
+                if timer.counts:
+                    event["usage"] = dict(timer.counts)
+                log_if_slow(query, timer, event.get("context"), cached=event.get("cached"), streamed=True)
+            yield event
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Process-wide retrieval context for the Pinecone deployment.
+
+Creating the Pinecone client, resolving the index and loading the
+SentenceTransformer model are the expensive parts of answering a query, so
+they are done once (at startup) and shared by every request. Call
+refresh_retrieval_context() after an ingest to pick up index changes.
+
+Set VECTOR_BACKEND=local to serve from the in-process index in
+LOCAL_INDEX_DIRECTORY instead of Pinecone (see local_vector_store.py).
+"""
+
+import os
+import time
+import threading
+from typing import List, Optional, Tuple
+
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.schema import Document
+from lanchain_pinecone_adapter import CustomHuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings
+from pinecone_langchain_adapter import PineconeVectorStore
+from local_vector_store import LocalVectorIndex, LocalVectorStore, local_index_directory
+from query_coalescer import batch_query_embeddings
+from query_timing import stage
+
+# Load environment variables
+pinecone_api_key = os.environ.get('PINECONE_API_KEY', 'pcsk_1MfLA_QRmNnRSR4pumc7thAYp6eqHkxGF3Jhmbs9X66SN2i1Rr4akBzmERV5NCjyBhE8e')
+index_name = os.environ.get('PINECONE_INDEX_NAME', 'phoenixville-municipal-code')
+embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME', 'llama-text-embed-v2')
+vector_backend = os.environ.get('VECTOR_BACKEND', 'pinecone').lower()
+search_type = os.environ.get('SEARCH_TYPE', 'similarity').lower()
+mmr_fetch_k = int(os.environ.get('MMR_FETCH_K', 20))
+mmr_lambda = float(os.environ.get('MMR_LAMBDA', 0.5))
+
+
+class IndexNotFoundError(RuntimeError):
+    """Raised when the configured Pinecone (or local) index does not exist."""
+
+
+# The embedding model is shared by querying and ingestion, so it is loaded
+# at most once per process.
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings():
+    """Return the process-wide embedding model, loading it on first use."""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                try:
+                    _embeddings = CustomHuggingFaceEmbeddings()
+                except Exception as e:
+                    print(f"Error with custom embeddings: {e}")
+                    _embeddings = CachedEmbeddings(
+                        HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name
+                    )
+    return _embeddings
+
+
+class RetrievalContext:
+    """Long-lived Pinecone client, index handle, embedding model and vectorstore."""
+
+    def __init__(self, api_key: str = pinecone_api_key, index: str = index_name, backend: str = vector_backend):
+        if backend not in ('pinecone', 'local'):
+            raise ValueError(f"Unknown VECTOR_BACKEND '{backend}' (expected 'pinecone' or 'local')")
+        self.api_key = api_key
+        self.backend = backend
+        self.index_name = index if backend == 'pinecone' else local_index_directory
+        self.client = None
+        self.index = None
+        self.embeddings = None
+        self.query_embeddings = None
+        self.vectorstore = None
+        self.warmup_time = None
+        self.ready_at = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Create the client and resolve the index, failing if it is missing."""
+        if self.backend == 'local':
+            if not LocalVectorIndex.exists(self.index_name):
+                raise IndexNotFoundError(f"Local index '{self.index_name}' does not exist; "
+                                         f"run pinecone_ingest.py with VECTOR_BACKEND=local")
+            return None, LocalVectorIndex.load(self.index_name)
+
+        from pinecone import Pinecone
+        client = Pinecone(api_key=self.api_key)
+        indexes = client.list_indexes()
+        if self.index_name not in indexes.names():
+            raise IndexNotFoundError(f"Pinecone index '{self.index_name}' does not exist")
+        return client, client.Index(self.index_name)
+
+    def _vectorstore(self, index, embeddings):
+        if self.backend == 'local':
+            return LocalVectorStore(embedding=embeddings, persist_directory=self.index_name, index=index)
+        return PineconeVectorStore(
+            pinecone_api_key=self.api_key,
+            index_name=self.index_name,
+            embedding=embeddings,
+            index=index
+        )
+
+    def warm_up(self, embeddings=None, index=None) -> "RetrievalContext":
+        """Connect to the index and load the embedding model once.
+
+        ``embeddings`` replaces the shared embedding model and ``index`` the
+        connection to the index (e.g. a stub in benchmarks and load tests).
+        """
+        start = time.time()
+        client, index = (None, index) if index is not None else self._connect()
+        embeddings = embeddings if embeddings is not None else get_embeddings()
+
+        # The first encode call initialises the model's kernels and buffers
+        dimension = len(embeddings.embed_query("warm-up"))
+        index_dimension = index.describe_index_stats().dimension
+        if index_dimension and index_dimension != dimension:
+            raise ValueError(
+                f"Index '{self.index_name}' has dimension {index_dimension} but the "
+                f"embeddings produce {dimension}; check EMBEDDING_TARGET_DIM"
+            )
+
+        # Concurrent queries share batched model.encode calls
+        query_embeddings = batch_query_embeddings(embeddings)
+        vectorstore = self._vectorstore(index, query_embeddings)
+
+        with self._lock:
+            self.client = client
+            self.index = index
+            self.embeddings = embeddings
+            self.query_embeddings = query_embeddings
+            self.vectorstore = vectorstore
+            self.ready_at = time.time()
+            self.warmup_time = self.ready_at - start
+
+        print(f"Retrieval context ready in {self.warmup_time:.2f}s ({self.backend} index: {self.index_name})")
+        return self
+
+    def refresh(self) -> "RetrievalContext":
+        """Re-resolve the index after an ingest, keeping the loaded model."""
+        if self.embeddings is None:
+            return self.warm_up()
+
+        client, index = self._connect()
+        vectorstore = self._vectorstore(index, self.query_embeddings)
+        with self._lock:
+            self.client = client
+            self.index = index
+            self.vectorstore = vectorstore
+        print(f"Retrieval context refreshed ({self.backend} index: {self.index_name})")
+        return self
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None) -> List[Document]:
+        """Search the index using the shared vectorstore."""
+        return self.vectorstore.similarity_search(query, k=k, filter=filter)
+
+    def search(self, query: str, k: int = 4, filter: Optional[dict] = None) -> List[Document]:
+        """Search with the configured strategy (SEARCH_TYPE=similarity or mmr).
+
+        ``filter`` is a metadata filter, e.g. code_chunker.chapter_filter("27").
+        """
+        if search_type == 'mmr':
+            return self.vectorstore.max_marginal_relevance_search(
+                query, k=k, fetch_k=max(mmr_fetch_k, k), lambda_mult=mmr_lambda, filter=filter
+            )
+        return self.similarity_search(query, k=k, filter=filter)
+
+    def search_with_scores(self, query: str, k: int = 4,
+                           filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """Like search(), returning (document, similarity) pairs."""
+        with stage("embed"):
+            vector = self.query_embeddings.embed_query(query)
+        with stage("retrieve"):
+            if search_type == 'mmr':
+                return self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                    vector, k=k, fetch_k=max(mmr_fetch_k, k), lambda_mult=mmr_lambda, filter=filter
+                )
+            return self.vectorstore.similarity_search_with_score_by_vector(vector, k=k, filter=filter)
+
+    def describe_index_stats(self):
+        """Return index statistics using the cached index handle."""
+        return self.index.describe_index_stats()
+
+
+_context: Optional[RetrievalContext] = None
+_context_lock = threading.Lock()
+
+
+def init_retrieval_context() -> RetrievalContext:
+    """Create and warm the process-wide retrieval context.
+
+    Raises IndexNotFoundError if the index is missing so callers can fail fast.
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = RetrievalContext().warm_up()
+    return _context
+
+
+def use_retrieval_context(context: RetrievalContext) -> RetrievalContext:
+    """Install an already warmed context as the process-wide one."""
+    global _context
+    with _context_lock:
+        _context = context
+    return _context
+
+
+def current_retrieval_context() -> Optional[RetrievalContext]:
+    """Return the process-wide retrieval context if it has been created, without warming it."""
+    return _context
+
+
+def get_retrieval_context() -> RetrievalContext:
+    """Return the process-wide retrieval context, warming it on first use."""
+    if _context is None:
+        return init_retrieval_context()
+    return _context
+
+
+def refresh_retrieval_context() -> RetrievalContext:
+    """Refresh the retrieval context after the index has changed."""
+    global _context
+    with _context_lock:
+        if _context is None:
+            _context = RetrievalContext().warm_up()
+        else:
+            _context.refresh()
+    return _context
@@ -0,0 +1,29 @@
+from langchain.docstore.document import Document
+
+from code_chunker import CodeChunker, iter_sections
+
+ROMAN_CHAPTER = """CHAPTER XXVII ZONING
+Part 2 Districts
+§ 27-201. Purpose.
+Districts are established to promote the general welfare.
+§ 27-202. Uses.
+Permitted uses are listed in the table, subject to
+§ 5-102. Fees apply.
+"""
+
+
+def test_sections_under_roman_numeral_chapter():
+    paths = [{level: value[0] for level, value in path.items()} for _, _, path in iter_sections(ROMAN_CHAPTER)]
+    assert paths[-2:] == [
+        {"chapter": "XXVII", "part": "2", "section": "27-201"},
+        {"chapter": "XXVII", "part": "2", "section": "27-202"},
+    ]
+
+
+def test_roman_numeral_chapter_chunks_keep_section_metadata():
+    chunks = CodeChunker(500, 50).split_documents([Document(page_content=ROMAN_CHAPTER, metadata={"source": "code.pdf"})])
+    sections = [chunk.metadata.get("section") for chunk in chunks]
+    assert sections == ["27-201", "27-202"]
+    # The cross-reference to Chapter 5 stays in the body of § 27-202
+    assert "§ 5-102" in chunks[-1].page_content
+    assert chunks[-1].metadata["section_path"] == "CHAPTER XXVII ZONING > Part 2 Districts > § 27-202. Uses."
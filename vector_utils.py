@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Small NumPy helpers shared by the vector stores.
+"""
+
+import numpy as np
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """L2-normalize vectors (1-D or 2-D) as float32, leaving zero vectors at zero."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without a full sort."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def maximal_marginal_relevance(query_vector, candidate_vectors, k: int = 4,
+                               lambda_mult: float = 0.5) -> list:
+    """Pick k candidates balancing relevance to the query against redundancy.
+
+    All pairwise similarities are computed in one matrix product; each step
+    then updates every candidate's similarity to the selected set with a
+    single vectorized maximum, so selection is O(k * n) array work.
+    Returns the selected candidate indices in selection order.
+    """
+    candidates = normalize_rows(candidate_vectors)
+    if candidates.ndim != 2 or len(candidates) == 0 or k <= 0:
+        return []
+    query = normalize_rows(query_vector)
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    k = min(k, len(candidates))
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        np.maximum(redundancy, similarity[chosen], out=redundancy)
+    return selected